@@ -0,0 +1,267 @@
+import os
+import math
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from collections import namedtuple, deque
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+DIRECTORY = "audit"
+SEGMENT_SIZE = 16 << 20  # Bytes of records in a segment before the log moves on to a new one
+MAX_SEGMENTS = 64  # Segments kept, the oldest one is deleted when there would be more
+FLUSH_INTERVAL = 0.5  # Seconds recorded rolls may wait to be written
+INDEX_GROWTH = 1 << 16  # Entries the index file grows by when it's full
+MAX_EXPRESSION = 1024  # Bytes of an expression that are kept
+
+MAGIC = b"DXAUDIT1"
+# crc32 of the rest of the record, chat_id, user_id, timestamp, seed, result, length of the expression that follows
+RECORD = struct.Struct("<IqqdQdH")
+INDEX_HEADER = struct.Struct("<8sQ")  # MAGIC, entries in the index
+# chat_id, user_id, segment, offset of the record in it, previous entry of the chat, previous entry of the user in
+# the chat (-1 for none) and result
+ENTRY = struct.Struct("<qqIIqqd")
+
+Roll = namedtuple("Roll", ["chat_id", "user_id", "timestamp", "expression", "seed", "result"])
+UserStats = namedtuple("UserStats", ["rolls", "mean", "lowest", "highest"])
+
+
+class AuditLog:
+    '''Append-only binary log of every roll, with a memory-mapped index of the rolls of every chat and user
+
+    Records go to numbered segment files, a new one once a segment holds segment_size bytes, and only the last
+    MAX_SEGMENTS are kept, together with the index entries of their rolls. Each index entry points at its record
+    and at the previous entries of its chat and of its user in the chat, so history() and user_stats() follow those
+    chains and read only the rolls they answer with.
+    record() just queues the roll: a writer thread appends the queued ones in a single write every flush_interval
+    seconds, without syncing to disk. Queries flush first, so they see every recorded roll.
+    Nothing is opened until the first roll is written or queried'''
+    def __init__(self, directory=DIRECTORY, segment_size=SEGMENT_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__writer = None
+        self.__closed = False
+        self.__opened = False
+        self.__index = None  # mmap of the index file
+        self.__entries = 0
+        self.__chats = {}  # chat_id: last entry of the chat
+        self.__users = {}  # (chat_id, user_id): last entry of the user in the chat
+        self.__segment = None  # number, file and size of the segment being appended to
+        self.__readers = {}  # segment: file descriptor
+
+    def record(self, chat_id, user_id, expression, seed, result):
+        '''Queues a roll to be written'''
+        self.pending.append((chat_id, user_id, time.time(), expression, seed, result))
+        if self.__writer is None and not self.__closed:
+            with self.__lock:
+                if self.__writer is None:
+                    self.__writer = threading.Thread(target=self._write_forever, name="audit-log", daemon=True)
+                    self.__writer.start()
+
+    def _write_forever(self):
+        while not self.__closed:
+            self.__wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write rolls to the audit log")
+
+    def flush(self):
+        '''Writes the queued rolls'''
+        with self.__lock:
+            if not self.pending:
+                return
+            # Popping from the deque keeps record() from ever waiting for the lock
+            batch = [self.pending.popleft() for _ in range(len(self.pending))]
+            self._open()
+            self._append(batch)
+
+    def _open(self):
+        if self.__opened:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "index")
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(descriptor).st_size == 0:
+                os.ftruncate(descriptor, INDEX_HEADER.size + ENTRY.size * INDEX_GROWTH)
+            self.__index = mmap.mmap(descriptor, 0)
+        finally:
+            os.close(descriptor)
+        magic, self.__entries = INDEX_HEADER.unpack_from(self.__index)
+        if magic != MAGIC:
+            if self.__entries or magic.strip(b"\0"):
+                raise ValueError(f"{path} is not the index of an audit log")
+            INDEX_HEADER.pack_into(self.__index, 0, MAGIC, 0)
+        # The heads of the chains are the only thing not stored, so they're found again in one pass over the index
+        entries = memoryview(self.__index)[INDEX_HEADER.size:INDEX_HEADER.size + self.__entries * ENTRY.size]
+        for number, (chat_id, user_id, *_) in enumerate(ENTRY.iter_unpack(entries)):
+            self.__chats[chat_id] = number
+            self.__users[chat_id, user_id] = number
+        entries.release()
+        segments = self._segments()
+        self._start_segment(segments[-1] if segments else 1)
+        self.__opened = True
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{number:08d}.log")
+
+    def _start_segment(self, number):
+        if self.__segment is not None:
+            self.__segment[1].close()
+        segment = open(self._segment_path(number), "ab")
+        self.__segment = [number, segment, segment.tell()]
+        for old in self._segments()[:-MAX_SEGMENTS]:
+            reader = self.__readers.pop(old, None)
+            if reader is not None:
+                os.close(reader)
+            os.remove(self._segment_path(old))
+            logger.info("Deleted audit log segment %s", old)
+        self._drop_entries(self._segments()[0])
+
+    def _drop_entries(self, oldest):
+        '''Removes the index entries of the segments before oldest, so the index only grows with the kept
+        segments. Entries are in the order of their segments, so they're a prefix of the index, and the rest is
+        written to a new index that replaces the old one, renumbered with the chains that led into the prefix cut'''
+        dropped = low = 0
+        high = self.__entries
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[2] < oldest:
+                dropped = low = middle + 1
+            else:
+                high = middle
+        if not dropped:
+            return
+        kept = self.__entries - dropped
+        data = bytearray(INDEX_HEADER.size + ENTRY.size * (kept + INDEX_GROWTH))
+        INDEX_HEADER.pack_into(data, 0, MAGIC, kept)
+        for number in range(kept):
+            chat_id, user_id, segment, offset, chat_previous, user_previous, result = self._entry(dropped + number)
+            ENTRY.pack_into(data, INDEX_HEADER.size + number * ENTRY.size, chat_id, user_id, segment, offset,
+                            max(chat_previous - dropped, -1), max(user_previous - dropped, -1), result)
+        path = os.path.join(self.directory, "index")
+        with open(path + ".new", "wb") as index:
+            index.write(data)
+        # The new index replaces the old one whole, so a crash leaves one or the other
+        os.replace(path + ".new", path)
+        self.__index.close()
+        descriptor = os.open(path, os.O_RDWR)
+        try:
+            self.__index = mmap.mmap(descriptor, 0)
+        finally:
+            os.close(descriptor)
+        self.__entries = kept
+        for heads in (self.__chats, self.__users):
+            for key, entry in list(heads.items()):
+                if entry < dropped:
+                    del heads[key]
+                else:
+                    heads[key] = entry - dropped
+        logger.info("Dropped %s audit log index entries of deleted segments", dropped)
+
+    def _append(self, batch):
+        number, segment, size = self.__segment
+        if size >= self.segment_size:
+            self._start_segment(number + 1)
+            number, segment, size = self.__segment
+        if self.__entries + len(batch) > (len(self.__index) - INDEX_HEADER.size) // ENTRY.size:
+            self._grow_index(len(batch))
+        data = bytearray()
+        for chat_id, user_id, timestamp, expression, seed, result in batch:
+            encoded = expression.encode()[:MAX_EXPRESSION]
+            record = RECORD.pack(0, chat_id, user_id, timestamp, seed, result, len(encoded))[4:] + encoded
+            offset = size + len(data)
+            data += struct.pack("<I", zlib.crc32(record)) + record
+            entry = self.__entries
+            ENTRY.pack_into(self.__index, INDEX_HEADER.size + entry * ENTRY.size, chat_id, user_id, number, offset,
+                            self.__chats.get(chat_id, -1), self.__users.get((chat_id, user_id), -1), result)
+            self.__chats[chat_id] = self.__users[chat_id, user_id] = entry
+            self.__entries += 1
+        # Records are written before the index counts them, so an index never points past the end of a segment
+        segment.write(data)
+        segment.flush()
+        self.__segment[2] = size + len(data)
+        INDEX_HEADER.pack_into(self.__index, 0, MAGIC, self.__entries)
+
+    def _grow_index(self, needed):
+        capacity = (len(self.__index) - INDEX_HEADER.size) // ENTRY.size + max(needed, INDEX_GROWTH)
+        self.__index.resize(INDEX_HEADER.size + capacity * ENTRY.size)
+
+    def _entry(self, number):
+        return ENTRY.unpack_from(self.__index, INDEX_HEADER.size + number * ENTRY.size)
+
+    def _read(self, segment, offset):
+        '''The record at offset of segment, None if the segment was deleted or the record is damaged'''
+        reader = self.__readers.get(segment)
+        if reader is None:
+            try:
+                reader = self.__readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+        header = os.pread(reader, RECORD.size, offset)
+        crc, chat_id, user_id, timestamp, seed, result, length = RECORD.unpack(header)
+        expression = os.pread(reader, length, offset + RECORD.size)
+        if zlib.crc32(header[4:] + expression) != crc:
+            logger.warning("Damaged record at %s of audit log segment %s", offset, segment)
+            return None
+        return Roll(chat_id, user_id, timestamp, expression.decode(errors="replace"), seed, result)
+
+    def history(self, chat_id, count):
+        '''The last count rolls of the chat, newest first'''
+        self.flush()
+        rolls = []
+        with self.__lock:
+            self._open()
+            entry = self.__chats.get(chat_id, -1)
+            while entry >= 0 and len(rolls) < count:
+                _, _, segment, offset, previous, _, _ = self._entry(entry)
+                roll = self._read(segment, offset)
+                if roll is None:
+                    break
+                rolls.append(roll)
+                entry = previous
+        return rolls
+
+    def user_stats(self, chat_id, user_id):
+        '''UserStats of the results of every roll of the user in the chat, None if there are none. Only the index
+        is read'''
+        self.flush()
+        results = []
+        with self.__lock:
+            self._open()
+            entry = self.__users.get((chat_id, user_id), -1)
+            while entry >= 0:
+                *_, previous, result = self._entry(entry)
+                if not math.isnan(result):
+                    results.append(result)
+                entry = previous
+        if not results:
+            return None
+        return UserStats(len(results), sum(results) / len(results), min(results), max(results))
+
+    def close(self):
+        self.__closed = True
+        self.__wakeup.set()
+        if self.__writer is not None:
+            self.__writer.join()
+        self.flush()
+        with self.__lock:
+            if self.__opened:
+                self.__segment[1].close()
+                self.__index.close()
+                for reader in self.__readers.values():
+                    os.close(reader)
+                self.__readers.clear()
+                self.__opened = False
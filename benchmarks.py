@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import asyncio
+import argparse
+import platform
+import timeit
+import logging
+
+import shuntingyard
+import dicebackends
+import timeout
+import dXRollBot
+import sendqueue
+import auditlog
+
+SEED = 20200517
+THRESHOLD = 0.25  # A case regresses when it gets this much slower than the baseline
+
+EXPRESSIONS = ["2+3*4",
+               "1d20+5",
+               "4d6dl1",
+               "(2^3 + 2) % 4 / 3 + 7d13",
+               "floor(3d6/2)+ceil(1d4)"]
+
+# Group: expressions evaluated by the suite
+SUITE = {"arithmetic": ["2+3*4", "(5 + 7.5 * (2**5 - 60/2))%2", "floor(10/3) + ceil(2.5) * abs(-4)"],
+         "formulas": ["1d20+5", "2d20kh1+7", "4d6dl1", "8d6", "1d8+1d6+3", "3d6!", "2d10ro<2+4", "4dF+2"],
+         "pools": ["100000d6dl50000", "1000d6!!", "10000d10kh10", "1000000d6"],
+         "errors": ["(1+2", "1d6r<7", "2d6kh3", "foo(1)", "1/0"]}
+# Case: program run by a new interpreter, timed from start to exit
+STARTUP = {"python": "pass",
+           "import dxroll and roll": "import dxroll; dxroll.roll('1d20')"}
+TOKENIZER_INPUT = "+".join(f"{i % 9 + 1}d{i % 19 + 2}kh1*({i}+floor({i}/3))" for i in range(100))
+
+POOL_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+POOL_MODIFIERS = ["", "dl{half}", "r<3", "!"]
+
+
+def seed(value=SEED):
+    dicebackends.seed(value)
+
+
+def per_call(function, repeat=5, number=2000):
+    '''Best-of-repeat time of a single call to function, in microseconds'''
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number * 1e6
+
+
+def measure(function, repeat=5, budget=0.2):
+    '''Best-of-repeat time of a single call to function in seconds, calling it as many times per repeat as fit
+    in budget seconds'''
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * budget / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def _evaluate_quietly(expression):
+    try:
+        shuntingyard.ExpressionEvaluation(expression)
+    except Exception:
+        pass
+
+
+class InlineEvaluator:
+    '''Evaluator that runs functions in the calling thread, to time the bot without worker processes'''
+    def evaluate(self, seconds, function, *args):
+        return function(*args)
+
+
+class StubAPI:
+    '''Telegram API that answers instantly'''
+    async def send_message(self, chat_id, text, **kwargs):
+        return {"chat": {"id": chat_id}, "text": text}
+
+
+async def _roll_and_send(bot, expression):
+    await bot._roll(1, expression)
+    await bot.outbox.join()
+
+
+def bot_cases(expression="4d6kh3+2"):
+    '''End-to-end dXRollBot._roll, with the evaluator inline and in the worker pool'''
+    loop = asyncio.new_event_loop()
+    pool = timeout.EvaluatorPool(workers=1)
+    directory = tempfile.TemporaryDirectory()
+    audit = auditlog.AuditLog(directory.name)
+    cases = {}
+    for name, evaluator in (("inline", InlineEvaluator()), ("pool", pool)):
+        api = StubAPI()
+        # Without rate limits, so the case times the bot rather than waiting for the outbox
+        bot = dXRollBot.dXRollBot("TOKEN", api=api, evaluator=evaluator, audit_log=audit,
+                                  outbox=sendqueue.Outbox(api, global_rate=None, chat_rate=None, coalesce=False))
+        cases[f"bot/_roll {name}"] = lambda bot=bot: loop.run_until_complete(_roll_and_send(bot, expression))
+    return cases, lambda: (pool.close(), loop.close(), audit.close(), directory.cleanup())
+
+
+def run_suite(groups=None, repeat=5):
+    '''Runs the benchmark cases, returns {case: seconds per call}'''
+    cases = {}
+    if groups is None or "tokenizer" in groups:
+        compact = shuntingyard.GRAMMAR.compact(TOKENIZER_INPUT)
+        cases["tokenizer/100 terms"] = lambda: shuntingyard.GRAMMAR.tokenize(compact)
+        cases["compile/100 terms uncached"] = lambda: shuntingyard.compile_expression(TOKENIZER_INPUT, cache=None)
+    for group, expressions in SUITE.items():
+        if groups is None or group in groups:
+            for expression in expressions:
+                cases[f"{group}/{expression}"] = lambda expression=expression: _evaluate_quietly(expression)
+    if groups is None or "startup" in groups:
+        # Cold starts, the bare interpreter shows how much of them the library takes
+        for name, code in STARTUP.items():
+            cases[f"startup/{name}"] = lambda code=code: subprocess.run(
+                [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    cleanup = None
+    if groups is None or "bot" in groups:
+        bot, cleanup = bot_cases()
+        cases.update(bot)
+    results = {}
+    try:
+        for name, function in cases.items():
+            seed()
+            results[name] = measure(function, repeat=repeat)
+            print(f"{name:<48} {results[name] * 1e6:12.2f} us", file=sys.stderr)
+    finally:
+        if cleanup is not None:
+            cleanup()
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''Returns [(case, baseline seconds, new seconds)] of the cases that got slower than threshold allows'''
+    return [(name, baseline[name], seconds) for name, seconds in results.items()
+            if name in baseline and seconds > baseline[name] * (1 + threshold)]
+
+
+def report(results, baseline, threshold=THRESHOLD):
+    regressions = {name for name, *_ in compare(results, baseline, threshold)}
+    for name, seconds in results.items():
+        if name in baseline:
+            ratio = seconds / baseline[name]
+            flag = "REGRESSED" if name in regressions else ""
+            print(f"{name:<48} {baseline[name] * 1e6:12.2f} -> {seconds * 1e6:12.2f} us  x{ratio:5.2f} {flag}")
+    return regressions
+
+
+def bench_expressions(expressions=EXPRESSIONS):
+    for expression in expressions:
+        elapsed = per_call(lambda: shuntingyard.ExpressionEvaluation(expression))
+        print(f"{expression:<32} {elapsed:10.2f} us")
+    print(f"Program cache: {shuntingyard.PROGRAM_CACHE.info()}")
+
+
+def bench_pools(sizes=POOL_SIZES):
+    '''Rolls NdS pools with every available dice backend'''
+    # Backend name: (ARRAY_THRESHOLD, COUNT_THRESHOLD)
+    backends = {"list": (float("inf"), float("inf")), "counts": (float("inf"), 0)}
+    if dicebackends.ARRAY_DICE is not None:
+        backends["array"] = (0, float("inf"))
+    for size in sizes:
+        for modifier in POOL_MODIFIERS:
+            expression = f"{size}d6" + modifier.format(half=size // 2)
+            timings = []
+            for name, (array_threshold, count_threshold) in backends.items():
+                dicebackends.ARRAY_THRESHOLD, dicebackends.COUNT_THRESHOLD = array_threshold, count_threshold
+                elapsed = per_call(lambda: shuntingyard.ExpressionEvaluation(expression), repeat=3, number=1)
+                timings.append(f"{name} {elapsed / 1000:10.2f} ms")
+            print(f"{expression:<24} " + "  ".join(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the dice expression evaluator and the bot")
+    parser.add_argument("expressions", nargs="*", help="time just these expressions")
+    parser.add_argument("--pools", action="store_true", help="benchmark dice backends on 10^3..10^7 dice")
+    parser.add_argument("--groups", nargs="+", choices=["tokenizer", *SUITE, "startup", "bot"], help="run only these groups of the suite")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE (usable as a baseline)")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with the results stored in FILE and fail on regressions")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed slowdown versus the baseline, 0.25 is 25%%")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.pools:
+        bench_pools()
+        return 0
+    if args.expressions:
+        bench_expressions(args.expressions)
+        return 0
+    results = run_suite(args.groups, args.repeat)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"seed": SEED, "python": platform.python_version(), "machine": platform.machine(),
+                       "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = report(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed by more than {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if (__name__ == "__main__"):
+    sys.exit(main())
@@ -1,4 +1,39 @@
 import shuntingyard
+import dicebackends
+import distribution
+import simulation
+import timeout
+import telegram
+import fakeapi
+import dXRollBot
+import sendqueue
+import rendering
+import webhook
+import macros
+import auditlog
+import inline
+import dxroll
+import tracing
+import metrics
+import urllib.request
+import urllib.error
+import benchmarks
+import helptopics
+import os
+import io
+import math
+import re
+import json
+import pickle
+import subprocess
+import signal
+import sys
+import functools
+import operator
+import collections
+import logging
+import time
+import asyncio
 import pytest
 
 tested = shuntingyard.ExpressionEvaluation
@@ -75,6 +110,21 @@ class TestClass(object):
         with pytest.raises(shuntingyard.NegativeRollMeasurements):
             tested("2d(2-3)")
 
+    @pytest.mark.parametrize("expression", ["1d0", "20d0", "300d0", "1d(1d2-2)"])
+    def test_zero_sided_dice(self, expression):
+        # Refused before anything is drawn, drawing from no faces would never stop
+        with pytest.raises(shuntingyard.NegativeRollMeasurements, match="0 sides"):
+            tested(expression)
+        with pytest.raises(shuntingyard.NegativeRollMeasurements):
+            shuntingyard.RolledDice(int(expression.split("d")[0]), 0)
+        with pytest.raises(ValueError):
+            dicebackends.RandomSource(1).randints(20, 1, 0)
+
+    def test_counted_reroll_error(self):
+        # Every backend refuses a reroll that never stops the same way
+        with pytest.raises(shuntingyard.RerollValueError):
+            dicebackends.COUNTED_DICE.reroll(dicebackends.FaceCounts({1: 20000}), 1, 1, operator.eq, 1)
+
     def test_keep_drop_error(self):
         with pytest.raises(shuntingyard.RollModifierMisuse):
             tested("5kl2")
@@ -95,6 +145,22 @@ class TestClass(object):
         with pytest.raises(shuntingyard.MismatchedBrackets):
             tested("2d6+(3*(2-4)))")
 
+    @pytest.mark.parametrize("expression, exception, message", [
+        ("2d6 + round(roo)", shuntingyard.UnknownSymbol, "'roo' at position 13"),
+        ("1d20 +  foo(1)", shuntingyard.UnknownSymbol, "'foo' at position 9"),
+        ("1_0", shuntingyard.UnknownSymbol, "'1_0' at position 1"),
+        ("2d6+(3*(2-4)", shuntingyard.MismatchedBrackets, "'(' at position 5 is never closed"),
+        ("2 * (3)) + 1", shuntingyard.MismatchedBrackets, "')' at position 8 has no opening bracket")])
+    def test_error_positions(self, expression, exception, message):
+        with pytest.raises(exception, match=re.escape(message)):
+            shuntingyard.compile_expression(expression, cache=None)
+
+    def test_tokenizer(self):
+        tokens = shuntingyard.GRAMMAR.tokenize("-2**3+4d%+floor(3d6!!<2kh1)-dF")
+        assert [value for _, value, _ in tokens] == ["_", 2.0, "^", 3.0, "+", 4.0, "d", 100.0, "+", "floor", "(", 3.0, "d",
+                                                     6.0, "!!<", 2.0, "kh", 1.0, ")", "-", "d", "F"]
+        assert [position for _, _, position in tokens][:4] == [0, 1, 2, 4]
+
     def test_function_for_dice(self):
         result = tested("ceil(6dF + 0.5)").result
         assert float(result) == sum(result.rolls[0]) + 1
@@ -166,3 +232,976 @@ class TestClass(object):
         for x, y in zip([x for x in result.rolls[0]], [x for x in result.additional_rolls[0]]):
             if y > 0:
                 assert x - y < 3
+
+    def test_shared_grammar(self):
+        assert tested("1d6").operators is tested("2+2").operators
+
+    def test_grammar_is_immutable(self):
+        with pytest.raises(TypeError):
+            shuntingyard.GRAMMAR.operators["x"] = shuntingyard.GRAMMAR.operators["+"]
+
+    def test_program_cache(self):
+        cache = shuntingyard.ProgramCache(maxsize=2)
+        first = shuntingyard.compile_expression("1d20 + 5", cache=cache)
+        assert shuntingyard.compile_expression("1d20+5", cache=cache) is first
+        shuntingyard.compile_expression("4d6dl1", cache=cache)
+        shuntingyard.compile_expression("8d6", cache=cache)
+        assert cache.info() == shuntingyard.CacheInfo(hits=1, misses=3, evictions=1, size=2, maxsize=2)
+
+    def test_program_cache_normalization(self):
+        cache = shuntingyard.ProgramCache()
+        assert shuntingyard.compile_expression("2^3+1d6", cache=cache) is shuntingyard.compile_expression("2**3 + 1d6", cache=cache)
+        assert shuntingyard.compile_expression("1d100", cache=cache) is shuntingyard.compile_expression("1d%", cache=cache)
+        assert cache.info().size == 2
+
+    def test_program_reexecution(self):
+        program = shuntingyard.compile_expression("10d1 + 2")
+        assert float(program.execute()) == float(program.execute()) == 12
+
+    def test_constant_folding(self):
+        program = shuntingyard.compile_expression("(2^3 + 2) * 3 + 1d6")
+        assert program.instructions[0] == (shuntingyard.PUSH, 30)
+
+    @pytest.mark.parametrize("threshold", [0, float("inf")])
+    def test_modifier_sums(self, monkeypatch, threshold):
+        monkeypatch.setattr(shuntingyard.dicebackends, "ARRAY_THRESHOLD", threshold)
+        for expression in ["300d6r<3", "300d6ro1", "300d6!", "300d6!!>4", "300d6dl100", "300dF!"]:
+            result = tested(expression).result
+            assert float(result) == sum(result.rolls[-1])
+
+    @pytest.mark.parametrize("count_threshold, array_threshold", [(0, 0), (float("inf"), 0),
+                                                                  (float("inf"), float("inf"))])
+    def test_chained_explodes(self, monkeypatch, count_threshold, array_threshold):
+        if count_threshold > array_threshold:
+            pytest.importorskip("numpy")
+        monkeypatch.setattr(shuntingyard.dicebackends, "COUNT_THRESHOLD", count_threshold)
+        monkeypatch.setattr(shuntingyard.dicebackends, "ARRAY_THRESHOLD", array_threshold)
+        for seed in range(10):
+            result = shuntingyard.evaluate("20d6!>5!<2", seed)
+            # The dice of both explosions are kept, like the ones dropped by chained keeps
+            assert len(result.rolls[0]) == 20 + len(result.additional_rolls[0])
+
+    def test_array_backend(self, monkeypatch):
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(shuntingyard.dicebackends, "ARRAY_THRESHOLD", 0)
+        result = tested("2000d6!").result
+        assert result.backend is shuntingyard.dicebackends.ARRAY_DICE
+        assert len(result.rolls[0]) == 2000 + len([x for x in result.rolls[0] if x == 6])
+        assert list(result.rolls[0][2000:]) == list(result.additional_rolls[0])
+
+    @pytest.mark.parametrize("rolls, kept, indices", [([3, 1, 4, 1, 5, 9, 2, 6], [5, 9, 6], [0, 1, 2, 3, 6]),
+                                                       ([300, 1, 4000, 1, 50, 90000, 2, 6], [300, 4000, 90000], [1, 3, 4, 6, 7])])
+    def test_keep_preserves_order(self, rolls, kept, indices):
+        backend = shuntingyard.dicebackends.LIST_DICE
+        assert backend.keep(rolls, 3, highest=True) == (kept, [rolls[index] for index in indices], indices)
+        assert backend.keep(rolls, 2, highest=False) == ([1, 1], [rolls[index] for index in [0, 2, 4, 5, 6, 7]], [0, 2, 4, 5, 6, 7])
+
+    def test_array_keep_matches_list_keep(self):
+        numpy = pytest.importorskip("numpy")
+        rolls = [6, 2, 2, 5, 1, 6, 3, 4, 1, 6]
+        for number in range(len(rolls) + 1):
+            for highest in (True, False):
+                kept, _, indices = shuntingyard.dicebackends.ArrayDice().keep(numpy.array(rolls), number, highest)
+                expected, _, _ = shuntingyard.dicebackends.LIST_DICE.keep(rolls, number, highest)
+                assert sorted(kept) == sorted(expected) and len(indices) == len(rolls) - number
+
+    def test_repeated_keep(self):
+        result = tested("10d6dl2kh3").result
+        assert len(result.rolls[0]) == 3 and len(result.dropped_rolls[0]) == 7
+
+    def test_counted_dice(self):
+        result = tested("100000d6").result
+        assert isinstance(result.rolls[0], shuntingyard.dicebackends.FaceCounts)
+        assert len(result.rolls[0]) == 100000 and float(result) == sum(result.rolls[0])
+        assert set(result.rolls[0].counts) <= set(range(1, 7))
+
+    @pytest.mark.parametrize("expression", ["100000d6dl50000", "100000d6kl10", "100000d6r<3", "100000d6ro1",
+                                            "100000d6!", "100000d6!!", "100000d6!!>4", "200000dF!"])
+    def test_counted_dice_modifiers(self, expression):
+        result = tested(expression).result
+        assert float(result) == result.rolls[0].total()
+        if "k" in expression or "dl" in expression:
+            assert len(result.rolls[0]) + len(result.dropped_rolls[0]) == 100000
+        if "r<3" in expression:
+            assert 1 not in result.rolls[0] and 2 not in result.rolls[0]
+        if expression.endswith("!") and "!!" not in expression:
+            assert len(result.rolls[0]) == len(result.additional_rolls[0]) + int(expression.split("d")[0])
+        if expression.endswith("!!"):
+            assert len(result.rolls[0]) == len(result.additional_rolls[0]) == 100000
+            assert 6 not in result.rolls[0]
+
+    def test_counted_keep(self):
+        rolls = shuntingyard.dicebackends.FaceCounts({1: 5, 3: 2, 6: 4})
+        kept, dropped, _ = shuntingyard.dicebackends.COUNTED_DICE.keep(rolls, 5, highest=True)
+        assert kept.counts == {6: 4, 3: 1} and dropped.counts == {3: 1, 1: 5}
+
+    def test_counted_dice_without_numpy(self, monkeypatch):
+        monkeypatch.setattr(shuntingyard.dicebackends, "numpy", None)
+        result = tested("20000d4r1").result
+        assert len(result.rolls[0]) == 20000 and 1 not in result.rolls[0]
+
+    @pytest.mark.parametrize("expression, exception", [("1d6r<7", shuntingyard.RerollValueError),
+                                                       ("1d(1d6)r1", shuntingyard.RerollValueError),
+                                                       ("2d1!", shuntingyard.ExplodeValueError),
+                                                       ("1d2!>0", shuntingyard.ExplodeValueError),
+                                                       ("3d6!!<7", shuntingyard.ExplodeValueError),
+                                                       ("100000000d100000000", shuntingyard.RollTooLarge),
+                                                       ("100000d1000!>1", shuntingyard.RollTooLarge)])
+    def test_cost_rejects_runaway_rolls(self, expression, exception):
+        with pytest.raises(exception):
+            tested(expression)
+
+    def test_cost_estimate(self):
+        assert shuntingyard.compile_expression("4d6kh3+2").cost.dice == 4
+        assert shuntingyard.compile_expression("2+3").cost.dice == 0
+        assert shuntingyard.compile_expression("10d6ro<7").cost.draws == 20
+        # Pools kept as face counts hold one entry per face, however many dice they have
+        assert shuntingyard.compile_expression("100000000d6").cost.dice == 6
+        assert tested("1d6ro<7").result.sum in range(1, 7)
+
+    @pytest.mark.parametrize("expression", ["4d6kh3+1d20", "100d6!", "20d10r<3", "1000d6dl10", "100000d6"])
+    def test_seeded_rolls_replay(self, expression):
+        first = shuntingyard.ExpressionEvaluation(expression, seed=1234)
+        replayed = shuntingyard.ExpressionEvaluation(expression, seed=1234)
+        assert first.result.sum == replayed.result.sum
+        assert [list(group) for group in first.result.rolls] == [list(group) for group in replayed.result.rolls]
+        assert shuntingyard.evaluate_batch("3#4d6; 1d20", seed=5) == shuntingyard.evaluate_batch("3#4d6; 1d20", seed=5)
+
+    @pytest.mark.parametrize("number, low, high", [(5, 1, 6), (10000, 1, 6), (10000, -1, 1), (5000, 1, 1000), (100, 1, 1)])
+    def test_bulk_draws(self, number, low, high):
+        rolls = dicebackends.RandomSource(7).randints(number, low, high)
+        assert len(rolls) == number and min(rolls) >= low and max(rolls) <= high
+        if number >= 10000:
+            counts = [rolls.count(face) for face in range(low, high + 1)]
+            assert max(counts) - min(counts) < number / (high - low + 1) * 0.2
+
+    def test_rolls_share_a_log(self):
+        result = tested("(20d6 + 10d4dl2) * 2 + 1d8").result
+        assert not hasattr(result, "__dict__")
+        assert [len(group) for group in result.rolls] == [20, 8, 1] and len(result.dropped_rolls[1]) == 2
+        assert float(result) == (sum(result.rolls[0]) + sum(result.rolls[1])) * 2 + sum(result.rolls[2])
+        # Finished groups of 8 or more dice are packed into one array shared by the whole evaluation
+        assert len(result._group.log.values) == 20 + 8 + 2 + 2
+        assert pickle.loads(pickle.dumps(result)).rolls == result.rolls
+
+    def test_split_batch(self):
+        assert shuntingyard.split_batch("10#1d20+3") == [("1d20+3", 10)]
+        assert shuntingyard.split_batch("2 # 1d6; 1d8 ;") == [("1d6", 2), ("1d8", 1)]
+        assert shuntingyard.is_batch("3#1d6") and shuntingyard.is_batch("1;2") and not shuntingyard.is_batch("1d6")
+        for query in ["0#1d6", "101#1", "60#1;60#2"]:
+            with pytest.raises(shuntingyard.BatchValueError):
+                shuntingyard.split_batch(query)
+
+    def test_batch_compiles_once(self):
+        shuntingyard.PROGRAM_CACHE.clear()
+        evaluation = shuntingyard.ExpressionEvaluation("1d20+3", times=50)
+        assert len(evaluation.results) == 50 and evaluation.result is evaluation.results[0]
+        assert all(4 <= float(result) <= 23 for result in evaluation.results)
+        assert shuntingyard.PROGRAM_CACHE.info().misses == 1
+        assert shuntingyard.evaluate_batch("3#2+2; 1d1") == [("2+2", [4.0, 4.0, 4.0]), ("1d1", [1.0])]
+        # The cost of every evaluation counts against the limits
+        with pytest.raises(shuntingyard.RollTooLarge):
+            shuntingyard.evaluate_batch("100#1000000d1000000")
+
+
+class TestDistribution(object):
+    '''Test class for exact distributions of expressions'''
+    def test_keep_matches_enumeration(self):
+        import itertools
+        expected = {}
+        for rolls in itertools.product(range(1, 7), repeat=4):
+            total = sum(sorted(rolls)[1:])
+            expected[total] = expected.get(total, 0) + 1 / 6 ** 4
+        result = distribution.DistributionEvaluation("4d6dl1").result
+        assert result.pmf.keys() == expected.keys()
+        assert all(abs(result.pmf[value] - expected[value]) < 1e-12 for value in expected)
+
+    def test_keep_lowest_and_arithmetic(self):
+        assert abs(distribution.DistributionEvaluation("2d20kl1 + 5").result.mean - 12.175) < 1e-9
+
+    def test_reroll(self):
+        assert distribution.DistributionEvaluation("1d6r<3").result.pmf == pytest.approx({3: 0.25, 4: 0.25, 5: 0.25, 6: 0.25})
+        assert distribution.DistributionEvaluation("1d4ro1").result.pmf == pytest.approx({1: 1 / 16, 2: 5 / 16, 3: 5 / 16, 4: 5 / 16})
+
+    def test_exploding_dice(self):
+        assert distribution.DistributionEvaluation("1d6!").result.mean == pytest.approx(4.2)
+        assert distribution.DistributionEvaluation("3d6!!").result.mean == pytest.approx(12.6)
+
+    def test_fate_dice(self):
+        result = distribution.DistributionEvaluation("4dF").result
+        assert result.pmf[4] == pytest.approx(1 / 81) and result.mean == pytest.approx(0)
+
+    def test_keep_is_fast(self):
+        import time
+        distribution._kept_sum.cache_clear()
+        start = time.perf_counter()
+        result = distribution.DistributionEvaluation("20d20kh10").result
+        assert time.perf_counter() - start < 0.1
+        assert result.total == pytest.approx(1)
+
+    def test_errors(self):
+        with pytest.raises(shuntingyard.RollModifierMisuse):
+            distribution.DistributionEvaluation("(3d6+2)k2")
+        with pytest.raises(shuntingyard.RerollValueError):
+            distribution.DistributionEvaluation("1d6r<7")
+        with pytest.raises(distribution.NoClosedForm):
+            distribution.DistributionEvaluation("4d6!kh2")
+
+    def test_describe(self):
+        text = distribution.describe(distribution.DistributionEvaluation("2d6").result)
+        assert text.splitlines()[0] == "mean 7, stddev 2.415"
+        assert "50%: 7" in text
+
+
+class TestSimulation(object):
+    '''Test class for Monte Carlo simulations of expressions'''
+    @pytest.mark.parametrize("expression", ["4d6dl1", "2d20kh1+5", "3d6r1", "1d6!", "3d6!!", "8dF", "floor(3d6/2)"])
+    def test_matches_distribution(self, expression):
+        pytest.importorskip("numpy")
+        result = simulation.SimulationEvaluation(expression, trials=50000, seed=7)
+        assert abs(result.mean - distribution.DistributionEvaluation(expression).result.mean) < 5 * result.stderr
+
+    def test_keep_after_explode(self):
+        pytest.importorskip("numpy")
+        result = simulation.SimulationEvaluation("4d6!kh2", trials=20000, seed=7)
+        assert result.complete and result.distribution().percentile(0) >= 2
+
+    def test_budget_and_deadline(self):
+        result = simulation.SimulationEvaluation("1d20", trials=10 ** 6, deadline=0, seed=7)
+        assert 0 < result.trials < 10 ** 6 and not result.complete
+        assert simulation.SimulationEvaluation("1d20", trials=5, seed=7).trials == 5
+
+    def test_errors(self):
+        pytest.importorskip("numpy")
+        with pytest.raises(shuntingyard.RerollValueError):
+            simulation.SimulationEvaluation("2d6r<7", trials=10)
+        with pytest.raises(shuntingyard.RollModifierMisuse):
+            simulation.SimulationEvaluation("(2d6+1)kh1", trials=10)
+        with pytest.raises(shuntingyard.KeepValueError):
+            simulation.SimulationEvaluation("2d6kh3", trials=10)
+
+    def test_split_trials(self):
+        assert simulation.split_trials("1d20+5 1000") == ("1d20+5", 1000)
+        assert simulation.split_trials("1d20 + 5") == ("1d20 + 5", simulation.TRIALS)
+        assert simulation.describe_query("2d1 10")[0] == "2d1"
+
+    def test_batch_memory(self, monkeypatch):
+        pytest.importorskip("numpy")
+        # Batches of large pools hold fewer trials, so their dice fit in BATCH_MEMORY
+        assert simulation.batch_size(shuntingyard.compile_expression("1d20")) == simulation.BATCH_SIZE
+        size = simulation.batch_size(shuntingyard.compile_expression("3000d6"))
+        assert 1 < size < simulation.BATCH_SIZE and size * 3000 * simulation.DIE_BYTES <= simulation.BATCH_MEMORY
+        monkeypatch.setattr(simulation, "BATCH_MEMORY", 100 * simulation.DIE_BYTES)
+        result = simulation.SimulationEvaluation("60d6kh30", trials=10, seed=7)
+        assert result.complete and result.trials == 10
+        with pytest.raises(simulation.SimulationError):
+            simulation.SimulationEvaluation("101d6", trials=10)
+        with pytest.raises(shuntingyard.RollTooLarge):
+            simulation.SimulationEvaluation("20000000d100000000", trials=10)
+
+
+def _allocate(size):
+    return len(bytearray(size))
+
+
+def _current_trace():
+    return tracing.current()
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class TestEvaluatorPool(object):
+    '''Test class for the pooled, bounded evaluator'''
+    @pytest.fixture
+    def pool(self):
+        pool = timeout.EvaluatorPool(workers=1, max_queue=0)
+        yield pool
+        pool.close()
+
+    def test_evaluate(self, pool):
+        assert float(pool.evaluate(5, shuntingyard.evaluate, "2+3*4")) == 14
+        assert pool.evaluate(5, shuntingyard.evaluate, "3d1").rolls == [[1, 1, 1]]
+        assert pool.stats().completed == 2 and pool.stats().recycled == 0
+
+    def test_timeout_recycles_worker(self, pool):
+        with pytest.raises(timeout.TimeoutException):
+            pool.evaluate(0.5, _sleep, 60)
+        stats = pool.stats()
+        assert stats.timeouts == 1 and stats.recycled == 1 and stats.busy == 0
+        assert float(pool.evaluate(5, shuntingyard.evaluate, "1+1")) == 2
+
+    def test_unpicklable_arguments(self, pool):
+        for attempt in range(3):
+            with pytest.raises(Exception):
+                pool.evaluate(5, _sleep, lambda: 0)
+        # The only worker is replaced every time instead of being lost to the pool
+        stats = pool.stats()
+        assert stats.busy == 0 and stats.recycled == 3
+        assert float(pool.evaluate(5, shuntingyard.evaluate, "1+1")) == 2
+
+    def test_exceptions_propagate(self, pool):
+        with pytest.raises(shuntingyard.MismatchedBrackets):
+            pool.evaluate(5, shuntingyard.evaluate, "(1+2")
+        assert pool.stats().failed == 1 and pool.stats().recycled == 0
+
+    def test_backpressure(self, pool):
+        worker = pool._acquire(1)
+        with pytest.raises(timeout.PoolBusy):
+            pool.evaluate(1, shuntingyard.evaluate, "1")
+        pool._release(worker)
+        assert pool.stats().rejected == 1
+        assert float(pool.evaluate(5, shuntingyard.evaluate, "1")) == 1
+
+    def test_trace_reaches_worker(self, pool):
+        with tracing.request("abcd", sample_rate=1):
+            assert pool.evaluate(5, _current_trace) == ("abcd", True)
+
+    def test_memory_limit(self):
+        pytest.importorskip("resource")
+        pool = timeout.EvaluatorPool(workers=1, memory_limit=1 << 30)
+        try:
+            with pytest.raises((MemoryError, timeout.WorkerCrashed)):
+                pool.evaluate(5, _allocate, 1 << 31)
+            assert pool.evaluate(5, _allocate, 1 << 20) == 1 << 20
+        finally:
+            pool.close()
+
+
+class SlowEvaluator(object):
+    '''Evaluates in the calling thread, taking a while for expressions that roll a d1'''
+    def evaluate(self, seconds, function, *args):
+        if "d1" in args[0]:
+            time.sleep(0.3)
+        return function(*args)
+
+
+class TestBot(object):
+    '''Test class for the asynchronous bot core, run against a fake Telegram API'''
+    @pytest.fixture
+    def fake(self):
+        with fakeapi.FakeTelegram() as fake:
+            yield fake
+
+    @pytest.fixture(autouse=True)
+    def audit_directory(self, tmp_path):
+        self.audit_directory = str(tmp_path / "audit")
+        return self.audit_directory
+
+    def _bot(self, fake, evaluator=None, **outbox):
+        api = telegram.TelegramAPI("TOKEN", base_url=fake.url, poll_timeout=1)
+        # Replies are only coalesced and rate limited where a test asks for it, so the others check them one by one
+        outbox = sendqueue.Outbox(api, **{"coalesce": False, "chat_rate": None, "backoff": 0.01, **outbox})
+        return dXRollBot.dXRollBot("TOKEN", api=api, evaluator=evaluator or SlowEvaluator(), outbox=outbox,
+                                   macro_store=macros.MacroStore(":memory:"),
+                                   audit_log=auditlog.AuditLog(self.audit_directory))
+
+    def _message(self, chat_id, text):
+        return {"message_id": 1, "text": text, "chat": {"id": chat_id, "type": "private"}}
+
+    def test_glance(self):
+        assert telegram.glance(self._message(5, "/r 1")) == ("text", "private", 5)
+
+    def test_commands(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            for text in ["/r 2+3", "/r (1", "/foo", "/help"]:
+                bot.dispatch(self._message(1, text))
+            await bot.join()
+        asyncio.run(handle())
+        texts = [message["text"] for message in fake.sent]
+        assert texts[:3] == ["```\n2+3 = 5```",
+                             "Error: There was a mismatched bracket in the expression: '(' at position 1 is never closed",
+                             'Unrecognized command: "foo"']
+        assert "/help" in texts[3]
+
+    def test_batch_roll(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            for text in ["/r 3#2*2; 1d1", "/r 0#1d6"]:
+                bot.dispatch(self._message(1, text))
+            await bot.join()
+        asyncio.run(handle())
+        assert [message["text"] for message in fake.sent] == ["```\n2*2 = 4, 4, 4\n1d1 = 1```",
+                                                              "Error: The number of rolls must be positive, got 0"]
+
+    def test_stats_errors(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            for text in ["/stats 1d0", "/stats 1d0+1"]:
+                bot.dispatch(self._message(1, text))
+            await bot.join()
+        asyncio.run(handle())
+        assert [message["text"] for message in fake.sent] == ["Error: Cannot roll dice with 0 sides"] * 2
+
+    def test_batch_roll_pages(self):
+        long_expression = "+".join(["1"] * 500)
+        pages = dXRollBot.render_batch([(long_expression, [500.0])] * 10)
+        assert len(pages) == 3 and all(len(f"```\n{page}```") <= dXRollBot.MESSAGE_LIMIT for page in pages)
+        # Too many results for MAX_PAGES messages are summarized
+        pages = dXRollBot.render_batch([("1d20", [float(i) for i in range(100000)])])
+        assert pages == ["1d20: 100000 rolls, total 4999950000, lowest 0, highest 99999"]
+
+    def _post(self, url, body, secret_token="SECRET"):
+        request = urllib.request.Request(url, data=body, headers={webhook.SECRET_HEADER: secret_token})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_webhook(self, fake):
+        async def handle():
+            server = await webhook.WebhookServer("SECRET", max_pending=2).start()
+            post = functools.partial(asyncio.get_running_loop().run_in_executor, None, self._post, server.url)
+            update = {"update_id": 1, "message": self._message(1, "/r 1+1")}
+            statuses = [await post(json.dumps(update).encode(), "WRONG"), await post(b"{"),
+                        await post(json.dumps(update).encode()), await post(json.dumps(update).encode()),
+                        await post(json.dumps(update).encode())]
+            bot = self._bot(fake)
+            polling = asyncio.create_task(bot.run(server.updates()))
+            await asyncio.sleep(0.1)
+            await bot.join()
+            polling.cancel()
+            server.stop()
+            return statuses
+        # The queue holds two updates, the third has to be posted again later
+        assert asyncio.run(handle()) == [401, 400, 200, 200, 503]
+        assert [message["text"] for message in fake.sent] == ["```\n1+1 = 2```"] * 2
+
+    def test_sharded_webhook(self, fake):
+        async def handle():
+            server = await webhook.WebhookServer("SECRET").start()
+            dispatcher = webhook.ShardedDispatcher(dXRollBot.dXRollBot, "TOKEN", 2, base_url=fake.url,
+                                                   audit_directory=self.audit_directory)
+            running = asyncio.create_task(dispatcher.run(server.updates()))
+            for i in range(10):
+                fake.send_text(i % 3 + 1, f"/r {i}")
+            await asyncio.get_running_loop().run_in_executor(None, fake.post_updates, server.url, "SECRET")
+            running.cancel()
+            dispatcher.close()
+            server.stop()
+        asyncio.run(handle())
+        # The workers' outboxes coalesce replies like the bot's own does
+        replies = [(message["chat"]["id"], int(number)) for message in fake.sent
+                   for number in re.findall(r"(\d+) =", message["text"])]
+        for chat_id in (1, 2, 3):
+            assert [number for chat, number in replies if chat == chat_id] == list(range(chat_id - 1, 10, 3))
+
+    def test_macros(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            for text in ["/save atk 1d1 + 7", "/r $atk", "/r $nope", "/save dmg 2d", "/save 9x 1", "/save"]:
+                bot.dispatch(self._message(1, text))
+            await bot.join()
+        asyncio.run(handle())
+        assert [message["text"] for message in fake.sent] == [
+            "Saved `$atk`: `1d1 + 7`", "```\n1d1 + 7 = 8\nRolls: 1```", "Error: There is no macro named `$nope`",
+            "Error: There was an unknown symbol or function in the expression: '2d' at position 1",
+            'Error: "9x" can\'t be the name of a macro, use up to 32 letters, digits and _',
+            "Usage: /save name expression. Macros of this chat: `$atk`"]
+
+    def test_history(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            for text in ["/history", "/r 2+3", "/r 2#4", "/r 7", "/history 2", "/history me", "/history 0"]:
+                message = self._message(1, text)
+                message["from"] = {"id": 42}
+                bot.dispatch(message)
+            await bot.join()
+            bot.audit.close()
+        asyncio.run(handle())
+        texts = [message["text"] for message in fake.sent]
+        assert texts[0] == "Nothing has been rolled in this chat yet"
+        assert re.fullmatch(r"```\n\S+ \S+ user 42: 2#4 = batch \(seed \d+\)\n\S+ \S+ user 42: 7 = 7 \(seed \d+\)```", texts[4])
+        assert texts[5:] == ["```\n2 rolls, average 6, lowest 5, highest 7```", "Usage: /history [1-50] or /history me"]
+
+    def test_inline_queries(self, fake):
+        async def poll():
+            bot = self._bot(fake)
+            polling = asyncio.create_task(bot.run())
+            # Every keystroke is a query, only the last one of a user is answered
+            for query in ["1", "1d", "1d2", "1d20", "1d20 + 5"]:
+                fake.send_inline_query(7, query)
+            fake.send_inline_query(8, "1d20+(")
+            await asyncio.get_running_loop().run_in_executor(None, fake.wait_for, 2, 10, "answers")
+            inline_message_id = fake.choose_inline_result(7, "1d1 + 5")
+            await asyncio.get_running_loop().run_in_executor(None, fake.wait_for, 1, 10, "edits")
+            polling.cancel()
+            return inline_message_id, bot.audit.history(dXRollBot.INLINE_CHAT, 5)
+        inline_message_id, rolls = asyncio.run(poll())
+        answers = {answer["inline_query_id"]: answer for answer in fake.answers}
+        assert sorted(answers) == ["5", "6"] and not fake.sent
+        result, = answers["5"]["results"]
+        assert (result["title"], result["description"]) == ("Roll 1d20 + 5", "From 6 to 25")
+        assert answers["6"]["results"] == [] and answers["6"]["button"]["text"] == "'(' at position 6 is never closed"
+        edit, = fake.edits
+        assert (edit["text"], edit["inline_message_id"]) == ("```\n1d1 + 5 = 6\nRolls: 1```", inline_message_id)
+        assert [(roll.user_id, roll.expression, roll.result) for roll in rolls] == [(7, "1d1 + 5", 6.0)]
+
+    def test_inline_latency_budget(self, fake, monkeypatch):
+        monkeypatch.setattr(dXRollBot, "INLINE_DEBOUNCE", 0)
+        monkeypatch.setattr(dXRollBot, "INLINE_TIMEOUT", 0.05)
+
+        async def handle():
+            bot = self._bot(fake)
+            monkeypatch.setattr(bot.previewer, "preview", lambda query: time.sleep(0.2))
+            bot.handle({"update_id": 1, "inline_query": {"id": "1", "from": {"id": 7}, "query": "2d6", "offset": ""}})
+            await bot.join()
+        asyncio.run(handle())
+        # The preview took too long, the result is offered unchecked
+        assert fake.answers[0]["results"][0]["description"] == inline.UNCHECKED
+
+    def test_render_roll(self):
+        text, result = rendering.render_roll("4d6kh3+2d6!", seed=1, hint="\nhint")
+        assert text.startswith("```\n4d6kh3+2d6! = ") and "\nRolls: " in text and "\nDropped: " in text
+        # A pool too large for a message is cut short and counted by face instead
+        text, result = rendering.render_roll("20000d6kh19000", seed=1, hint="\nhint")
+        assert len(text) <= dXRollBot.MESSAGE_LIMIT and text.endswith("; 1000 dropped\nhint```")
+        assert re.search(r" …\n19000 dice: 1×\d+, 2×\d+, 3×\d+, 4×\d+, 5×\d+, 6×\d+;", text)
+
+    @pytest.mark.parametrize("count_threshold, array_threshold", [(0, 0), (float("inf"), 0),
+                                                                  (float("inf"), float("inf"))])
+    def test_render_large_pools(self, monkeypatch, count_threshold, array_threshold):
+        if count_threshold > array_threshold:
+            pytest.importorskip("numpy")
+        monkeypatch.setattr(shuntingyard.dicebackends, "COUNT_THRESHOLD", count_threshold)
+        monkeypatch.setattr(shuntingyard.dicebackends, "ARRAY_THRESHOLD", array_threshold)
+        result = shuntingyard.evaluate("3000d6!", seed=1)
+        # Summarized from the counts of the faces, the same for every backend
+        faces = collections.Counter(roll for group in result.rolls for roll in group)
+        expected = ", ".join(f"{face}×{count}" for face, count in sorted(faces.items()))
+        assert rendering.summarize(result).startswith(f"{sum(faces.values())} dice: {expected}; ")
+        document = rendering.render_log("3000d6!", seed=1, limit=1000).decode()
+        assert len(document) < 1000 + rendering.SUMMARY_LIMIT * 2 and "\nRolls: " in document
+        assert document.endswith(f"All of them: {rendering.summarize(result)}\n")
+
+    def test_chats_are_concurrent_and_ordered(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            bot.dispatch(self._message(1, "/r 1d1+0"))
+            bot.dispatch(self._message(1, "/r 1+1"))
+            bot.dispatch(self._message(2, "/r 2+2"))
+            await bot.join()
+        asyncio.run(handle())
+        assert [(message["chat"]["id"], message["text"]) for message in fake.sent] == [
+            (2, "```\n2+2 = 4```"), (1, "```\n1d1+0 = 1\nRolls: 1```"), (1, "```\n1+1 = 2```")]
+
+    def test_chat_queue_is_capped(self, fake, monkeypatch):
+        monkeypatch.setattr(dXRollBot, "MAX_CHAT_QUEUE", 2)
+        async def handle():
+            bot = self._bot(fake)
+            for i in range(4):
+                bot.dispatch(self._message(1, f"/r {i}"))
+            bot.dispatch(self._message(2, "/r 9"))
+            await bot.join()
+            bot.dispatch(self._message(1, "/r 5"))
+            await bot.join()
+        dropped = dXRollBot.DROPPED_MESSAGES.value()
+        asyncio.run(handle())
+        assert sorted(message["text"] for message in fake.sent) == ["```\n0 = 0```", "```\n1 = 1```", "```\n5 = 5```",
+                                                                   "```\n9 = 9```"]
+        assert dXRollBot.DROPPED_MESSAGES.value() - dropped == (2 if metrics.ENABLED else 0)
+
+    def test_roll_log(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            for text in ["/log", "/r 3d1!<1", "/log"]:
+                bot.dispatch(self._message(1, text))
+            await bot.join()
+        asyncio.run(handle())
+        assert [message.get("text", message.get("caption")) for message in fake.sent] == [
+            "Error: There is no roll to send the log of", "```\n3d1!<1 = 3\nRolls: 1, 1, 1```", "Rolls of 3d1!<1"]
+        chat_id, filename, data = fake.documents[0]
+        assert chat_id == 1 and filename.startswith("rolls-") and filename.endswith(".txt")
+        assert data.decode().startswith("3d1!<1 = 3\nSeed: ") and "\nRolls: 1, 1, 1\n" in data.decode()
+
+    def test_replies_are_coalesced(self, fake):
+        async def handle():
+            bot = self._bot(fake, coalesce=True)
+            bot.outbox.buckets[1] = sendqueue.TokenBucket(5, burst=1)
+            for text in ["/r 1", "/r 2", "/r 3"]:
+                bot.dispatch(self._message(1, text))
+            await bot.join()
+        asyncio.run(handle())
+        assert [message["text"] for message in fake.sent] == ["```\n1 = 1```", "```\n2 = 2```\n```\n3 = 3```"]
+
+    def test_flood_control_is_retried(self, fake):
+        async def handle():
+            bot = self._bot(fake)
+            fake.fail(retry_after=0.2)
+            fake.fail(error_code=502, retry_after=None)
+            bot.dispatch(self._message(1, "/r 1+1"))
+            start = time.monotonic()
+            await bot.join()
+            return time.monotonic() - start
+        assert asyncio.run(handle()) >= 0.2
+        assert [message["text"] for message in fake.sent] == ["```\n1+1 = 2```"]
+
+    def test_outbox_backpressure(self, fake):
+        async def handle():
+            api = telegram.TelegramAPI("TOKEN", base_url=fake.url)
+            outbox = sendqueue.Outbox(api, chat_rate=None, max_pending=2)
+            queued = [await outbox.send(1, "a"), await outbox.send(2, "b"), await outbox.send(3, "c", wait=False)]
+            # Waits for room instead of dropping
+            queued.append(await outbox.send(4, "d"))
+            await outbox.join()
+            return queued, outbox.pending
+        assert asyncio.run(handle()) == ([True, True, False, True], 0)
+        assert sorted(message["text"] for message in fake.sent) == ["a", "b", "d"]
+
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = sendqueue.TokenBucket(2, burst=2, clock=lambda: now[0])
+        for _ in range(2):
+            assert bucket.delay() == 0
+            bucket.take()
+        assert bucket.delay() == pytest.approx(0.5)
+        now[0] = 2.0
+        assert bucket.idle()
+
+    def test_polling(self, fake):
+        async def poll():
+            bot = self._bot(fake)
+            polling = asyncio.get_running_loop().create_task(bot.run())
+            fake.send_text(1, "/r 1+2")
+            fake.send_text(2, "/roll 3*4")
+            while len(fake.sent) < 2:
+                await asyncio.sleep(0.01)
+            polling.cancel()
+        asyncio.run(poll())
+        assert sorted(message["text"] for message in fake.sent) == ["```\n1+2 = 3```", "```\n3*4 = 12```"]
+        assert not fake.updates or fake.updates[0]["update_id"] > 2
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestTracing(object):
+    '''Test class for lazy debug tracing and queued log output'''
+    @pytest.fixture
+    def records(self):
+        logger, handler = logging.getLogger("shuntingyard"), ListHandler()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        yield handler.records
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    def test_short(self):
+        assert str(tracing.Short([[1, 2], [3]])) == "[[1, 2], [3]]"
+        text = str(tracing.Short([list(range(10 ** 5))]))
+        assert len(text) < 200 and "..." in text
+
+    def test_level_gated(self, records):
+        tested("4d6kh3")
+        assert not records
+
+    def test_sampled_request(self, records):
+        with tracing.request("abcd", sample_rate=1) as trace_id:
+            tested("4d6kh3")
+        assert trace_id == "abcd" and records and all(record.levelno == logging.DEBUG for record in records)
+        records.clear()
+        with tracing.request(sample_rate=0):
+            tested("4d6kh3")
+        assert not records
+
+    def test_configure(self):
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        stream = io.StringIO()
+        try:
+            tracing.configure(logging.INFO, stream=stream)
+            with tracing.request("abcd"):
+                logging.getLogger("test").info("queued")
+        finally:
+            tracing._stop_listener()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            for handler in handlers:
+                root.addHandler(handler)
+            root.setLevel(level)
+        assert "[abcd] queued" in stream.getvalue()
+
+
+class TestMetrics(object):
+    '''Test class for the metrics registry and the instrumented evaluator'''
+    @pytest.fixture
+    def enabled(self):
+        metrics.REGISTRY.drain()
+        metrics.enable()
+        yield metrics.REGISTRY
+        metrics.enable(False)
+        metrics.REGISTRY.drain()
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = metrics.counter("test_total", "Test counter", ["kind"], registry=registry)
+        histogram = metrics.histogram("test_seconds", "Test histogram", buckets=(0.1, 1), registry=registry)
+        counter.inc('a"b', amount=2)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        text = registry.render()
+        assert '# TYPE test_total counter\ntest_total{kind="a\\"b"} 2\n' in text
+        assert 'test_seconds_bucket{le="0.1"} 1\ntest_seconds_bucket{le="1"} 2\ntest_seconds_bucket{le="+Inf"} 3' in text
+        assert "test_seconds_sum 5.55\ntest_seconds_count 3" in text
+
+    def test_disabled(self):
+        metrics.REGISTRY.drain()
+        tested("4d6kh3")
+        assert metrics.REGISTRY.drain() == {}
+
+    def test_evaluation(self, enabled):
+        tested("4d6kh3+1d4")
+        assert shuntingyard.DICE_ROLLED.value("list") == 5
+        assert shuntingyard.PHASE_SECONDS.count("execute") == 1
+        assert shuntingyard.OPERATOR_SECONDS.count("d") == 2 and shuntingyard.OPERATOR_SECONDS.count("kh") == 1
+
+    def test_worker_metrics_are_merged(self, enabled):
+        pool = timeout.EvaluatorPool(workers=1)
+        try:
+            pool.evaluate(5, shuntingyard.evaluate, "3d6")
+            pool.evaluate(5, shuntingyard.evaluate, "2d6")
+        finally:
+            pool.close()
+        assert shuntingyard.DICE_ROLLED.value("list") == 5
+
+    def test_bot_and_endpoint(self, enabled, tmp_path):
+        async def handle(fake):
+            bot = dXRollBot.dXRollBot("TOKEN", api=telegram.TelegramAPI("TOKEN", base_url=fake.url), evaluator=SlowEvaluator(),
+                                      audit_log=auditlog.AuditLog(str(tmp_path)))
+            for text in ["/r 1+1", "/r (1"]:
+                bot.dispatch({"message_id": 1, "text": text, "chat": {"id": 1, "type": "private"}})
+            await bot.join()
+        with fakeapi.FakeTelegram() as fake:
+            asyncio.run(handle(fake))
+        assert dXRollBot.COMMAND_SECONDS.count("r") == 2
+        assert sendqueue.SEND_SECONDS.count() == sendqueue.REPLIES.value("sent")
+        assert sendqueue.REPLIES.value("sent") + sendqueue.REPLIES.value("coalesced") == 2
+        assert dXRollBot.ERRORS.value("MismatchedBrackets") == 1
+        server = metrics.serve(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                text = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert 'dxroll_errors_total{exception="MismatchedBrackets"} 1' in text
+        assert 'dxroll_messages_total{content_type="text"} 2' in text
+
+
+class TestBenchmarks(object):
+    '''Test class for the benchmark suite tooling'''
+    def test_compare(self):
+        results, baseline = {"a": 1.3, "b": 1.2, "c": 5.0}, {"a": 1.0, "b": 1.0}
+        assert benchmarks.compare(results, baseline, threshold=0.25) == [("a", 1.0, 1.3)]
+
+    def test_seeded_rolls(self):
+        benchmarks.seed()
+        first = [tested("10d6").result.rolls, tested("1000d6").result.sum]
+        benchmarks.seed()
+        assert [tested("10d6").result.rolls, tested("1000d6").result.sum] == first
+
+
+class TestMacros(object):
+    '''Test class for the macro store'''
+    def test_saved_programs_are_not_parsed_again(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "macros.sqlite3")
+        store = macros.MacroStore(path)
+        store.save(1, "stat", "4d6 dl1", macros.compile_macro("4d6 dl1"))
+        store.save(2, "stat", "3d6", macros.compile_macro("3d6"))
+        store.close()
+        store = macros.MacroStore(path)
+        monkeypatch.setattr(shuntingyard.GRAMMAR, "tokenize", None)
+        expression, program = store.get(1, "stat")
+        assert expression == "4d6 dl1" and store.names(2) == ["stat"]
+        assert shuntingyard.evaluate(expression, 5, program).sum == shuntingyard.evaluate("4d6dl1", 5).sum
+        with pytest.raises(macros.MacroError):
+            store.get(1, "nope")
+
+    def test_limits(self, monkeypatch):
+        store = macros.MacroStore(":memory:")
+        monkeypatch.setattr(macros, "MAX_MACROS", 2)
+        for name in ["a", "b", "a"]:
+            store.save(1, name, "1", macros.compile_macro("1"))
+        with pytest.raises(macros.MacroError):
+            store.save(1, "c", "1", macros.compile_macro("1"))
+        with pytest.raises(macros.MacroError):
+            store.save(1, "a-b", "1", macros.compile_macro("1"))
+        with pytest.raises(shuntingyard.RollTooLarge):
+            macros.compile_macro("100000d1000!>1")
+
+
+class TestInline(object):
+    '''Test class for the previews of inline queries'''
+    @pytest.mark.parametrize("expression", ["4d6kh3 + 2d%5-(-3)", "floor(2d20!!>5/3)*d%", "10d6ro<3+ceil(1.5)**2"])
+    def test_resumed_tokens_match(self, expression):
+        previewer = inline.Previewer()
+        for end in range(1, len(expression) + 1):
+            query = expression[:end]
+            try:
+                expected = shuntingyard.GRAMMAR.tokenize(shuntingyard.GRAMMAR.compact(query), query)
+            except shuntingyard.UnknownSymbol as exc:
+                with pytest.raises(shuntingyard.UnknownSymbol, match=re.escape(str(exc))):
+                    previewer.tokenize(shuntingyard.GRAMMAR.compact(query), query)
+            else:
+                assert list(previewer.tokenize(shuntingyard.GRAMMAR.compact(query), query)) == expected
+
+    def test_previews(self, monkeypatch):
+        previewer = inline.Previewer(maxsize=2)
+        monkeypatch.setattr(shuntingyard.Program, "execute", None)
+        assert previewer.preview(" 2+3 ") == inline.Preview("2+3", True, "Always 5")
+        assert previewer.preview("3dF-2") == inline.Preview("3dF-2", True, "From -5 to 1")
+        assert previewer.preview("") == inline.Preview("", False, "Type a formula to roll, e.g. 2d6+3")
+        # Brackets with nothing in them yet, as while typing "(1d6+2)*3"
+        for query in ["()", "(())"]:
+            assert previewer.preview(query) == inline.Preview(query, False, "Type a formula to roll, e.g. 2d6+3")
+        assert previewer.preview("2d") == inline.Preview("2d", False, "Unknown symbol '2d' at position 1")
+        assert not previewer.preview("3#1d6").valid and not previewer.preview("100000d1000!>1").valid
+        assert len(previewer) == 2
+
+
+class TestLibrary(object):
+    '''Test class for the importable API and the batch command line'''
+    def test_import_has_no_side_effects(self):
+        code = ("import sys, logging, threading, dxroll\n"
+                "loaded = [name for name in sys.modules if name.startswith(('numpy.', 'http', 'distribution', 'dXRollBot'))]\n"
+                "print(loaded, logging.getLogger().handlers, threading.active_count())")
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        assert output == "[] [] 1\n"
+
+    def test_api(self):
+        assert dxroll.roll("2+3") == 5 and float(dxroll.roll("4d6kh3", seed=9)) == float(dxroll.roll("4d6kh3", seed=9))
+        assert len(dxroll.roll_many("1d6", 10)) == 10 and dxroll.roll_batch("2#1") == [("1", [1.0, 1.0])]
+        assert dxroll.distribution_of("1d6").mean == pytest.approx(3.5)
+        assert dxroll.simulate("1d6", trials=1000, seed=1).trials == 1000
+
+    def test_batch_keeps_order(self):
+        lines = ["1d20+5", "", "2d", "2#1d6", "1e308*10"] + [f"{i}+1d1" for i in range(20)]
+        records = list(dxroll.evaluate_lines(iter(lines), workers=2, chunk_size=3, seed=7))
+        assert records == list(dxroll.evaluate_lines(lines, workers=0, seed=7))
+        assert [record["line"] for record in records] == [1] + list(range(3, 26))
+        assert records[1]["error"] == "UnknownSymbol: '2d' at position 1" and records[2]["seed"] == 11
+        assert records[3]["error"] == "OverflowError: The result is not a finite number"
+        assert [record["result"] for record in records[4:]] == list(range(1, 21))
+        assert records[0]["result"] == float(dxroll.roll("1d20+5", seed=8))
+
+    def test_batch_line_errors(self, monkeypatch):
+        records = list(dxroll.evaluate_lines(["1d6d6", "()", "2d1"], workers=0, seed=1))
+        assert [record.get("error", "").partition(":")[0] for record in records] == ["TypeError", "EmptyExpression", ""]
+        assert records[2]["result"] == 2
+        if not hasattr(signal, "setitimer"):
+            return
+        handler, evaluate = signal.getsignal(signal.SIGALRM), shuntingyard.evaluate
+        monkeypatch.setattr(shuntingyard, "evaluate", lambda expression, seed: (
+            time.sleep(5) if expression == "slow" else evaluate(expression, seed)))
+        records = list(dxroll.evaluate_lines(["slow", "1+1"], workers=0, seconds=0.1))
+        assert records[0]["error"] == "TimeoutException: Timed out after 0.1 seconds" and records[1]["result"] == 2
+        assert signal.getsignal(signal.SIGALRM) is handler
+
+    def test_cli(self):
+        output = subprocess.run([sys.executable, "dxroll.py", "--seed", "1", "--workers", "0"], input="2d1\n1+\n",
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                check=True).stdout
+        assert [json.loads(line) for line in output.splitlines()] == [
+            {"line": 1, "expression": "2d1", "seed": 2, "result": 2},
+            {"line": 2, "expression": "1+", "seed": 3, "error": "StackIsEmpty: +"}]
+
+
+class TestAuditLog(object):
+    '''Test class for the audit log of rolls'''
+    def test_history_and_stats(self, tmp_path):
+        log = auditlog.AuditLog(str(tmp_path))
+        for i in range(10):
+            log.record(i % 2, i % 3, f"1d20+{i}", i, float(i))
+        log.record(1, 1, "2#1d6", 10, math.nan)
+        assert [roll.expression for roll in log.history(1, 3)] == ["2#1d6", "1d20+9", "1d20+7"]
+        assert log.history(1, 1)[0][:2] == (1, 1) and log.history(5, 3) == []
+        # User 1 rolled 1 and 7 in chat 1, and the batch, which has no result
+        assert log.user_stats(1, 1) == auditlog.UserStats(2, 4.0, 1.0, 7.0)
+        log.close()
+        log = auditlog.AuditLog(str(tmp_path))
+        log.record(1, 1, "1", 11, 1.0)
+        assert [roll.seed for roll in log.history(1, 3)] == [11, 10, 9]
+        assert log.user_stats(1, 1).rolls == 3
+        log.close()
+
+    def test_segments_rotate(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(auditlog, "MAX_SEGMENTS", 2)
+        log = auditlog.AuditLog(str(tmp_path), segment_size=1)
+        for i in range(5):
+            log.record(1, 1, "1d6", i, 1.0)
+            log.flush()
+        assert sorted(os.listdir(tmp_path)) == ["00000004.log", "00000005.log", "index"]
+        # The older rolls went with their segments
+        assert [roll.seed for roll in log.history(1, 5)] == [4, 3]
+        log.close()
+
+    def test_index_rotates(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(auditlog, "MAX_SEGMENTS", 2)
+        log = auditlog.AuditLog(str(tmp_path), segment_size=1)
+        for i in range(6):
+            log.record(i % 2, 1, "1d6", i, float(i))
+            log.flush()
+        log.close()
+        with open(tmp_path / "index", "rb") as index:
+            # Only the rolls of the two kept segments are left in the index
+            assert auditlog.INDEX_HEADER.unpack(index.read(auditlog.INDEX_HEADER.size))[1] == 2
+        log = auditlog.AuditLog(str(tmp_path), segment_size=1)
+        assert [roll.seed for roll in log.history(1, 5)] == [5]
+        assert log.user_stats(0, 1) == auditlog.UserStats(1, 4.0, 4.0, 4.0)
+        log.record(2, 1, "1d6", 6, 6.0)
+        log.flush()
+        assert [roll.seed for roll in log.history(1, 5)] == [5]
+        assert log.history(0, 5) == [] and log.user_stats(2, 1).rolls == 1
+        log.close()
+
+
+class TestHelpTopics(object):
+    '''Test class for the indexed help file'''
+    @pytest.fixture
+    def helpfile(self, tmp_path):
+        path = tmp_path / "help.txt"
+        path.write_text("Intro line\n[roll]\nRoll `XdY`\n[reroll]\nReroll *dice*\n[keep]\nKeep dice\n")
+        return path
+
+    def test_shipped_helpfile_is_valid(self):
+        help_topics = helptopics.HelpTopics()
+        assert {"roll", "modifiers", "stats", "sim"} <= set(help_topics.topics)
+
+    def test_lookup(self, helpfile):
+        help_topics = helptopics.HelpTopics(str(helpfile))
+        assert help_topics.topics == ["roll", "reroll", "keep"]
+        assert help_topics.message("") == "Intro line\nHelp topics: `roll`, `reroll`, `keep`\n"
+        assert help_topics.message(" Roll") == "Roll `XdY`\n"
+        assert help_topics.message("ke") == "Keep dice\n"
+        assert help_topics.message("rerol") == help_topics.message("rerolll") == "Reroll *dice*\n"
+        assert help_topics.lookup("r") == ["roll", "reroll"]
+        assert help_topics.message("no_such") == 'There is no help topic "no\\_such". Help topics: `roll`, `reroll`, `keep`'
+
+    def test_markdown_validation(self):
+        helptopics.validate_markdown("`a_b` *bold* _it_ [link](http://x) \\_ ```pre*```")
+        for text in ["`code", "*bold", "snake_case", "[link]"]:
+            with pytest.raises(helptopics.MarkdownError):
+                helptopics.validate_markdown(text)
+
+    def test_reload(self, helpfile):
+        help_topics = helptopics.HelpTopics(str(helpfile), check_interval=0)
+        helpfile.write_text("Intro\n[sim]\nSimulate\n")
+        os.utime(helpfile, ns=(0, 10 ** 9))
+        assert help_topics.topics == ["sim"]
+        helpfile.write_text("Intro\n[sim]\nSimulate *unclosed\n")
+        os.utime(helpfile, ns=(0, 2 * 10 ** 9))
+        assert help_topics.message("sim") == "Simulate\n"
+        with pytest.raises(helptopics.MarkdownError):
+            helptopics.HelpTopics(str(helpfile))
@@ -1,107 +1,488 @@
-import sys
-import time
-import telepot
-import telepot.loop
 import re
+import math
+import time
+import textwrap
+import asyncio
+import secrets
+import argparse
 import logging
+import functools
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import shuntingyard
+import dicebackends
+import distribution
+import simulation
+import timeout
+import telegram
+import tracing
+import helptopics
+import metrics
+import sendqueue
+import rendering
+import webhook
+import macros
+import auditlog
+import inline
+import lazyimport
 
-# telepot.api.set_proxy("http://proxy.url")
-
-logging.basicConfig(format="%(levelname)-8s (%(asctime)s) %(message)s", level=logging.DEBUG, datefmt="%d.%m.%y, %H:%M:%S")
+logging.getLogger(__name__).addHandler(logging.NullHandler())
 logger = logging.getLogger(__name__)
 
+LOG_LEVEL = logging.INFO
+TRACE_SAMPLE_RATE = 0.0  # Share of messages whose whole evaluation is traced at DEBUG level whatever LOG_LEVEL is
+
+MESSAGES = metrics.counter("dxroll_messages_total", "Messages received", ["content_type"])
+MESSAGE_SECONDS = metrics.histogram("dxroll_message_seconds", "Time to handle a message, replies included")
+COMMAND_SECONDS = metrics.histogram("dxroll_command_seconds", "Time to handle a command, replies included", ["command"])
+ERRORS = metrics.counter("dxroll_errors_total", "Errors reported to users, by exception class", ["exception"])
+INLINE_QUERIES = metrics.counter("dxroll_inline_queries_total", "Inline queries received, by what became of them",
+                                 ["outcome"])
+DROPPED_MESSAGES = metrics.counter("dxroll_dropped_messages_total", "Messages dropped, their chat had too many waiting")
+INLINE_SECONDS = metrics.histogram("dxroll_inline_seconds", "Time to answer an inline query once it's no longer debounced")
+
+ROLL_TIMEOUT = 1
+STATS_TIMEOUT = 2
+SIM_TIMEOUT = simulation.DEADLINE + 1
+MESSAGE_LIMIT = telegram.MESSAGE_LIMIT
+MAX_CHAT_QUEUE = 50  # Messages of a chat waiting to be handled before the chat's newer ones are dropped
+MAX_PAGES = 3  # Messages one batch roll may be answered with before its results are only summarized
+LAST_ROLLS = 10000  # Chats whose last roll is remembered, so /log can still attach every die of it
+LOG_HINT = "\nSend /log for all of the rolls"
+HISTORY = 10  # Rolls /history shows when not asked for a number
+MAX_HISTORY = 50
+INLINE_DEBOUNCE = 0.3  # Seconds an inline query waits for a newer one from its user before it's answered
+INLINE_TIMEOUT = 0.5  # Seconds a preview may take before the inline query is answered without one
+INLINE_CACHE_TIME = 300  # Seconds Telegram may keep answers to inline queries, previews never roll anything
+INLINE_CHAT = 0  # Chat the audit log files inline rolls under, Telegram doesn't tell which chat they were sent to
+
+_sender = contextvars.ContextVar("sender", default=None)  # User id of the message being handled
+
+
+def paginate(lines, limit=MESSAGE_LIMIT - len("```\n```")):
+    '''Joins lines into pages of at most limit characters, wrapping the lines too long for a page on their own'''
+    pages, page = [], ""
+    for line in lines:
+        for part in textwrap.wrap(line, limit, break_on_hyphens=False) or [""]:
+            if page and len(page) + 1 + len(part) > limit:
+                pages.append(page)
+                page = ""
+            page = f"{page}\n{part}" if page else part
+    if page:
+        pages.append(page)
+    return pages
+
+
+def render_batch(batch, max_pages=MAX_PAGES):
+    '''Pages of the reply to a batch roll: every result if they fit in max_pages messages, otherwise the total,
+    lowest and highest result of every expression'''
+    pages = paginate(f"{expression} = {', '.join(str(rendering.format_result(result)) for result in results)}"
+                     for expression, results in batch)
+    if len(pages) <= max_pages:
+        return pages
+    pages = paginate(f"{expression}: {len(results)} rolls, total {rendering.format_result(sum(results))}, "
+                     f"lowest {rendering.format_result(min(results))}, highest {rendering.format_result(max(results))}"
+                     for expression, results in batch)
+    if len(pages) > max_pages:
+        pages = pages[:max_pages]
+        pages[-1] = pages[-1][:-len(" …")] + " …"
+    return pages
+
 
 class dXRollBot:
-    '''Telegram Bot that rolls dice. Meant to mimic Roll20 dice functionality'''
-    def __init__(self, token):
-        self.bot = telepot.Bot(token)
-        self.sent_message = ''
+    '''Telegram Bot that rolls dice. Meant to mimic Roll20 dice functionality
+
+    Updates are handled concurrently, but every chat gets its answers in the order it sent the messages. Evaluations
+    run in the evaluator pool and are waited for in a thread pool, so the event loop only ever does I/O. Replies go
+    through the outbox, which sends them within Telegram's rate limits. Inline queries are only previewed, the dice
+    are rolled once a user sends the result'''
+    command_pattern = re.compile(r"(\w+)(?:\s+|$)")
+
+    def __init__(self, token, api=None, evaluator=None, executor=None, help_topics=None, outbox=None, macro_store=None,
+                 audit_log=None):
+        self.api = api or telegram.TelegramAPI(token)
+        self.outbox = outbox or sendqueue.Outbox(self.api)
+        self.help = help_topics or helptopics.HelpTopics()
+        self.macros = macro_store or macros.MacroStore()
+        self.audit = audit_log or auditlog.AuditLog()
+        self.evaluator = evaluator or timeout.EvaluatorPool()
+        self.executor = executor or ThreadPoolExecutor(max_workers=timeout.WORKERS + timeout.MAX_QUEUE,
+                                                       thread_name_prefix="evaluator")
+        self.chats = {}  # chat_id: messages of the chat waiting to be handled
+        self.last_rolls = {}  # chat_id: (expression, seed) of the last roll of the chat, oldest chat first
+        self.tasks = set()
+        self.previewer = inline.Previewer()
+        self.inline_queries = {}  # user_id: id of the last inline query of the user, until it's answered
         self.commands = {"help": self._help,
                          "roll": self._roll,
-                         "r": self._roll}
-        telepot.loop.MessageLoop(self.bot, {'chat': self.on_chat_message}).run_as_thread()
+                         "r": self._roll,
+                         "stats": self._stats,
+                         "sim": self._sim,
+                         "log": self._log,
+                         "save": self._save,
+                         "history": self._history}
+
+    async def run(self, updates=None):
+        '''Handles updates forever, polled from the API unless they come from somewhere else (e.g. a webhook)'''
         logger.info('Started listening...')
-        while 1:
-            time.sleep(10)
-
-    def _help(self, chat_id, topic=''):
-        with open("helpfile.txt", "r") as f:
-            print_flag = not topic
-            help_message = ""
-            for line in f:
-                if line == f"[{topic}]\n":
-                    print_flag = True
-                    continue
-                if print_flag:
-                    if (line[0] == "["):
-                        break
-                    help_message += line
-        self.sent_message = self.bot.sendMessage(chat_id, help_message, parse_mode='Markdown')
-        logger.info('Sent help message: "%s"', self.sent_message['text'])
-
-    def _roll(self, chat_id, query):
+        async for update in updates or self.api.updates():
+            self.handle(update)
+
+    def handle(self, update):
+        '''Hands a message, inline query or chosen inline result to its handler, other updates are ignored'''
+        if "message" in update:
+            self.dispatch(update["message"])
+        elif "inline_query" in update:
+            self._start(self.on_inline_query(update["inline_query"]))
+        elif "chosen_inline_result" in update:
+            self._start(self.on_chosen_inline_result(update["chosen_inline_result"]))
+
+    def dispatch(self, message):
+        '''Queues the message behind the earlier messages of its chat, drops it if MAX_CHAT_QUEUE are waiting'''
+        chat_id = message["chat"]["id"]
+        if chat_id in self.chats:
+            queue = self.chats[chat_id]
+            if len(queue) >= MAX_CHAT_QUEUE:
+                if metrics.ENABLED:
+                    DROPPED_MESSAGES.inc()
+                logger.warning("Too many messages of chat %s are waiting, dropped one", chat_id)
+                return
+            queue.append(message)
+            return
+        self.chats[chat_id] = deque([message])
+        self._start(self._serve_chat(chat_id))
+
+    def _start(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _serve_chat(self, chat_id):
+        queue = self.chats[chat_id]
+        try:
+            while queue:
+                try:
+                    await self.on_chat_message(queue.popleft())
+                except Exception:
+                    logger.exception("Failed to handle a message from chat %s", chat_id)
+        finally:
+            del self.chats[chat_id]
+
+    async def join(self):
+        '''Waits until every queued message is handled and its replies are sent'''
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+        await self.outbox.join()
+
+    async def _send(self, chat_id, text, description="message"):
+        '''Queues a message in the outbox, waiting only while the outbox is full'''
+        await self.outbox.send(chat_id, text, description, parse_mode='Markdown')
+
+    async def _help(self, chat_id, topic=''):
+        await self._send(chat_id, self.help.message(topic), "help message")
+
+    async def _evaluate(self, seconds, function, *args):
+        '''Runs function in the evaluator pool, returns its result and an error message for the user'''
         error_message = ""
+        loop = asyncio.get_running_loop()
         try:
-            result = round(float(shuntingyard.ExpressionEvaluation(query)), 4)
-            if result == int(result):
-                result = int(result)
+            try:
+                # Executor threads don't inherit the context, so the trace of the message is carried over explicitly
+                evaluate = functools.partial(contextvars.copy_context().run, self.evaluator.evaluate, seconds, function, *args)
+                return await loop.run_in_executor(self.executor, evaluate), error_message
+            except Exception as exc:
+                if metrics.ENABLED:
+                    ERRORS.inc(type(exc).__name__)
+                raise
+        except timeout.TimeoutException:
+            error_message = "Error: The expression took too long to evaluate"
+        except timeout.PoolBusy:
+            error_message = "Error: The bot is too busy right now, please try again later"
+        except (timeout.WorkerCrashed, MemoryError):
+            error_message = "Error: The expression needs too much memory to evaluate"
+        except distribution.NoClosedForm as exc:
+            error_message = f"Error: This expression has no exact distribution: {exc}"
+        except simulation.SimulationError as exc:
+            error_message = f"Error: This expression can't be simulated: {exc}"
         except shuntingyard.UnknownSymbol as exc:
             error_message = f"Error: There was an unknown symbol or function in the expression: {exc}"
         except shuntingyard.StackIsEmpty as exc:
             error_message = f"Error: There was not enough values for one of the operators: {exc}"
-        except shuntingyard.NegativeRollMeasurements as exc:
-            error_message = "Error: " + exc
-        except shuntingyard.KeepValueError as exc:
-            error_message = "Error: " + exc
-        except shuntingyard.RerollValueError as exc:
-            error_message = "Error: " + exc
+        except (shuntingyard.NegativeRollMeasurements, shuntingyard.KeepValueError, shuntingyard.RerollValueError,
+                shuntingyard.ExplodeValueError, shuntingyard.RollModifierMisuse) as exc:
+            error_message = f"Error: {exc}"
+        except (shuntingyard.RollTooLarge, shuntingyard.BatchValueError, macros.MacroError) as exc:
+            error_message = f"Error: {exc}"
         except shuntingyard.MismatchedBrackets as exc:
-            error_message = "Error: There was a mismatched bracket in the expression"
+            error_message = f"Error: There was a mismatched bracket in the expression: {exc}"
         except shuntingyard.EmptyExpression:
             error_message = "Error: No expression was given"
-        except shuntingyard.RollModifierMisuse as exc:
-            error_message = "Error: " + exc
         except ZeroDivisionError:
             error_message = "Error: There was an attempt to divide by zero"
-        finally:
-            if error_message:
-                self.sent_message = self.bot.sendMessage(chat_id, error_message, parse_mode='Markdown')
-                logger.info('Sent exception message: "%s"', self.sent_message['text'])
-                return False
-        new_text = f'```\n{query} = {result}```'
-        if (len(new_text) >= 4095):
-            if (len(str(result)) < 4088):
-                new_text = f'```\n{result}```'
-            else:
-                new_text = "Error: The message is too long to display"
-        self.sent_message = self.bot.sendMessage(chat_id, new_text, parse_mode='Markdown')
-        logger.info('Sent message: "%s"', self.sent_message['text'])
+        except OverflowError:
+            error_message = "Error: The result is too large to calculate"
+        return None, error_message
+
+    async def _send_error(self, chat_id, error_message):
+        await self._send(chat_id, error_message, "exception message")
+        return False
+
+    async def _roll(self, chat_id, query):
+        # Every roll gets a logged seed of its own, so a disputed result can be replayed exactly
+        seed = dicebackends.new_seed()
+        logger.info("Rolling %r with seed %s", query, seed)
+        if shuntingyard.is_batch(query):
+            return await self._roll_batch(chat_id, query, seed)
+        program = None
+        if query.strip().startswith("$"):
+            # A macro runs the program saved with it, its expression is only shown
+            try:
+                query, program = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.macros.get, chat_id, query.strip()[1:])
+            except macros.MacroError as exc:
+                return await self._send_error(chat_id, f"Error: {exc}")
+        # The reply is rendered in the evaluator along with the roll, only as much of it as fits in a message
+        rendered, error_message = await self._evaluate(ROLL_TIMEOUT, rendering.render_roll, query, seed, LOG_HINT,
+                                                       program)
+        if error_message:
+            return await self._send_error(chat_id, error_message)
+        new_text, result = rendered
+        self.audit.record(chat_id, _sender.get() or 0, query, seed, result)
+        self.last_rolls.pop(chat_id, None)
+        self.last_rolls[chat_id] = (query, seed)
+        if len(self.last_rolls) > LAST_ROLLS:
+            del self.last_rolls[next(iter(self.last_rolls))]
+        await self._send(chat_id, new_text)
+        return True
+
+    async def _log(self, chat_id, query=''):
+        '''Attaches every die of the last roll of the chat as a document, rolled again from its seed'''
+        if chat_id not in self.last_rolls:
+            return await self._send_error(chat_id, "Error: There is no roll to send the log of")
+        expression, seed = self.last_rolls[chat_id]
+        document, error_message = await self._evaluate(ROLL_TIMEOUT, rendering.render_log, expression, seed)
+        if error_message:
+            return await self._send_error(chat_id, error_message)
+        caption = f"Rolls of {expression}"[:telegram.CAPTION_LIMIT]
+        await self.outbox.send(chat_id, caption, "roll log", document=(f"rolls-{seed}.txt", document))
         return True
 
-    def _parse_command(self, message):
-        _, _, chat_id = telepot.glance(message)
+    async def _save(self, chat_id, query=''):
+        '''Saves "name expression" as a macro of the chat, which "/r $name" rolls'''
+        name, _, expression = query.strip().partition(" ")
+        if not name or not expression.strip():
+            names = await asyncio.get_running_loop().run_in_executor(self.executor, self.macros.names, chat_id)
+            listed = ", ".join(f"`${name}`" for name in names) or "none yet"
+            return await self._send_error(chat_id, f"Usage: /save name expression. Macros of this chat: {listed}")
+        expression = expression.strip()
+        program, error_message = await self._evaluate(ROLL_TIMEOUT, macros.compile_macro, expression)
+        if error_message:
+            return await self._send_error(chat_id, error_message)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.macros.save, chat_id, name,
+                                                             expression, program)
+        except macros.MacroError as exc:
+            return await self._send_error(chat_id, f"Error: {exc}")
+        await self._send(chat_id, f"Saved `${name}`: `{expression}`", "macro message")
+        return True
+
+    async def _history(self, chat_id, query=''):
+        '''Lists the last rolls of the chat, or with "me" the statistics of the rolls of the sender'''
+        query = query.strip()
+        loop = asyncio.get_running_loop()
+        if query == "me":
+            stats = await loop.run_in_executor(self.executor, self.audit.user_stats, chat_id, _sender.get() or 0)
+            if stats is None:
+                return await self._send_error(chat_id, "You haven't rolled anything in this chat yet")
+            await self._send(chat_id, f"```\n{stats.rolls} rolls, average {rendering.format_result(stats.mean)}, "
+                                      f"lowest {rendering.format_result(stats.lowest)}, "
+                                      f"highest {rendering.format_result(stats.highest)}```", "history message")
+            return True
+        if query and not (query.isdigit() and 0 < int(query) <= MAX_HISTORY):
+            return await self._send_error(chat_id, f"Usage: /history [1-{MAX_HISTORY}] or /history me")
+        rolls = await loop.run_in_executor(self.executor, self.audit.history, chat_id, int(query or HISTORY))
+        if not rolls:
+            return await self._send_error(chat_id, "Nothing has been rolled in this chat yet")
+        lines = [f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(roll.timestamp))} user {roll.user_id}: "
+                 f"{roll.expression} = {'batch' if math.isnan(roll.result) else rendering.format_result(roll.result)} "
+                 f"(seed {roll.seed})" for roll in reversed(rolls)]
+        for page in paginate(lines):
+            await self._send(chat_id, f'```\n{page}```', "history message")
+        return True
+
+    async def _roll_batch(self, chat_id, query, seed=None):
+        batch, error_message = await self._evaluate(ROLL_TIMEOUT, shuntingyard.evaluate_batch, query, seed)
+        if error_message:
+            return await self._send_error(chat_id, error_message)
+        # A batch has no single result, it's replayed from its seed like any other roll
+        self.audit.record(chat_id, _sender.get() or 0, query, seed, math.nan)
+        for page in render_batch(batch):
+            await self._send(chat_id, f'```\n{page}```')
+        return True
+
+    async def _stats(self, chat_id, query):
+        description, error_message = await self._evaluate(STATS_TIMEOUT, distribution.describe_expression, query)
+        if error_message:
+            return await self._send_error(chat_id, error_message)
+        await self._send(chat_id, f'```\n{query}\n{description}```')
+        return True
+
+    async def _sim(self, chat_id, query):
+        described, error_message = await self._evaluate(SIM_TIMEOUT, simulation.describe_query, query)
+        if error_message:
+            return await self._send_error(chat_id, error_message)
+        expression, description = described
+        await self._send(chat_id, f'```\n{expression}\n{description}```')
+        return True
+
+    async def _parse_command(self, message):
+        _, _, chat_id = telegram.glance(message)
         if (message["text"][0] != '/'):
             return None
-        command = re.compile("(\w+)(?:\s+|$)").match(message["text"][1:])
+        command = self.command_pattern.match(message["text"][1:])
         if not command:
             return None
         if (command[1] in self.commands):
-            self.commands[command[1]](chat_id, message["text"][command.span()[1]:])
+            with COMMAND_SECONDS.time(command[1]):
+                await self.commands[command[1]](chat_id, message["text"][1 + command.end():])
         else:
             error_message = f"Unrecognized command: \"{command[1]}\""
-            self.sent_message = self.bot.sendMessage(chat_id, error_message, parse_mode='Markdown')
-            logger.info('Sent error message: "%s"', self.sent_message['text'])
+            await self._send(chat_id, error_message, "error message")
         return command[1]
 
-    def on_chat_message(self, message):
-        content_type, chat_type, chat_id = telepot.glance(message)
+    async def on_inline_query(self, query):
+        '''Answers an inline query with a preview of its expression, once its user has stopped typing
+
+        Telegram sends a query on nearly every keystroke, so a query is only answered if no newer one came from its
+        user within INLINE_DEBOUNCE. Telegram has moved on from the superseded ones and wouldn't show their answers'''
+        user_id = query["from"]["id"]
+        self.inline_queries[user_id] = query["id"]
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if self.inline_queries.get(user_id) != query["id"]:
+            outcome = "superseded"
+        else:
+            del self.inline_queries[user_id]
+            with INLINE_SECONDS.time():
+                outcome = await self._answer_inline_query(query)
+        if metrics.ENABLED:
+            INLINE_QUERIES.inc(outcome)
+
+    async def _answer_inline_query(self, query):
+        '''Previews the query in a thread within INLINE_TIMEOUT and answers it, returns what became of it'''
+        outcome = "answered"
+        preview = functools.partial(contextvars.copy_context().run, self.previewer.preview, query["query"])
+        try:
+            preview = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(self.executor, preview),
+                                             INLINE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Sending it is what checks the expression then, the roll reports what's wrong with it
+            preview, outcome = inline.unchecked(query["query"]), "timed_out"
+        logger.debug("Previewed inline query %r: %s", query["query"], preview)
+        try:
+            await self.api.answer_inline_query(query["id"], cache_time=INLINE_CACHE_TIME, **inline.answer(preview))
+        except (telegram.TelegramError, OSError) as e:
+            logger.warning("Failed to answer inline query %r: %r", query["query"], e)
+            return "failed"
+        return outcome
+
+    async def on_chosen_inline_result(self, chosen):
+        '''Rolls the expression of an inline result the user sent, and edits the message it became into the roll'''
+        with tracing.request(sample_rate=TRACE_SAMPLE_RATE):
+            expression, user_id = chosen["query"].strip(), chosen["from"]["id"]
+            if "inline_message_id" not in chosen:
+                logger.warning("Chosen inline result %r has no message to edit", expression)
+                return
+            seed = dicebackends.new_seed()
+            logger.info("Rolling %r inline with seed %s", expression, seed)
+            rendered, error_message = await self._evaluate(ROLL_TIMEOUT, rendering.render_roll, expression, seed)
+            if error_message:
+                text = error_message
+            else:
+                text, result = rendered
+                self.audit.record(INLINE_CHAT, user_id, expression, seed, result)
+            try:
+                await self.api.edit_message_text(text, inline_message_id=chosen["inline_message_id"],
+                                                 parse_mode="Markdown", reply_markup=inline.keyboard(expression))
+            except (telegram.TelegramError, OSError) as e:
+                logger.warning("Failed to edit the inline roll of %r: %r", expression, e)
+
+    async def on_chat_message(self, message):
+        sender = _sender.set(message.get("from", {}).get("id"))
+        try:
+            with tracing.request(sample_rate=TRACE_SAMPLE_RATE), MESSAGE_SECONDS.time():
+                await self._on_chat_message(message)
+        finally:
+            _sender.reset(sender)
+
+    async def _on_chat_message(self, message):
+        content_type, chat_type, chat_id = telegram.glance(message)
+        if metrics.ENABLED:
+            MESSAGES.inc(content_type)
         if (content_type == 'text'):
             logger.info('Received text message: "%s" from %s chat, id %s', message["text"], chat_type, chat_id)
-            self._parse_command(message)
+            await self._parse_command(message)
         else:
             logger.info('Received non-text (%s) message from %s chat, id %s', content_type, chat_type, chat_id)
 
 
-dXRollBot(sys.argv[1])
+async def serve_webhook(token, port, host="127.0.0.1", url=None, secret_token=None, workers=0,
+                        base_url=telegram.API_URL, macros_path=macros.DATABASE, audit_directory=auditlog.DIRECTORY):
+    '''Runs the bot on the updates Telegram posts to a local webhook, registering url with Telegram if given
+
+    With workers the messages are handled by that many processes, each of them answering its share of the chats'''
+    server = await webhook.WebhookServer(secret_token, host=host, port=port).start()
+    api = telegram.TelegramAPI(token, base_url=base_url)
+    if url:
+        await api.call("setWebhook", url=url, secret_token=secret_token)
+    if not workers:
+        bot = dXRollBot(token, api=api, macro_store=macros.MacroStore(macros_path),
+                        audit_log=auditlog.AuditLog(audit_directory))
+        try:
+            await bot.run(server.updates())
+        finally:
+            bot.audit.close()
+        return
+    dispatcher = webhook.ShardedDispatcher(dXRollBot, token, workers, base_url=base_url, macros_path=macros_path,
+                                           audit_directory=audit_directory)
+    try:
+        await dispatcher.run(server.updates())
+    finally:
+        dispatcher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram bot that rolls dice")
+    parser.add_argument("token")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--macros", default=macros.DATABASE, help="SQLite database the macros of the chats are saved in")
+    parser.add_argument("--audit", default=auditlog.DIRECTORY, help="directory of the log of every roll")
+    parser.add_argument("--webhook-port", type=int, help="take the updates Telegram posts to http://127.0.0.1:PORT/ "
+                                                         "instead of polling for them")
+    parser.add_argument("--webhook-url", help="public URL that forwards to the webhook port, registered with Telegram")
+    parser.add_argument("--secret-token", help="token Telegram has to post updates with (a random one by default)")
+    parser.add_argument("--workers", type=int, default=0, help="processes that handle the updates of the webhook, "
+                                                               "sharded by chat")
+    args = parser.parse_args()
+    tracing.configure(LOG_LEVEL)
+    if args.metrics_port is not None:
+        # Before the bot starts its evaluator, so the worker processes record metrics too
+        metrics.enable()
+        metrics.serve(args.metrics_port)
+    # NumPy is loaded lazily, the evaluator processes are forked with it rather than each loading it on a large roll
+    lazyimport.load(dicebackends.numpy)
+    if args.webhook_port is None:
+        bot = dXRollBot(args.token, macro_store=macros.MacroStore(args.macros), audit_log=auditlog.AuditLog(args.audit))
+        try:
+            asyncio.run(bot.run())
+        finally:
+            bot.audit.close()
+    else:
+        asyncio.run(serve_webhook(args.token, args.webhook_port, url=args.webhook_url,
+                                  secret_token=args.secret_token or secrets.token_urlsafe(32), workers=args.workers,
+                                  macros_path=args.macros, audit_directory=args.audit))
+
+
+if (__name__ == "__main__"):
+    main()
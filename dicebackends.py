@@ -0,0 +1,415 @@
+import os
+import heapq
+import random
+import logging
+import contextlib
+import contextvars
+from collections import Counter
+
+import lazyimport
+
+numpy = lazyimport.optional("numpy")
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+ARRAY_THRESHOLD = 256  # Smallest pool that is rolled by the array backend when NumPy is available
+COUNT_THRESHOLD = 10000  # Smallest pool that is kept as face counts...
+COUNT_RATIO = 64  # ...provided it has at least this many dice per face
+BULK_THRESHOLD = 16  # Smallest number of dice drawn from random bytes in bulk rather than one by one
+
+
+def new_seed():
+    '''A fresh 64-bit seed from the OS, which differs in forked processes unlike the state of a generator'''
+    return int.from_bytes(os.urandom(8), "big")
+
+
+class RandomSource:
+    '''Random draws for the dice backends, all derived from one seed so an evaluation can be replayed exactly
+
+    Single draws skip randint's argument checks, large groups of dice are drawn from random bytes in bulk, and the
+    NumPy generator for the array backend is seeded from the same seed when it's first needed'''
+    def __init__(self, seed=None):
+        self.seed = new_seed() if seed is None else seed
+        self.random = random.Random(self.seed)
+        self._randbelow = self.random._randbelow
+        self._generator = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(seed={self.seed})"
+
+    @property
+    def generator(self):
+        if self._generator is None:
+            self._generator = numpy.random.default_rng(self.seed)
+        return self._generator
+
+    def randbelow(self, number):
+        return self._randbelow(number)
+
+    def randint(self, low, high):
+        if high < low:
+            raise ValueError(f"No integer lies between {low} and {high}")
+        return low + self._randbelow(high - low + 1)
+
+    def randints(self, number, low, high):
+        '''List of number uniform ints from low to high inclusive'''
+        span = high - low + 1
+        if span <= 0 and number > 0:
+            # _randbelow(0) would never return
+            raise ValueError(f"No integer lies between {low} and {high}")
+        if number < BULK_THRESHOLD or span > 1 << 16:
+            randbelow = self._randbelow
+            return [low + randbelow(span) for i in range(number)]
+        # Bytes (or pairs of them) at or above the largest multiple of span are rejected, so every face is as likely
+        width, typecode = (1, "B") if span <= 1 << 8 else (2, "H")
+        limit = (1 << 8 * width) // span * span
+        rolls = []
+        while len(rolls) < number:
+            missing = number - len(rolls)
+            data = memoryview(self.random.randbytes(width * (missing + missing // 4 + 4))).cast(typecode)
+            rolls += [low + value % span for value in data if value < limit]
+        del rolls[number:]
+        return rolls
+
+
+_source = contextvars.ContextVar("source", default=None)
+_default_source = RandomSource()
+_seeded = False
+
+
+def current():
+    '''Random source of the current evaluation, the default one unless using() set another'''
+    return _source.get() or _default_source
+
+
+@contextlib.contextmanager
+def using(source):
+    '''Draws every roll in the block from source, which is a RandomSource or a seed to create one from'''
+    if not isinstance(source, RandomSource):
+        source = RandomSource(source)
+    token = _source.set(source)
+    try:
+        yield source
+    finally:
+        _source.reset(token)
+
+
+class ListDice:
+    '''Pure Python dice backend, every group of rolls is a list of ints'''
+    name = "list"
+
+    def roll(self, number, low, high):
+        return current().randints(number, low, high)
+
+    def total(self, rolls):
+        return sum(rolls)
+
+    def concatenate(self, first, second):
+        return list(first) + list(second)
+
+    def _select(self, rolls, count, lowest):
+        '''Indices of count lowest (or highest) rolls, earlier dice win ties'''
+        if count == 0:
+            return []
+        low, high = min(rolls), max(rolls)
+        if high - low < len(rolls):
+            # Faces are bounded, so counting them is linear in the number of dice
+            counts = [0] * (high - low + 1)
+            for value in rolls:
+                counts[value - low] += 1
+            quotas, remaining = [0] * len(counts), count
+            for face in (range(len(counts)) if lowest else reversed(range(len(counts)))):
+                quotas[face] = min(counts[face], remaining)
+                remaining -= quotas[face]
+                if not remaining:
+                    break
+            selected = []
+            for index, value in enumerate(rolls):
+                if quotas[value - low]:
+                    quotas[value - low] -= 1
+                    selected.append(index)
+            return selected
+        if lowest:
+            return sorted(heapq.nsmallest(count, range(len(rolls)), key=rolls.__getitem__))
+        return sorted(heapq.nlargest(count, range(len(rolls)), key=lambda index: (rolls[index], -index)))
+
+    def keep(self, rolls, number, highest=True):
+        '''Returns (kept, dropped, dropped_indices), kept and dropped rolls stay in the order they were rolled'''
+        dropped_indices = self._select(rolls, len(rolls) - number, lowest=highest)
+        dropped_set = set(dropped_indices)
+        kept = [value for index, value in enumerate(rolls) if index not in dropped_set]
+        return kept, [rolls[index] for index in dropped_indices], dropped_indices
+
+    def reroll(self, rolls, low, high, relation, target, once=False):
+        randint = current().randint
+        new_rolls = []
+        for value in rolls:
+            while relation(value, target):
+                value = randint(low, high)
+                if once is True:
+                    break
+            new_rolls.append(value)
+        return new_rolls
+
+    def explode(self, rolls, low, high, relation, target):
+        '''Returns (rolls, additional) where every matching die adds one more die, which can explode again'''
+        randint = current().randint
+        rolls, additional = list(rolls), []
+        for value in rolls:
+            if relation(value, target):
+                new_roll = randint(low, high)
+                additional.append(new_roll)
+                rolls.append(new_roll)
+        return rolls, additional
+
+    def explode_compounding(self, rolls, low, high, relation, target):
+        '''Returns (rolls, additional) where the extra dice are added to the die that exploded'''
+        randint = current().randint
+        new_rolls, additional = [], []
+        for value in rolls:
+            new_value = new_roll = value
+            while relation(new_roll, target):
+                new_roll = randint(low, high)
+                new_value += new_roll
+            new_rolls.append(new_value)
+            additional.append(new_value - value)
+        return new_rolls, additional
+
+
+class ArrayDice:
+    '''NumPy dice backend, every group of rolls is a compact integer array drawn in one batched call
+
+    Draws come from the generator of the current random source unless a generator is given'''
+    name = "array"
+
+    def __init__(self, generator=None):
+        self._generator = generator
+
+    @property
+    def generator(self):
+        return self._generator if self._generator is not None else current().generator
+
+    def _dtype(self, low, high):
+        return numpy.int32 if max(abs(low), abs(high)) < 2 ** 31 else numpy.int64
+
+    def _draw(self, size, low, high):
+        return self.generator.integers(low, high, size=size, endpoint=True, dtype=self._dtype(low, high))
+
+    def roll(self, number, low, high):
+        if number == 0:
+            return numpy.zeros(0, dtype=self._dtype(low, high))
+        return self._draw(number, low, high)
+
+    def total(self, rolls):
+        return int(rolls.sum(dtype=numpy.int64))
+
+    def concatenate(self, first, second):
+        return numpy.concatenate((numpy.asarray(first, dtype=numpy.int64), numpy.asarray(second, dtype=numpy.int64)))
+
+    def keep(self, rolls, number, highest=True):
+        count = len(rolls) - number
+        if count == 0:
+            dropped_indices = numpy.zeros(0, dtype=numpy.intp)
+        elif highest:
+            dropped_indices = numpy.sort(numpy.argpartition(rolls, count - 1)[:count])
+        else:
+            dropped_indices = numpy.sort(numpy.argpartition(rolls, number)[number:])
+        mask = numpy.ones(len(rolls), dtype=bool)
+        mask[dropped_indices] = False
+        return rolls[mask], rolls[dropped_indices], dropped_indices
+
+    def reroll(self, rolls, low, high, relation, target, once=False):
+        rolls = rolls.copy()
+        indices = numpy.flatnonzero(relation(rolls, target))
+        while indices.size:
+            rolls[indices] = self._draw(indices.size, low, high)
+            if once is True:
+                break
+            indices = indices[relation(rolls[indices], target)]
+        return rolls
+
+    def explode(self, rolls, low, high, relation, target):
+        waves = []
+        pending = int(numpy.count_nonzero(relation(rolls, target)))
+        while pending:
+            waves.append(self._draw(pending, low, high))
+            pending = int(numpy.count_nonzero(relation(waves[-1], target)))
+        additional = numpy.concatenate(waves) if waves else rolls[:0]
+        return numpy.concatenate((rolls, additional)), additional
+
+    def explode_compounding(self, rolls, low, high, relation, target):
+        additional = numpy.zeros(len(rolls), dtype=numpy.int64)
+        indices = numpy.flatnonzero(relation(rolls, target))
+        while indices.size:
+            draws = self._draw(indices.size, low, high)
+            additional[indices] += draws
+            indices = indices[relation(draws, target)]
+        return rolls + additional, additional
+
+
+class FaceCounts:
+    '''Histogram of a dice pool: how many dice show each value. Expands to individual rolls only when iterated'''
+    def __init__(self, counts=None):
+        self.counts = Counter()
+        if counts:
+            self.add(counts)
+
+    def add(self, other):
+        if isinstance(other, FaceCounts):
+            self.counts.update(other.counts)
+        elif isinstance(other, dict):
+            self.counts.update(other)
+        else:
+            self.counts.update(int(value) for value in other)
+        self.counts = +self.counts  # Drop faces with zero dice
+        return self
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def __iter__(self):
+        for value in sorted(self.counts):
+            for i in range(self.counts[value]):
+                yield value
+
+    def __contains__(self, value):
+        return self.counts[value] > 0
+
+    def __eq__(self, other):
+        if isinstance(other, FaceCounts):
+            return self.counts == other.counts
+        return NotImplemented
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(sorted(self.counts.items()))})"
+
+    def total(self):
+        return sum(value * count for value, count in self.counts.items())
+
+
+class CountedDice:
+    '''Dice backend for large homogeneous pools, every group of rolls is a FaceCounts histogram'''
+    name = "counts"
+
+    def _multinomial(self, number, faces):
+        '''Spreads number dice uniformly over faces, returns a dict of face counts'''
+        if number == 0 or not faces:
+            return {}
+        source = current()
+        if numpy is not None:
+            counts = source.generator.multinomial(number, [1 / len(faces)] * len(faces))
+            return dict(zip(faces, (int(count) for count in counts)))
+        return Counter(faces[index] for index in source.randints(number, 0, len(faces) - 1))
+
+    def roll(self, number, low, high):
+        return FaceCounts(self._multinomial(number, range(low, high + 1)))
+
+    def total(self, rolls):
+        return rolls.total() if isinstance(rolls, FaceCounts) else sum(rolls)
+
+    def concatenate(self, first, second):
+        if isinstance(first, FaceCounts) or isinstance(second, FaceCounts):
+            return FaceCounts(first).add(second)
+        return list(first) + list(second)
+
+    def keep(self, rolls, number, highest=True):
+        '''Returns (kept, dropped, dropped_indices), counted dice have no positions so dropped_indices is empty'''
+        kept, remaining = {}, number
+        for value in sorted(rolls.counts, reverse=highest):
+            kept[value] = min(rolls.counts[value], remaining)
+            remaining -= kept[value]
+        dropped = {value: count - kept[value] for value, count in rolls.counts.items()}
+        return FaceCounts(kept), FaceCounts(dropped), []
+
+    def reroll(self, rolls, low, high, relation, target, once=False):
+        faces = range(low, high + 1)
+        matching = {value: count for value, count in rolls.counts.items() if relation(value, target)}
+        new_rolls = FaceCounts({value: count for value, count in rolls.counts.items() if value not in matching})
+        if once is True:
+            return new_rolls.add(self._multinomial(sum(matching.values()), faces))
+        # Rerolling until a die stops matching is the same as rolling it over the faces that don't match
+        allowed = [face for face in faces if not relation(face, target)]
+        if matching and not allowed:
+            # Imported here, shuntingyard imports this module
+            import shuntingyard
+            raise shuntingyard.RerollValueError(f"Rerolling {relation.__name__} {target} never stops for faces {low}..{high}")
+        return new_rolls.add(self._multinomial(sum(matching.values()), allowed))
+
+    def explode(self, rolls, low, high, relation, target):
+        faces = range(low, high + 1)
+        additional = FaceCounts()
+        pending = sum(count for value, count in rolls.counts.items() if relation(value, target))
+        while pending:
+            wave = self._multinomial(pending, faces)
+            additional.add(wave)
+            pending = sum(count for value, count in wave.items() if relation(value, target))
+        return FaceCounts(rolls).add(additional), additional
+
+    def explode_compounding(self, rolls, low, high, relation, target):
+        faces = range(low, high + 1)
+        new_rolls = FaceCounts({value: count for value, count in rolls.counts.items() if not relation(value, target)})
+        additional = FaceCounts({0: len(new_rolls)})
+        # Chains that are still exploding, keyed by (accumulated value, extra over the original die)
+        active = Counter({(value, 0): count for value, count in rolls.counts.items() if relation(value, target)})
+        while active:
+            next_active = Counter()
+            for (value, extra), count in active.items():
+                for face, face_count in self._multinomial(count, faces).items():
+                    if relation(face, target):
+                        next_active[(value + face, extra + face)] += face_count
+                    else:
+                        new_rolls.add({value + face: face_count})
+                        additional.add({extra + face: face_count})
+            active = +next_active
+        return new_rolls, additional
+
+
+LIST_DICE = ListDice()
+ARRAY_DICE = ArrayDice() if numpy is not None else None
+COUNTED_DICE = CountedDice()
+
+
+def seed(value):
+    '''Seeds the default random source, for reproducible rolls in this process and the ones it forks'''
+    global _default_source, _seeded
+    _default_source = RandomSource(value)
+    _seeded = True
+
+
+def _after_fork():
+    '''Forked processes would draw the same rolls as their parent and siblings, unless seeded on purpose'''
+    global _default_source
+    if not _seeded:
+        _default_source = RandomSource()
+
+
+def select_backend(number, faces=None):
+    '''Picks face counts for pools much larger than the number of faces, arrays for large pools
+    when NumPy is installed and plain lists otherwise'''
+    if faces is not None and number >= COUNT_THRESHOLD and number >= COUNT_RATIO * faces:
+        return COUNTED_DICE
+    if ARRAY_DICE is not None and number >= ARRAY_THRESHOLD:
+        return ARRAY_DICE
+    return LIST_DICE
+
+
+def face_counts(rolls):
+    '''{face: number of dice showing it} of a group of rolls of any backend, without expanding counted dice or
+    iterating over an array in Python'''
+    if isinstance(rolls, FaceCounts):
+        return rolls.counts
+    if isinstance(rolls, (list, tuple)):
+        return Counter(rolls)
+    if not len(rolls):
+        return {}
+    low, high = int(rolls.min()), int(rolls.max())
+    if high - low < 2 * len(rolls):
+        counts = numpy.bincount(rolls - low)
+        faces = numpy.flatnonzero(counts)
+        return dict(zip((faces + low).tolist(), counts[faces].tolist()))
+    faces, counts = numpy.unique(rolls, return_counts=True)
+    return dict(zip(faces.tolist(), counts.tolist()))
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,478 @@
+import math
+import operator
+import functools
+import logging
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import shuntingyard
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+EXPLODE_DEPTH = 32  # Exploding chains are cut off after this many extra dice
+MAX_PAIRS = 250000  # Largest number of value pairs a generic binary operation may combine
+MAX_KEEP_STEPS = 2000000  # Largest number*count*faces handled by the keep/drop order statistics
+FFT_THRESHOLD = 1 << 14  # Convolutions with more products than this are done with FFT
+EPSILON = 1e-15
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class NoClosedForm(Exception):
+    '''The expression can't be turned into an exact distribution in reasonable time'''
+
+
+def _zeros(size):
+    return numpy.zeros(size) if numpy is not None else [0.0] * size
+
+
+def _add_shifted(target, source, shift, weight):
+    '''target[shift + i] += source[i] * weight, for every i that fits into target'''
+    length = min(len(source), len(target) - shift)
+    if length <= 0:
+        return
+    if numpy is not None:
+        target[shift:shift + length] += source[:length] * weight
+    else:
+        for i in range(length):
+            target[shift + i] += source[i] * weight
+
+
+def _convolve(first, second):
+    if numpy is None:
+        result = [0.0] * (len(first) + len(second) - 1)
+        for i, a in enumerate(first):
+            if a:
+                for j, b in enumerate(second):
+                    result[i + j] += a * b
+        return result
+    if len(first) * len(second) <= FFT_THRESHOLD:
+        return numpy.convolve(first, second)
+    size = len(first) + len(second) - 1
+    result = numpy.fft.irfft(numpy.fft.rfft(first, size) * numpy.fft.rfft(second, size), size)
+    return numpy.clip(result, 0, None)
+
+
+def _to_array(pmf):
+    '''Integer-valued pmf as (offset, array of probabilities of offset, offset + 1, ...)'''
+    offset = int(min(pmf))
+    array = _zeros(int(max(pmf)) - offset + 1)
+    for value, probability in pmf.items():
+        array[int(value) - offset] += probability
+    return offset, array
+
+
+def _from_array(offset, array):
+    return {offset + i: float(probability) for i, probability in enumerate(array) if probability > EPSILON}
+
+
+def _is_integral(pmf):
+    return all(float(value).is_integer() for value in pmf)
+
+
+def _binomial(number, probability):
+    '''Probabilities of 0..number successes out of number trials'''
+    if probability >= 1:
+        return [0.0] * number + [1.0]
+    if probability <= 0:
+        return [1.0] + [0.0] * number
+    log_p, log_q = math.log(probability), math.log1p(-probability)
+    log_n = math.lgamma(number + 1)
+    return [math.exp(log_n - math.lgamma(k + 1) - math.lgamma(number - k + 1) + k * log_p + (number - k) * log_q)
+            for k in range(number + 1)]
+
+
+class Distribution:
+    '''Probability mass function of a value, maps every possible value to its probability'''
+    def __init__(self, pmf, truncated=0.0):
+        self.pmf = {value: probability for value, probability in pmf.items() if probability > EPSILON}
+        self.truncated = truncated  # Probability mass lost by cutting off exploding chains
+
+    @classmethod
+    def constant(cls, value):
+        return cls({value: 1.0})
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())})"
+
+    def items(self):
+        return sorted(self.pmf.items())
+
+    @property
+    def mean(self):
+        return sum(value * probability for value, probability in self.pmf.items()) / self.total
+
+    @property
+    def total(self):
+        return sum(self.pmf.values())
+
+    @property
+    def stddev(self):
+        mean = self.mean
+        variance = sum((value - mean) ** 2 * probability for value, probability in self.pmf.items()) / self.total
+        return math.sqrt(variance)
+
+    def percentile(self, percent):
+        '''Smallest value that is at least as large as percent% of outcomes'''
+        target, cumulative = percent / 100 * self.total, 0.0
+        items = self.items()
+        for value, probability in items:
+            cumulative += probability
+            if cumulative >= target - 1e-12:
+                return value
+        return items[-1][0]
+
+    def histogram(self, rows=16, tail=0.1):
+        '''List of (low, high, probability) buckets, the tail% least likely values on each side go to the edge buckets'''
+        items = self.items()
+        if len(items) <= rows:
+            return [(value, value, probability) for value, probability in items]
+        low, high = self.percentile(tail), self.percentile(100 - tail)
+        width = (high - low) / rows or 1
+        if _is_integral(self.pmf):
+            width = math.ceil((high - low + 1) / rows)
+        buckets = [[None, None, 0.0] for i in range(rows)]
+        for value, probability in items:
+            bucket = buckets[max(0, min(int((value - low) / width), rows - 1))]
+            bucket[0] = value if bucket[0] is None else bucket[0]
+            bucket[1] = value
+            bucket[2] += probability
+        return [tuple(bucket) for bucket in buckets if bucket[0] is not None]
+
+    def map(self, function):
+        pmf = defaultdict(float)
+        for value, probability in self.pmf.items():
+            pmf[function(value)] += probability
+        return Distribution(pmf, self.truncated)
+
+    def combine(self, oper, other):
+        '''Distribution of oper(X, Y) for independent X from self and Y from other'''
+        truncated = self.truncated + other.truncated
+        if (oper in (operator.add, operator.sub) and len(self.pmf) * len(other.pmf) > 64
+                and _is_integral(self.pmf) and _is_integral(other.pmf)):
+            if oper is operator.sub:
+                other = other.map(operator.neg)
+            (first_offset, first), (second_offset, second) = _to_array(self.pmf), _to_array(other.pmf)
+            return Distribution(_from_array(first_offset + second_offset, _convolve(first, second)), truncated)
+        if len(self.pmf) * len(other.pmf) > MAX_PAIRS:
+            raise NoClosedForm(f"Combining {len(self.pmf)} by {len(other.pmf)} values is too expensive")
+        pmf = defaultdict(float)
+        for first, first_probability in self.pmf.items():
+            for second, second_probability in other.pmf.items():
+                pmf[oper(first, second)] += first_probability * second_probability
+        return Distribution(pmf, truncated)
+
+
+def _mixture(weighted):
+    '''Distribution of picking one of (weight, distribution) pairs with the given probabilities'''
+    pmf, truncated = defaultdict(float), 0.0
+    for weight, distribution in weighted:
+        truncated += weight * distribution.truncated
+        for value, probability in distribution.pmf.items():
+            pmf[value] += weight * probability
+    return Distribution(pmf, truncated)
+
+
+@functools.lru_cache(maxsize=512)
+def _dice_sum(number, die):
+    '''Distribution of the sum of number independent dice, die is a tuple of (value, probability) pairs'''
+    if number == 0:
+        return Distribution.constant(0)
+    offset, array = _to_array(dict(die))
+    result_offset, result = 0, None
+    while number:
+        if number & 1:
+            result = array if result is None else _convolve(result, array)
+            result_offset += offset
+        number >>= 1
+        if number:
+            array, offset = _convolve(array, array), offset * 2
+    return Distribution(_from_array(result_offset, result))
+
+
+@functools.lru_cache(maxsize=512)
+def _kept_sum(number, die, count, highest):
+    '''Distribution of the sum of count highest (or lowest) out of number independent dice
+
+    Faces are visited from the best to the worst one. Given that the remaining dice are no better than the
+    current face, each of them shows it with probability p(face) / P(no better), so the number of dice showing
+    it is binomial. Dice are kept until count of them have been assigned, after that the sum can't change.'''
+    if count == 0:
+        return Distribution.constant(0)
+    if number * count * len(die) > MAX_KEEP_STEPS:
+        raise NoClosedForm(f"Keeping {count} out of {number} dice with {len(die)} faces is too expensive")
+    low = die[0][0]
+    size = count * (die[-1][0] - low) + 1
+    faces = die[::-1] if highest else die
+    remaining = sum(probability for _, probability in die)
+    states, done = {0: _zeros(size)}, _zeros(size)
+    states[0][0] = 1.0
+    for index, (value, probability) in enumerate(faces):
+        chance = 1.0 if index == len(faces) - 1 else min(probability / remaining, 1.0)
+        remaining -= probability
+        new_states = {}
+        for assigned, sums in states.items():
+            for showing, weight in enumerate(_binomial(number - assigned, chance)):
+                if weight < EPSILON:
+                    continue
+                if assigned + showing >= count:
+                    target = done
+                else:
+                    target = new_states.setdefault(assigned + showing, _zeros(size))
+                _add_shifted(target, sums, min(showing, count - assigned) * (value - low), weight)
+        states = new_states
+    return Distribution(_from_array(count * low, done))
+
+
+def _add_arrays(first, second):
+    '''Adds two (offset, array) probability vectors that may start at different values'''
+    (first_offset, first), (second_offset, second) = first, second
+    offset = min(first_offset, second_offset)
+    result = _zeros(max(first_offset + len(first), second_offset + len(second)) - offset)
+    _add_shifted(result, first, first_offset - offset, 1.0)
+    _add_shifted(result, second, second_offset - offset, 1.0)
+    return offset, result
+
+
+def _explosion_chain(base, matches, depth):
+    '''Extra value an exploding die adds, together with the chance the chain would go on past depth dice'''
+    offset, array = _to_array(dict(base))
+    stop, go_on = _zeros(len(array)), _zeros(len(array))
+    for value, probability in base:
+        (go_on if matches(value) else stop)[value - offset] = probability
+    exploding = sum(probability for value, probability in base if matches(value))
+    chain, reach = (offset, array), exploding  # The last die in the chain doesn't explode anymore
+    for i in range(depth - 1):
+        if reach < EPSILON:
+            break
+        chain = _add_arrays((offset, stop), (offset + chain[0], _convolve(go_on, chain[1])))
+        reach *= exploding
+    return Distribution(_from_array(*chain)), (reach if reach >= EPSILON else 0.0)
+
+
+class Dice:
+    '''Independent dice with the same distribution that can still be modified, optionally reduced by keep/drop'''
+    def __init__(self, number, die, base, kept=None, exploded=False, truncated=0.0):
+        self.number = number
+        self.die = die  # Tuple of (value, probability) pairs for a single die after modifiers
+        self.base = base  # The same for a freshly rolled die
+        self.kept = kept
+        self.exploded = exploded
+        self.truncated = truncated
+
+    def distribution(self):
+        if self.kept is not None:
+            return self.kept
+        result = _dice_sum(self.number, self.die)
+        return Distribution(result.pmf, self.truncated) if self.truncated else result
+
+    def _check_modifiable(self, modifier):
+        if self.kept is not None or self.exploded:
+            raise NoClosedForm(f"Applying {modifier} after keeping/dropping or exploding dice has no exact form")
+
+
+class Pool:
+    '''Dice result that roll modifiers can still be applied to: a mixture of weighted Dice'''
+    def __init__(self, components):
+        self.components = components
+
+    def distribution(self):
+        if len(self.components) == 1:
+            return self.components[0][1].distribution()
+        return _mixture((weight, dice.distribution()) for weight, dice in self.components)
+
+    def apply(self, argument, function):
+        '''Applies function(dice, value) to every component for every possible value of argument'''
+        if isinstance(argument, Pool):
+            argument = argument.distribution()
+        pmf = argument.pmf if isinstance(argument, Distribution) else {argument: 1.0}
+        return Pool([(weight * probability, function(dice, value))
+                     for weight, dice in self.components for value, probability in pmf.items()])
+
+
+def _as_distribution(value):
+    if isinstance(value, Pool):
+        return value.distribution()
+    if isinstance(value, Distribution):
+        return value
+    raise shuntingyard.UnknownSymbol(value)
+
+
+def _integer(value, exception, message):
+    try:
+        return int(value)
+    except ValueError:
+        raise exception(message.format(value))
+
+
+class DistributionEvaluation:
+    '''Exact probability distribution of an expression, evaluated over the same compiled program as a roll'''
+    def __init__(self, expression, depth=EXPLODE_DEPTH, grammar=shuntingyard.GRAMMAR):
+        logger.info("Computing distribution of expression '%s'", expression)
+        self.depth = depth
+        self.program = shuntingyard.compile_expression(expression, grammar)
+        self.result = _evaluate(self.program.instructions, grammar, depth)
+
+    @staticmethod
+    def dice(number, sides):
+        components = []
+        for count, count_probability in _as_distribution(number).pmf.items():
+            count = round(count)
+            if count < 0:
+                raise shuntingyard.NegativeRollMeasurements(f"Cannot roll negative number of dice: {count}")
+            for side, side_probability in ({"F": 1.0} if sides == "F" else _as_distribution(sides).pmf).items():
+                low, high = (-1, 1) if side == "F" else (1, round(side))
+                if high < 0:
+                    raise shuntingyard.NegativeRollMeasurements(f"Cannot roll dice with negative number of sides: {high}")
+                if high < low and count:
+                    raise shuntingyard.NegativeRollMeasurements("Cannot roll dice with 0 sides")
+                die = tuple((value, 1 / (high - low + 1)) for value in range(low, high + 1)) or ((0, 1.0),)
+                components.append((count_probability * side_probability, Dice(count, die, die)))
+        return Pool(components)
+
+    @staticmethod
+    def keep(pool, count, *, highest=True, drop=False):
+        def keep_dice(dice, count):
+            dice._check_modifiable("keep/drop")
+            count = _integer(count, shuntingyard.KeepValueError, "Number of dice to keep/drop ({}) has to be a number")
+            keep_highest = highest
+            if drop:
+                count, keep_highest = dice.number - count, not highest
+            if (0 > count) or (count > dice.number):
+                raise shuntingyard.KeepValueError(f"Number of dice to keep/drop ({count}) has to be positive and less than number of rolls ({dice.number})")
+            return Dice(dice.number, dice.die, dice.base, kept=_kept_sum(dice.number, dice.die, count, keep_highest))
+        return pool.apply(count, keep_dice)
+
+    @staticmethod
+    def reroll(pool, target, *, relation, once=False):
+        def reroll_dice(dice, target):
+            dice._check_modifiable("rerolls")
+            target = _integer(target, shuntingyard.RerollValueError, "Number of dice to reroll ({}) has to be a number")
+
+            def matches(value):
+                return shuntingyard.RELATIONS[relation](value, target)
+            redo = sum(probability for value, probability in dice.die if matches(value))
+            pmf = defaultdict(float, {value: probability for value, probability in dice.die if not matches(value)})
+            if once:
+                replacement = dice.base
+            else:
+                # Rerolling until a die stops matching is the same as rolling it over the faces that don't match
+                allowed = sum(probability for value, probability in dice.base if not matches(value))
+                if redo and not allowed:
+                    raise shuntingyard.RerollValueError(f"Rerolling dice that are {relation}{target} would never stop")
+                replacement = tuple((value, probability / allowed) for value, probability in dice.base if not matches(value))
+            for value, probability in replacement:
+                pmf[value] += redo * probability
+            return Dice(dice.number, tuple(sorted(pmf.items())), dice.base)
+        return pool.apply(target, reroll_dice)
+
+    @staticmethod
+    def explode(pool, target=None, *, relation="=", compounding=False, depth=EXPLODE_DEPTH):
+        def explode_dice(dice, target):
+            dice._check_modifiable("exploding")
+            if target is None or target == "F":
+                target = dice.base[-1][0]
+            target = _integer(target, shuntingyard.ExplodeValueError, "Target number for exploding dice ({}) has to be a number (or 'F' for Fate dice)")
+
+            def matches(value):
+                return shuntingyard.RELATIONS[relation](value, target)
+            chain, cut_off = _explosion_chain(dice.base, matches, depth)
+            pmf, exploding = defaultdict(float), 0.0
+            for value, probability in dice.die:
+                if matches(value):
+                    exploding += probability
+                    for extra, extra_probability in chain.pmf.items():
+                        pmf[value + extra] += probability * extra_probability
+                else:
+                    pmf[value] += probability
+            # An exploded die adds up to the same total whether its extra dice are compounded or kept apart
+            return Dice(dice.number, tuple(sorted(pmf.items())), dice.base, exploded=not compounding,
+                        truncated=dice.truncated + dice.number * exploding * cut_off)
+        return pool.apply(target, explode_dice)
+
+
+ARITHMETIC = {operator.add, operator.sub, operator.mul, operator.truediv, operator.mod, operator.pow}
+
+
+def _modifiers():
+    '''Distribution counterparts of the roll modifiers, keyed by the functions the grammar uses for rolls'''
+    return {shuntingyard.keep_highest: ("keep", {"highest": True}),
+            shuntingyard.keep_lowest: ("keep", {"highest": False}),
+            shuntingyard.drop_highest: ("keep", {"highest": True, "drop": True}),
+            shuntingyard.drop_lowest: ("keep", {"highest": False, "drop": True}),
+            shuntingyard.reroll_equal: ("reroll", {"relation": "="}),
+            shuntingyard.reroll_more: ("reroll", {"relation": ">"}),
+            shuntingyard.reroll_less: ("reroll", {"relation": "<"}),
+            shuntingyard.reroll_once_equal: ("reroll", {"relation": "=", "once": True}),
+            shuntingyard.reroll_once_more: ("reroll", {"relation": ">", "once": True}),
+            shuntingyard.reroll_once_less: ("reroll", {"relation": "<", "once": True}),
+            shuntingyard.explode: ("explode", {}),
+            shuntingyard.explode_equal: ("explode", {"relation": "="}),
+            shuntingyard.explode_more: ("explode", {"relation": ">"}),
+            shuntingyard.explode_less: ("explode", {"relation": "<"}),
+            shuntingyard.explode_compounding: ("explode", {"compounding": True}),
+            shuntingyard.explode_compounding_equal: ("explode", {"relation": "=", "compounding": True}),
+            shuntingyard.explode_compounding_more: ("explode", {"relation": ">", "compounding": True}),
+            shuntingyard.explode_compounding_less: ("explode", {"relation": "<", "compounding": True})}
+
+
+MODIFIERS = _modifiers()
+
+
+@functools.lru_cache(maxsize=256)
+def _evaluate(instructions, grammar, depth):
+    values = []
+    for kind, token in instructions:
+        if kind == shuntingyard.PUSH:
+            values.append(token if token == "F" else Distribution.constant(token))
+        elif kind == shuntingyard.FUNCTION:
+            values.append(_as_distribution(values.pop()).map(grammar.functions[token]))
+        else:
+            oper = grammar.operators[token]
+            args = values[-oper.operands:]
+            del values[-oper.operands:]
+            if token in grammar.roll_modifiers:
+                if not isinstance(args[0], Pool):
+                    raise shuntingyard.RollModifierMisuse(f"Tried to apply roll modifier to something that is not a roll: {args[0]}")
+                if oper.function not in MODIFIERS:
+                    raise NoClosedForm(f"Roll modifier '{token}' has no exact distribution")
+                name, options = MODIFIERS[oper.function]
+                if name == "explode":
+                    options = dict(options, depth=depth)
+                values.append(getattr(DistributionEvaluation, name)(*args, **options))
+            elif oper.function is shuntingyard.RolledDice:
+                values.append(DistributionEvaluation.dice(*args))
+            elif oper.function is operator.neg:
+                values.append(_as_distribution(args[0]).map(operator.neg))
+            elif oper.function in ARITHMETIC:
+                values.append(_as_distribution(args[0]).combine(oper.function, _as_distribution(args[1])))
+            else:
+                raise NoClosedForm(f"Operator '{token}' has no exact distribution")
+    return _as_distribution(values[0])
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else f"{value:.4g}"
+
+
+def describe(distribution, rows=16, width=20, depth=EXPLODE_DEPTH):
+    '''Mean, standard deviation, percentiles and a compact text histogram of the distribution'''
+    lines = [f"mean {distribution.mean:.4g}, stddev {distribution.stddev:.4g}",
+             "  ".join(f"{percent}%: {_number(distribution.percentile(percent))}" for percent in PERCENTILES)]
+    histogram = distribution.histogram(rows)
+    highest = max(probability for _, _, probability in histogram)
+    labels = [_number(low) if low == high else f"{_number(low)}..{_number(high)}" for low, high, _ in histogram]
+    label_width = max(len(label) for label in labels)
+    for label, (_, _, probability) in zip(labels, histogram):
+        lines.append(f"{label:>{label_width}} {probability * 100:6.2f}% " + "#" * round(probability / highest * width))
+    if distribution.truncated > 1e-9:
+        lines.append(f"(exploding dice cut off after {depth} rolls, {distribution.truncated:.2g} probability lost)")
+    return "\n".join(lines)
+
+
+def describe_expression(expression, depth=EXPLODE_DEPTH):
+    return describe(DistributionEvaluation(expression, depth).result, depth=depth)
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import math
+import signal
+import argparse
+import itertools
+import logging
+import threading
+import contextlib
+from collections import deque
+
+import shuntingyard
+import dicebackends
+import tracing
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256  # Lines a worker process rolls per task
+CHUNKS_PER_WORKER = 4  # Chunks handed out ahead of the output, more lines than these aren't read before they're written
+
+LINE_TIMEOUT = 1  # Seconds a line may take to roll before it's recorded as an error, like a roll the bot times out
+
+
+def compile(expression):
+    '''Program compiled from the expression, cached like the bot's, which can be executed any number of times'''
+    return shuntingyard.compile_expression(expression)
+
+
+def roll(expression, seed=None):
+    '''Result of rolling the expression once: a number, or RolledDice with the dice rolled. float() gives its value'''
+    return shuntingyard.evaluate(expression, seed)
+
+
+def roll_many(expression, times, seed=None):
+    '''Results of rolling the expression times times, compiled and checked only once'''
+    return shuntingyard.ExpressionEvaluation(expression, times=times, seed=seed).results
+
+
+def roll_batch(query, seed=None):
+    '''[(expression, [results])] of a batch like "10#1d20; 2d6", see shuntingyard.split_batch'''
+    return shuntingyard.evaluate_batch(query, seed)
+
+
+def distribution_of(expression):
+    '''Exact Distribution of the results of the expression, as /stats computes it'''
+    import distribution
+    return distribution.DistributionEvaluation(expression).result
+
+
+def simulate(expression, trials=None, seed=None):
+    '''SimulationEvaluation of the expression over trials random rolls (the simulation default if not given), as /sim
+    makes it'''
+    import simulation
+    return simulation.SimulationEvaluation(expression, trials or simulation.TRIALS, seed=seed)
+
+
+def _number(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise OverflowError("The result is not a finite number")
+    return int(value) if value.is_integer() else value
+
+
+@contextlib.contextmanager
+def _deadlines(seconds):
+    '''Yields deadline(), a context manager that raises TimeoutException in its block once it has run for seconds,
+    like a roll the bot times out. The handler of SIGALRM is set once for all of them. There is no deadline without
+    SIGALRM, or outside of the main thread where signals can't be handled'''
+    if not seconds or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield contextlib.nullcontext
+        return
+    # Imported here, the library doesn't need it
+    import timeout
+
+    def expire(signum, frame):
+        raise timeout.TimeoutException(f"Timed out after {seconds} seconds")
+
+    @contextlib.contextmanager
+    def deadline():
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    try:
+        yield deadline
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+
+
+def evaluate_line(line, expression, seed, deadline=contextlib.nullcontext):
+    '''Record of the roll of the expression on a line of a batch, its result or the error it raised'''
+    record = {"line": line, "expression": expression, "seed": seed}
+    try:
+        with deadline():
+            if shuntingyard.is_batch(expression):
+                record["results"] = [[part, [_number(result) for result in results]]
+                                     for part, results in shuntingyard.evaluate_batch(expression, seed)]
+            else:
+                record["result"] = _number(shuntingyard.evaluate(expression, seed))
+    except Exception as exc:
+        # Whatever a line raises (e.g. TypeError for "1d6d6") is reported on it, the rest of the batch goes on
+        record["error"] = f"{type(exc).__name__}: {exc}"
+    return record
+
+
+def evaluate_chunk(chunk, seconds=LINE_TIMEOUT):
+    '''Records of a chunk of [(line, expression, seed)], in a worker process. A line that takes longer than seconds
+    to roll is recorded with TimeoutException'''
+    with _deadlines(seconds) as deadline:
+        return [evaluate_line(*item, deadline) for item in chunk]
+
+
+def _numbered(lines, seed):
+    '''(line, expression, seed) of every line that isn't blank, line numbers counted from 1'''
+    for number, text in enumerate(lines, 1):
+        expression = text.strip()
+        if expression:
+            yield number, expression, dicebackends.new_seed() if seed is None else seed + number
+
+
+def evaluate_lines(lines, workers=None, chunk_size=CHUNK_SIZE, seed=None, seconds=LINE_TIMEOUT):
+    '''Rolls the expression on every line that isn't blank, yields their records in the order of the lines
+
+    Lines are read as they're needed and rolled chunk_size at a time by workers processes (one per CPU by default,
+    in this process with 0 or a single CPU). Only CHUNKS_PER_WORKER chunks per worker are read ahead of the records
+    yielded, so a stream of any length is rolled in bounded memory. Every line has a seed of its own, SEED+N for
+    line N when a seed is given, so the records don't depend on the workers and any line can be rolled again alone.
+    A line that takes longer than seconds to roll is recorded as an error'''
+    items = _numbered(lines, seed)
+    chunks = iter(lambda: list(itertools.islice(items, chunk_size)), [])
+    if workers is None:
+        # A single worker process would only add the cost of sending it the lines and the records back
+        workers = os.cpu_count() if (os.cpu_count() or 1) > 1 else 0
+    if workers == 0:
+        for chunk in chunks:
+            yield from evaluate_chunk(chunk, seconds)
+        return
+    # Imported here, the library doesn't need it
+    import concurrent.futures
+    pool = concurrent.futures.ProcessPoolExecutor(workers)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(evaluate_chunk, chunk, seconds))
+            if len(pending) >= workers * CHUNKS_PER_WORKER:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rolls dice expressions in bulk, one per line, and writes a JSON "
+                                                 "object per expression with its result or error")
+    parser.add_argument("input", nargs="?", default="-", help="file of expressions, stdin by default or with -")
+    parser.add_argument("-o", "--output", default="-", help="file to write the results to, stdout by default or with -")
+    parser.add_argument("--workers", type=int, help="processes rolling the expressions (one per CPU by default), "
+                                                    "0 rolls them in this one")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="expressions a process rolls at a time")
+    parser.add_argument("--seed", type=int, help="roll line N with seed SEED+N, to reproduce the results")
+    parser.add_argument("--timeout", type=float, default=LINE_TIMEOUT,
+                        help="seconds an expression may take to roll before it's reported as an error")
+    args = parser.parse_args(argv)
+    tracing.configure(logging.WARNING)
+    source = sys.stdin if args.input == "-" else open(args.input)
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        for record in evaluate_lines(source, args.workers, max(1, args.chunk_size), args.seed,
+                                     args.timeout):
+            output.write(json.dumps(record) + "\n")
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        else:
+            output.flush()
+    return 0
+
+
+if (__name__ == "__main__"):
+    sys.exit(main())
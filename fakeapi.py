@@ -0,0 +1,293 @@
+import re
+import sys
+import json
+import time
+import email
+import email.policy
+import http.client
+import urllib.parse
+import asyncio
+import argparse
+import logging
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+
+class FakeTelegram:
+    '''Local stand-in for the Telegram Bot API: queues messages for getUpdates and records what the bot sends
+
+    Serves getMe, getUpdates (with long polling), sendMessage, sendDocument, answerInlineQuery and editMessageText.
+    latency seconds are added to every message sent to mimic a slow round trip, and fail() makes the next ones fail
+    like flood control does. The files of sent documents are kept in documents, answers to inline queries in answers
+    and edited messages in edits. post_updates() delivers the queued updates to a webhook instead'''
+    path_pattern = re.compile(r"/bot(?P<token>[^/]+)/(?P<method>\w+)")
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.updates = []
+        self.sent = []
+        self.documents = []  # (chat_id, filename, bytes) of every document sent
+        self.answers = []  # parameters of every answerInlineQuery
+        self.edits = []  # parameters of every editMessageText
+        self.__condition = threading.Condition()
+        self.__next_id = 1
+        self.__message_id = 1
+        self.__failures = []  # (error_code, retry_after) answers of the next messages sent
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                match = fake.path_pattern.fullmatch(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if self.headers.get_content_type() == "multipart/form-data":
+                    params = fake.parse_form(self.headers["Content-Type"], body)
+                else:
+                    params = json.loads(body or b"{}")
+                if not match or not hasattr(fake, "_" + match["method"]):
+                    answer, status = {"ok": False, "error_code": 404, "description": "Not Found"}, 404
+                else:
+                    answer = getattr(fake, "_" + match["method"])(**params)
+                    status = answer.get("error_code", 200)
+                body = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _queue(self, kind, make):
+        '''Queues an update of kind made by make(update_id), returns its update_id'''
+        with self.__condition:
+            update_id = self.__next_id
+            self.__next_id += 1
+            self.updates.append({"update_id": update_id, kind: make(update_id)})
+            self.__condition.notify_all()
+        return update_id
+
+    def send_text(self, chat_id, text, chat_type="private"):
+        '''Queues a text message from a user, returns its update_id'''
+        return self._queue("message", lambda update_id: {
+            "message_id": update_id, "date": int(time.time()), "text": text, "chat": {"id": chat_id, "type": chat_type},
+            "from": {"id": chat_id, "is_bot": False}})
+
+    def send_inline_query(self, user_id, query):
+        '''Queues an inline query typed by a user, returns its update_id'''
+        return self._queue("inline_query", lambda update_id: {
+            "id": str(update_id), "from": {"id": user_id, "is_bot": False}, "query": query, "offset": ""})
+
+    def choose_inline_result(self, user_id, query, result_id="roll"):
+        '''Queues the result a user sent for an inline query, returns the inline_message_id it was sent as'''
+        update_id = self._queue("chosen_inline_result", lambda update_id: {
+            "result_id": result_id, "from": {"id": user_id, "is_bot": False}, "query": query,
+            "inline_message_id": f"inline-{update_id}"})
+        return f"inline-{update_id}"
+
+    @staticmethod
+    def parse_form(content_type, body):
+        '''Parameters of a multipart/form-data body, files as (filename, bytes)'''
+        form = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body, policy=email.policy.HTTP)
+        params = {}
+        for part in form.iter_parts():
+            name, filename = part.get_param("name", header="content-disposition"), part.get_filename()
+            data = part.get_payload(decode=True)
+            params[name] = (filename, data) if filename else data.decode()
+        return params
+
+    def post_updates(self, url, secret_token, retry_delay=0.05):
+        '''Posts the queued updates to the webhook at url one at a time and in order, like Telegram does, posting an
+        update again until the webhook accepts it. Returns how many updates were posted'''
+        import webhook
+        address = urllib.parse.urlsplit(url)
+        connection = http.client.HTTPConnection(address.hostname, address.port, timeout=10)
+        headers = {"Content-Type": "application/json", webhook.SECRET_HEADER: secret_token}
+        posted = 0
+        try:
+            while True:
+                with self.__condition:
+                    if not self.updates:
+                        return posted
+                    update = self.updates[0]
+                connection.request("POST", address.path or "/", json.dumps(update).encode(), headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    time.sleep(retry_delay)
+                    continue
+                with self.__condition:
+                    self.updates.remove(update)
+                posted += 1
+        finally:
+            connection.close()
+
+    def fail(self, count=1, error_code=429, retry_after=1):
+        '''Makes the next count messages sent fail, by default with flood control asking to retry after a while'''
+        with self.__condition:
+            self.__failures += [(error_code, retry_after)] * count
+
+    def wait_for(self, count, timeout=10, kind="sent"):
+        '''Waits until the bot has sent count messages (or whatever other kind of list is given), returns them'''
+        with self.__condition:
+            self.__condition.wait_for(lambda: len(getattr(self, kind)) >= count, timeout)
+            return list(getattr(self, kind))
+
+    def _getMe(self):
+        return {"ok": True, "result": {"id": 0, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+
+    def _getUpdates(self, offset=None, timeout=0, limit=100, **params):
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            if offset is not None:
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.__condition.wait(deadline - time.monotonic())
+            return {"ok": True, "result": self.updates[:limit]}
+
+    def _send(self, chat_id, document=None, **content):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.__condition:
+            if self.__failures:
+                error_code, retry_after = self.__failures.pop(0)
+                answer = {"ok": False, "error_code": error_code, "description": f"Error {error_code}"}
+                if retry_after is not None:
+                    answer["parameters"] = {"retry_after": retry_after}
+                return answer
+            message = {"message_id": self.__message_id, "date": int(time.time()), **content,
+                       "chat": {"id": chat_id, "type": "private"}}
+            if document is not None:
+                message["document"] = {"file_name": document[0], "file_size": len(document[1])}
+                self.documents.append((chat_id, *document))
+            self.__message_id += 1
+            self.sent.append(message)
+            self.__condition.notify_all()
+        return {"ok": True, "result": message}
+
+    def _sendMessage(self, chat_id, text, **params):
+        return self._send(chat_id, text=text)
+
+    def _sendDocument(self, chat_id, document, caption=None, **params):
+        return self._send(int(chat_id), document, **({} if caption is None else {"caption": caption}))
+
+    def _record(self, kind, params):
+        with self.__condition:
+            getattr(self, kind).append(params)
+            self.__condition.notify_all()
+        return {"ok": True, "result": True}
+
+    def _answerInlineQuery(self, inline_query_id, results, **params):
+        return self._record("answers", {"inline_query_id": inline_query_id, "results": results, **params})
+
+    def _editMessageText(self, text, **params):
+        return self._record("edits", {"text": text, **params})
+
+
+def load_test(chats, messages, expression, latency, webhook_mode=False, workers=0):
+    '''Runs the bot against a FakeTelegram server and reports its throughput and per-chat ordering
+
+    The bot polls for the updates, or in webhook_mode they're posted to its webhook, where workers processes
+    handle them if given'''
+    import dXRollBot
+    import telegram
+    import webhook
+    import auditlog
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with FakeTelegram(latency=latency) as fake, tempfile.TemporaryDirectory() as directory:
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        bot, dispatcher, server = None, None, None
+        if not webhook_mode:
+            bot = dXRollBot.dXRollBot("TOKEN", api=telegram.TelegramAPI("TOKEN", base_url=fake.url, poll_timeout=1),
+                                      audit_log=auditlog.AuditLog(directory))
+            updates = None
+        else:
+            server = asyncio.run_coroutine_threadsafe(webhook.WebhookServer("SECRET").start(), loop).result()
+            updates = server.updates()
+            if workers:
+                dispatcher = webhook.ShardedDispatcher(dXRollBot.dXRollBot, "TOKEN", workers, base_url=fake.url,
+                                                       audit_directory=directory)
+            else:
+                bot = dXRollBot.dXRollBot("TOKEN", api=telegram.TelegramAPI("TOKEN", base_url=fake.url),
+                                          audit_log=auditlog.AuditLog(directory))
+        running = asyncio.run_coroutine_threadsafe(dispatcher.run(updates) if dispatcher else bot.run(updates), loop)
+        start = time.monotonic()
+        for i in range(messages):
+            for chat_id in range(1, chats + 1):
+                fake.send_text(chat_id, f"/r {expression}+{i}")
+        if server is not None:
+            fake.post_updates(server.url, "SECRET")
+            print(f"Posted {chats * messages} updates to the webhook in {time.monotonic() - start:.2f} s")
+        # The outbox may coalesce several replies into one message, so replies are counted rather than messages
+        deadline = time.monotonic() + 60 + chats * messages
+        while True:
+            sent = list(fake.sent)
+            answered = {chat_id: [int(number) for message in sent if message["chat"]["id"] == chat_id
+                                  for number in re.findall(r"\+(\d+) =", message["text"])]
+                        for chat_id in range(1, chats + 1)}
+            if sum(map(len, answered.values())) >= chats * messages or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        elapsed = time.monotonic() - start
+        in_order = all(numbers == list(range(messages)) for numbers in answered.values())
+        print(f"{len(sent)} messages answering {chats * messages} messages from {chats} chats in {elapsed:.2f} s "
+              f"({len(sent) / elapsed:.1f} per second), per-chat order kept: {in_order}")
+        running.cancel()
+        if bot is not None:
+            print(f"Evaluator: {bot.evaluator.stats()}")
+            bot.evaluator.close()
+            bot.audit.close()
+        if dispatcher is not None:
+            dispatcher.close()
+        if server is not None:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server for load testing the bot")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10, help="messages sent by every chat")
+    parser.add_argument("--expression", default="4d6kh3")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every sendMessage takes")
+    parser.add_argument("--webhook", action="store_true", help="post the updates to the bot's webhook instead of "
+                                                               "letting it poll for them")
+    parser.add_argument("--workers", type=int, default=0, help="processes that handle the updates of the webhook")
+    args = parser.parse_args()
+    load_test(args.chats, args.messages, args.expression, args.latency, args.webhook, args.workers)
+
+
+if (__name__ == "__main__"):
+    sys.exit(main())
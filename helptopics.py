@@ -0,0 +1,132 @@
+import os
+import re
+import time
+import difflib
+import logging
+import threading
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+HELP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helpfile.txt")
+CHECK_INTERVAL = 2.0  # Seconds between checks of the help file's modification time
+FUZZY_CUTOFF = 0.6  # How similar to a topic a misspelled name has to be, from 0 to 1
+
+LINK_PATTERN = re.compile(r"\[[^\]]*\]\([^)]*\)")
+HEADER_PATTERN = re.compile(r"\[(\w+)\]\s*")
+
+
+class MarkdownError(ValueError):
+    '''The text has Markdown entities Telegram can't parse'''
+
+
+def escape_markdown(text):
+    return re.sub(r"([_*`\[])", r"\\\1", text)
+
+
+def validate_markdown(text):
+    '''Raises MarkdownError unless every entity of Telegram's (legacy) Markdown in text is closed'''
+    i = 0
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+        for marker in ("```", "`", "*", "_"):
+            if text.startswith(marker, i):
+                end = text.find(marker, i + len(marker))
+                if end < 0:
+                    raise MarkdownError(f"Unclosed {marker} at position {i}: {text[i:i + 20]!r}")
+                i = end + len(marker)
+                break
+        else:
+            if text[i] == "[":
+                link = LINK_PATTERN.match(text, i)
+                if not link:
+                    raise MarkdownError(f"Malformed link at position {i}: {text[i:i + 20]!r}")
+                i = link.end()
+            else:
+                i += 1
+
+
+def parse(lines):
+    '''Splits the lines of a help file into {topic: text}, the text before the first [topic] is under ""'''
+    topics, topic, text = {}, "", []
+    for line in lines:
+        header = HEADER_PATTERN.fullmatch(line)
+        if header:
+            topics[topic] = "".join(text)
+            topic, text = header[1].lower(), []
+        else:
+            text.append(line)
+    topics[topic] = "".join(text)
+    return topics
+
+
+class HelpTopics:
+    '''Help file loaded and indexed once, then reloaded only when it changes
+
+    The file is checked at most every check_interval seconds, so a /help request normally costs no I/O. Every
+    message is built and validated as Markdown on load, and a reload that fails keeps the topics loaded before'''
+    def __init__(self, path=HELP_FILE, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.__lock = threading.Lock()
+        self.__mtime = os.stat(path).st_mtime_ns
+        self.__checked = time.monotonic()
+        self.__topics, self.__messages = self._load()
+
+    def _load(self):
+        with open(self.path, "r") as f:
+            topics = parse(f)
+        messages = dict(topics)
+        listing = ", ".join(f"`{topic}`" for topic in topics if topic)
+        messages[""] = topics.get("", "") + f"Help topics: {listing}\n"
+        for topic, message in messages.items():
+            if not message.strip():
+                raise MarkdownError(f"Help topic [{topic}] is empty")
+            try:
+                validate_markdown(message)
+            except MarkdownError as e:
+                raise MarkdownError(f"Help topic [{topic}]: {e}") from e
+        logger.info("Loaded %s help topics from %s", len(topics) - ("" in topics), self.path)
+        return topics, messages
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self.__checked < self.check_interval:
+            return
+        with self.__lock:
+            self.__checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self.__mtime:
+                    self.__mtime = mtime
+                    self.__topics, self.__messages = self._load()
+            except (OSError, MarkdownError) as e:
+                logger.error("Couldn't reload the help file, keeping the loaded topics: %s", e)
+
+    @property
+    def topics(self):
+        self._refresh()
+        return [topic for topic in self.__topics if topic]
+
+    def lookup(self, query):
+        '''Topics that match query: the exact one, those it is a prefix of, or the one it looks most like a typo of'''
+        self._refresh()
+        query = query.strip().lower()
+        if query in self.__messages:
+            return [query]
+        topics = [topic for topic in self.__topics if topic]
+        return ([topic for topic in topics if topic.startswith(query)]
+                or difflib.get_close_matches(query, topics, n=1, cutoff=FUZZY_CUTOFF))
+
+    def message(self, query=""):
+        '''Text to answer /help query with'''
+        matches = self.lookup(query)
+        if len(matches) == 1:
+            return self.__messages[matches[0]]
+        listing = ", ".join(f"`{topic}`" for topic in (matches or self.topics))
+        query = escape_markdown(query.strip())
+        if matches:
+            return f"There are several help topics like \"{query}\": {listing}"
+        return f"There is no help topic \"{query}\". Help topics: {listing}"
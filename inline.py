@@ -0,0 +1,120 @@
+import math
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+import shuntingyard
+import rendering
+import metrics
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+PREFIXES = 4096  # Tokenized queries kept, for the queries that extend them to resume from
+MAX_QUERY = 256  # Characters Telegram allows in an inline query
+RESULT_ID = "roll"
+HELP_TOPIC = "roll"  # Help topic the button of an invalid query opens a chat with the bot on
+UNCHECKED = "Tap to roll"
+
+PREFIX_LOOKUPS = metrics.counter("dxroll_inline_prefix_lookups_total",
+                                 "Inline queries tokenized, by whether they resumed from a cached prefix", ["outcome"])
+
+# expression: the query without surrounding whitespace, valid: whether it can be rolled, text: the results it may
+# have or why it can't be rolled
+Preview = namedtuple("Preview", ["expression", "valid", "text"])
+
+PREVIEW_ERRORS = (shuntingyard.UnknownSymbol, shuntingyard.StackIsEmpty, shuntingyard.MismatchedBrackets,
+                  shuntingyard.EmptyExpression, shuntingyard.RollTooLarge, shuntingyard.BatchValueError,
+                  shuntingyard.NegativeRollMeasurements, shuntingyard.KeepValueError, shuntingyard.RerollValueError,
+                  shuntingyard.ExplodeValueError, shuntingyard.RollModifierMisuse, ZeroDivisionError, OverflowError)
+ERROR_FORMATS = {shuntingyard.UnknownSymbol: "Unknown symbol {}",
+                 shuntingyard.StackIsEmpty: "Not enough values for {}",
+                 shuntingyard.EmptyExpression: "Type a formula to roll, e.g. 2d6+3",
+                 ZeroDivisionError: "Division by zero",
+                 OverflowError: "The result is too large"}
+
+
+def unchecked(query):
+    '''Preview of a query that couldn't be checked in time, rolling it is what tells whether it's valid'''
+    return Preview(query.strip()[:MAX_QUERY], True, UNCHECKED)
+
+
+def describe_bounds(bounds):
+    low, high = getattr(bounds, "low", -math.inf), getattr(bounds, "high", math.inf)
+    if not (math.isfinite(low) and math.isfinite(high)):
+        return UNCHECKED
+    if low == high:
+        return f"Always {rendering.format_result(low)}"
+    return f"From {rendering.format_result(low)} to {rendering.format_result(high)}"
+
+
+def keyboard(expression):
+    '''Markup of an inline roll. Telegram only tells which message a chosen result became when it has some'''
+    return {"inline_keyboard": [[{"text": "Roll again", "switch_inline_query_current_chat": expression}]]}
+
+
+def answer(preview):
+    '''Parameters of answerInlineQuery for a preview: a single result to roll, or a button leading to the help when
+    the query can't be rolled'''
+    if not preview.valid:
+        return {"results": [], "button": {"text": preview.text, "start_parameter": HELP_TOPIC}}
+    return {"results": [{"type": "article", "id": RESULT_ID, "title": f"Roll {preview.expression}",
+                         "description": preview.text,
+                         "input_message_content": {"message_text": f"Rolling {preview.expression} …"},
+                         "reply_markup": keyboard(preview.expression)}]}
+
+
+class Previewer:
+    '''Previews of inline queries, which Telegram sends on nearly every keystroke
+
+    A preview compiles the query and estimates the cost and bounds of the roll, no dice are rolled. The tokens of
+    every query are kept, and the next query, which usually extends an earlier one, resumes tokenizing from the
+    longest of them it starts with. Only the last token of that prefix is split again, as it may go on (e.g. "1d2"
+    becoming "1d20")'''
+    def __init__(self, grammar=shuntingyard.GRAMMAR, maxsize=PREFIXES):
+        self.grammar = grammar
+        self.maxsize = maxsize
+        self.__prefixes = OrderedDict()  # compact query: its tokens
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__prefixes)
+
+    def _longest_prefix(self, compact):
+        with self.__lock:
+            for end in range(len(compact), 0, -1):
+                tokens = self.__prefixes.get(compact[:end])
+                if tokens is not None:
+                    self.__prefixes.move_to_end(compact[:end])
+                    return tokens
+        return ()
+
+    def tokenize(self, compact, source):
+        '''Tokens of the compact query, resumed from the longest prefix of it that was tokenized'''
+        tokens = self._longest_prefix(compact)
+        keep = len(tokens) - 1
+        if keep > 0 and tokens[keep - 1][1] == "d":
+            # The number after "d%" is placed at the "%", tokenizing can only resume at the "d"
+            keep -= 1
+        if metrics.ENABLED:
+            PREFIX_LOOKUPS.inc("hit" if tokens else "miss")
+        position = tokens[keep][2] if tokens else 0
+        tokens = tuple(self.grammar.tokenize(compact, source, tokens[:max(keep, 0)], position))
+        with self.__lock:
+            self.__prefixes[compact] = tokens
+            self.__prefixes.move_to_end(compact)
+            while len(self.__prefixes) > self.maxsize:
+                self.__prefixes.popitem(last=False)
+        return tokens
+
+    def preview(self, query):
+        expression = query.strip()[:MAX_QUERY]
+        try:
+            if shuntingyard.is_batch(expression):
+                raise shuntingyard.BatchValueError("Batch rolls can only be sent with /r")
+            tokens = self.tokenize(self.grammar.compact(expression), expression)
+            program = self.grammar.compile(expression, tokens)
+            program.cost.check()
+        except PREVIEW_ERRORS as exc:
+            return Preview(expression, False, ERROR_FORMATS.get(type(exc), "{}").format(exc))
+        return Preview(expression, True, describe_bounds(program.cost.bounds))
@@ -0,0 +1,32 @@
+import sys
+import importlib.util
+
+
+def optional(name):
+    '''The module name if it's installed, None otherwise, imported only when one of its attributes is first used
+
+    Whether the module is installed is looked up at once, so callers still test it against None, but loading it
+    (NumPy alone takes longer to import than the whole evaluator) waits until something of it is needed. Once a
+    module is loaded lazily, importing it anywhere else gives the same module'''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.loader is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load(module):
+    '''Finishes loading a module returned by optional() (e.g. before forking processes that would each load it)'''
+    if module is not None:
+        module.__name__  # Looking up any attribute finishes loading it
+    return module
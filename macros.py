@@ -0,0 +1,98 @@
+import re
+import json
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+import shuntingyard
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+DATABASE = "macros.sqlite3"
+CACHED_CHATS = 1000  # Chats whose macros are kept in memory
+MAX_MACROS = 100  # Macros a chat may save
+NAME_PATTERN = re.compile(r"[A-Za-z_]\w{0,31}")
+
+
+class MacroError(Exception):
+    '''A macro can't be saved or run'''
+
+
+def compile_macro(expression):
+    '''Compiles the expression of a macro and checks it isn't too large to roll, returns its program'''
+    program = shuntingyard.compile_expression(expression)
+    program.cost.check()
+    return program
+
+
+class MacroStore:
+    '''Roll macros of every chat, kept in an SQLite database with the programs compiled from them
+
+    A macro is only saved once its expression has compiled, and its program is stored next to its text, so running
+    it never parses the text again. The macros of the chats used last are kept in memory, read in one query when a
+    chat first needs one. The database is in WAL mode and only created once a macro is looked up or saved'''
+    def __init__(self, path=DATABASE, grammar=shuntingyard.GRAMMAR, cached_chats=CACHED_CHATS):
+        self.path = path
+        self.grammar = grammar
+        self.cached_chats = cached_chats
+        self.__connection = None
+        self.__lock = threading.Lock()
+        self.__chats = OrderedDict()  # chat_id: {name: (expression, program)}
+
+    def _connect(self):
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS macros (chat_id INTEGER NOT NULL, name TEXT NOT NULL, "
+                                      "expression TEXT NOT NULL, program TEXT NOT NULL, PRIMARY KEY (chat_id, name))")
+        return self.__connection
+
+    def _chat(self, chat_id):
+        '''{name: (expression, program)} of the chat, read from the database unless it's cached. Expects the lock'''
+        macros = self.__chats.get(chat_id)
+        if macros is not None:
+            self.__chats.move_to_end(chat_id)
+            return macros
+        rows = self._connect().execute("SELECT name, expression, program FROM macros WHERE chat_id = ?", (chat_id,))
+        macros = {}
+        for name, expression, program in rows:
+            source, instructions = json.loads(program)
+            macros[name] = (expression, shuntingyard.Program(source, map(tuple, instructions), self.grammar))
+        self.__chats[chat_id] = macros
+        while len(self.__chats) > self.cached_chats:
+            self.__chats.popitem(last=False)
+        return macros
+
+    def save(self, chat_id, name, expression, program):
+        '''Saves program compiled from expression as the macro name of the chat, replacing one of the same name'''
+        if not NAME_PATTERN.fullmatch(name):
+            raise MacroError(f'"{name}" can\'t be the name of a macro, use up to 32 letters, digits and _')
+        with self.__lock:
+            macros = self._chat(chat_id)
+            if name not in macros and len(macros) >= MAX_MACROS:
+                raise MacroError(f"A chat can save at most {MAX_MACROS} macros")
+            self._connect().execute("INSERT OR REPLACE INTO macros VALUES (?, ?, ?, ?)",
+                                    (chat_id, name, expression, json.dumps([program.source, program.instructions])))
+            macros[name] = (expression, program)
+        logger.info("Saved macro %s of chat %s: %r", name, chat_id, expression)
+
+    def get(self, chat_id, name):
+        '''(expression, program) of the macro name of the chat'''
+        with self.__lock:
+            macro = self._chat(chat_id).get(name)
+        if macro is None:
+            raise MacroError(f"There is no macro named `${name}`")
+        return macro
+
+    def names(self, chat_id):
+        with self.__lock:
+            return sorted(self._chat(chat_id))
+
+    def close(self):
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+            self.__chats.clear()
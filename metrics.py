@@ -0,0 +1,218 @@
+import math
+import time
+import bisect
+import logging
+import threading
+import contextlib
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+# Instrumented code checks this before taking any measurement, so disabled metrics cost one global lookup
+ENABLED = False
+
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    '''Monotonic count, one per combination of label values'''
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        with self._lock:
+            for labels, value in values.items():
+                self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+                for labels, value in sorted(values.items())]
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    '''Distribution of observed values in cumulative buckets, with their sum and count'''
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # labels: [counts per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *labels):
+        '''Context manager that observes how long its block takes, or does nothing while metrics are disabled'''
+        return _Timer(self, labels) if ENABLED else _NULL_TIMER
+
+    def count(self, *labels):
+        state = self._values.get(labels)
+        return sum(state[0]) if state else 0
+
+    def sum(self, *labels):
+        state = self._values.get(labels)
+        return state[1] if state else 0
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        with self._lock:
+            for labels, (counts, total) in values.items():
+                state = self._values.get(labels)
+                if state is None:
+                    state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+                state[0] = [mine + theirs for mine, theirs in zip(state[0], counts)]
+                state[1] += total
+
+    def render(self):
+        with self._lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self._values.items()}
+        lines = []
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    '''Metrics of the process, rendered in the Prometheus text format'''
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def drain(self):
+        '''Takes the values of every metric, resetting them. Worker processes send these to merge() in the parent'''
+        return {name: values for name, values in ((name, metric.drain()) for name, metric in self.metrics.items()) if values}
+
+    def merge(self, values):
+        for name, metric_values in values.items():
+            if name in self.metrics:
+                self.metrics[name].merge(metric_values)
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, documentation, labels, buckets))
+
+
+def serve(port, host="127.0.0.1", registry=REGISTRY):
+    '''Serves the metrics at http://host:port/metrics from a daemon thread, returns the server'''
+    # Imported here, programs that only evaluate expressions never serve anything
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", *server.server_address[:2])
+    return server
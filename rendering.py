@@ -0,0 +1,150 @@
+import heapq
+import logging
+from collections import Counter
+
+import shuntingyard
+import dicebackends
+import telegram
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = telegram.MESSAGE_LIMIT
+SUMMARY_LIMIT = 1000  # Characters of a reply the summary of the rolls that didn't fit may take
+LOG_LIMIT = 1000000  # Characters of the dice a /log document lists, the ones past them are only summarized
+FENCE = "```"
+ELLIPSIS = " …"
+
+
+def format_result(result):
+    result = round(float(result), 4)
+    return int(result) if result == int(result) else result
+
+
+class Budget:
+    '''Text built a piece at a time that refuses the pieces that would make it longer than limit characters'''
+    __slots__ = ("parts", "length", "limit")
+
+    def __init__(self, limit):
+        self.parts = []
+        self.length = 0
+        self.limit = limit
+
+    def write(self, text):
+        '''Appends text if it fits, returns whether it did'''
+        if self.length + len(text) > self.limit:
+            return False
+        self.parts.append(text)
+        self.length += len(text)
+        return True
+
+    def __str__(self):
+        return "".join(self.parts)
+
+
+def _write_rolls(budget, label, groups, skip_empty=True):
+    '''Writes a line of the rolls of every group, as many of them as fit. Returns whether all of them did'''
+    if not any(len(group) for group in groups):
+        return True
+    if not budget.write(f"\n{label}:"):
+        return False
+    separator = " "
+    for group in groups:
+        if skip_empty and not len(group):
+            continue
+        for roll in group:
+            if not budget.write(f"{separator}{roll}"):
+                return False
+            separator = ", "
+        separator = " | "
+    return True
+
+
+def summarize(result, limit=SUMMARY_LIMIT):
+    '''One line counting the kept dice of a roll by face, and how many were dropped and exploded'''
+    faces = Counter()
+    for group in result.rolls:
+        faces.update(dicebackends.face_counts(group))
+    dropped = sum(len(group) for group in result.dropped_rolls)
+    exploded = sum(len(group) for group in result.additional_rolls)
+    summary = Budget(limit - len(ELLIPSIS))
+    summary.write(f"{sum(faces.values())} dice:")
+    separator = " "
+    # Every face takes at least ", 1×1", only the lowest ones can fit
+    for face, count in heapq.nsmallest(limit // 5 + 1, faces.items()):
+        if not summary.write(f"{separator}{face}×{count}"):
+            summary.limit += len(ELLIPSIS)
+            summary.write(ELLIPSIS)
+            break
+        separator = ", "
+    counts = [f"{dropped} dropped"] * bool(dropped) + [f"{exploded} exploded"] * bool(exploded)
+    return f"{summary}{'; ' + ', '.join(counts) if counts else ''}"
+
+
+def _write_all_rolls(budget, result):
+    return (_write_rolls(budget, "Rolls", result.rolls, skip_empty=False)
+            and _write_rolls(budget, "Dropped", result.dropped_rolls)
+            and _write_rolls(budget, "Exploded", result.additional_rolls))
+
+
+def render_result(expression, result, hint="", limit=MESSAGE_LIMIT):
+    '''The reply to a roll: its result, then the dice rolled for as long as they fit in limit characters
+
+    The rolls are written one at a time into what is left of the message, so a pool of any size is never formatted
+    whole. When they don't all fit, they're written again cut short to make room for their summary, followed by
+    hint, which is only counted then'''
+    value = format_result(result)
+    reply = Budget(limit - len(FENCE) * 2 - 1)
+    if not reply.write(f"{expression} = {value}") and not reply.write(str(value)):
+        return "Error: The message is too long to display"
+    if isinstance(result, shuntingyard.RolledDice):
+        rolls = Budget(reply.limit - reply.length)
+        if not _write_all_rolls(rolls, result):
+            summary = f"\n{summarize(result)}{hint}"
+            rolls = Budget(reply.limit - reply.length - len(ELLIPSIS) - len(summary))
+            _write_all_rolls(rolls, result)
+            rolls.limit += len(ELLIPSIS) + len(summary)
+            rolls.write(ELLIPSIS)
+            rolls.write(summary)
+        reply.write(str(rolls))
+    return f"{FENCE}\n{reply}{FENCE}"
+
+
+def render_roll(expression, seed=None, hint="", program=None):
+    '''Rolls the expression (or its compiled program) and renders the reply, in the process that rolled it so the
+    dice never leave it. Returns the reply and the result as a float'''
+    result = shuntingyard.evaluate(expression, seed, program)
+    return render_result(expression, result, hint), float(result)
+
+
+def _write_log_rolls(budget, label, rolls):
+    '''Writes a line of the rolls of a group, as many of them as fit. Returns whether all of them did'''
+    if not budget.write(f"{label}: "):
+        return False
+    separator = ""
+    for roll in rolls:
+        if not budget.write(f"{separator}{roll}"):
+            return False
+        separator = ", "
+    return budget.write("\n")
+
+
+def render_log(expression, seed, limit=LOG_LIMIT):
+    '''Rolls the expression with seed again and writes its dice to a text document, returns its bytes
+
+    The dice are listed for as long as they fit in limit characters, the whole roll is summarized after them when
+    they don't, so a pool of any size is never formatted whole'''
+    evaluation = shuntingyard.ExpressionEvaluation(expression, seed=seed)
+    result = evaluation.result
+    document = Budget(limit)
+    header = f"{expression} = {format_result(result)}\nSeed: {seed}\n"
+    if not isinstance(result, shuntingyard.RolledDice):
+        return header.encode()
+    for number, (rolls, dropped, exploded) in enumerate(zip(result.rolls, result.dropped_rolls,
+                                                            result.additional_rolls), 1):
+        if not (document.write(f"\nGroup {number}\n") and _write_log_rolls(document, "Rolls", rolls)
+                and (not len(dropped) or _write_log_rolls(document, "Dropped", dropped))
+                and (not len(exploded) or _write_log_rolls(document, "Exploded", exploded))):
+            note = f"Only the first {limit} characters of the dice are listed. All of them: {summarize(result)}"
+            return f"{header}{document}{ELLIPSIS}\n\n{note}\n".encode()
+    return f"{header}{document}".encode()
@@ -0,0 +1,193 @@
+import time
+import asyncio
+import logging
+from collections import deque, namedtuple
+
+import metrics
+import telegram
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 30  # Messages per second Telegram lets a bot send across all chats
+GLOBAL_BURST = 30
+CHAT_RATE = 1  # Messages per second a single chat should get
+CHAT_BURST = 3  # Messages a chat that has been quiet may get at once
+MAX_PENDING = 1000  # Replies waiting to be sent before senders have to wait for room (or their replies are dropped)
+MAX_RETRIES = 5
+BACKOFF = 0.5  # Seconds to wait before retrying a failed send, doubled with every retry
+MAX_BACKOFF = 30
+IDLE_CHATS = 1000  # Rate limits of chats kept before the ones that have fully recovered are forgotten
+
+SEND_SECONDS = metrics.histogram("dxroll_send_seconds", "Time the Telegram API took to send a message")
+QUEUE_SECONDS = metrics.histogram("dxroll_outbox_queue_seconds", "Time replies waited in the outbox to be sent")
+BACKPRESSURE_SECONDS = metrics.histogram("dxroll_outbox_backpressure_seconds", "Time senders waited for room in the full outbox")
+REPLIES = metrics.counter("dxroll_outbox_replies_total", "Replies handed to the outbox, by what became of them", ["outcome"])
+RETRIES = metrics.counter("dxroll_outbox_retries_total", "Sends retried, by the reason they failed", ["reason"])
+
+Reply = namedtuple("Reply", ["text", "description", "kwargs", "queued"])
+
+
+class TokenBucket:
+    '''Allows rate events per second on average and up to burst of them at once. A rate of None doesn't limit'''
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def delay(self):
+        '''Seconds until the next event is allowed'''
+        if self.rate is None:
+            return 0
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate is not None:
+            self.tokens -= 1
+
+    def idle(self):
+        '''Whether the bucket is full again, so forgetting it changes nothing'''
+        return self.delay() == 0 and (self.rate is None or self.tokens >= self.burst)
+
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self.take()
+
+
+class Outbox:
+    '''Sends the replies of the bot within Telegram's rate limits
+
+    Every chat is sent to in order by a task of its own, limited by a token bucket of the chat and one shared by all
+    chats. Replies that pile up for a chat while it waits are coalesced into one message when they fit. Sends that
+    hit flood control are retried after the retry_after the API asks for, other failures with exponential backoff.
+    At most max_pending replies wait at once: send() then waits for room, or drops the reply with wait=False.
+    A reply with a document=(filename, bytes) keyword is sent as that document with the text as its caption'''
+    def __init__(self, api, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, max_pending=MAX_PENDING, coalesce=True,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF, global_burst=GLOBAL_BURST):
+        self.api = api
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pending = 0
+        self.chats = {}  # chat_id: replies waiting to be sent to the chat
+        self.buckets = {}  # chat_id: rate limit of the chat
+        self.tasks = set()
+        self.__room = None
+
+    async def send(self, chat_id, text, description="message", wait=True, **kwargs):
+        '''Queues a message to the chat, returns whether it was queued (it's only dropped with wait=False)'''
+        if self.pending >= self.max_pending:
+            if not wait:
+                if metrics.ENABLED:
+                    REPLIES.inc("dropped")
+                logger.warning("The outbox is full, dropped %s to chat %s", description, chat_id)
+                return False
+            if self.__room is None:
+                self.__room = asyncio.Condition()
+            with BACKPRESSURE_SECONDS.time():
+                async with self.__room:
+                    await self.__room.wait_for(lambda: self.pending < self.max_pending)
+        self.pending += 1
+        reply = Reply(text, description, kwargs, time.perf_counter())
+        if chat_id in self.chats:
+            self.chats[chat_id].append(reply)
+            return True
+        self.chats[chat_id] = deque([reply])
+        task = asyncio.get_running_loop().create_task(self._serve_chat(chat_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def join(self):
+        '''Waits until every queued reply is sent (or given up on)'''
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    def _take(self, queue):
+        '''Pops the next reply of a chat, coalesced with the ones after it that fit in the same message'''
+        replies = [queue.popleft()]
+        length = len(replies[0].text)
+        while (self.coalesce and queue and "document" not in replies[0].kwargs and queue[0].kwargs == replies[0].kwargs
+               and length + 1 + len(queue[0].text) <= telegram.MESSAGE_LIMIT):
+            length += 1 + len(queue[0].text)
+            replies.append(queue.popleft())
+        return replies
+
+    async def _serve_chat(self, chat_id):
+        queue = self.chats[chat_id]
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, CHAT_BURST)
+        try:
+            while queue:
+                await bucket.acquire()
+                replies = self._take(queue)
+                try:
+                    await self._deliver(chat_id, replies)
+                except Exception:
+                    if metrics.ENABLED:
+                        REPLIES.inc("failed", amount=len(replies))
+                    logger.exception("Failed to send a reply to chat %s", chat_id)
+                self.pending -= len(replies)
+                if self.__room is not None:
+                    async with self.__room:
+                        self.__room.notify(len(replies))
+        finally:
+            del self.chats[chat_id]
+            if len(self.buckets) > IDLE_CHATS:
+                for idle in [chat for chat, bucket in self.buckets.items() if chat not in self.chats and bucket.idle()]:
+                    del self.buckets[idle]
+
+    async def _deliver(self, chat_id, replies):
+        text = "\n".join(reply.text for reply in replies)
+        description = replies[0].description if len(replies) == 1 else f"{len(replies)} coalesced messages"
+        kwargs = dict(replies[0].kwargs)
+        document = kwargs.pop("document", None)
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                if document is None:
+                    sent_message = await self.api.send_message(chat_id, text, **kwargs)
+                else:
+                    sent_message = await self.api.send_document(chat_id, *document, caption=text, **kwargs)
+            except telegram.TelegramError as exc:
+                if exc.retry_after is None and (exc.error_code or 0) < 500:
+                    raise
+                error = exc
+                reason, delay = ("rate_limited", exc.retry_after) if exc.retry_after else ("error", self.backoff * 2 ** attempt)
+            except OSError as exc:
+                error = exc
+                reason, delay = "error", self.backoff * 2 ** attempt
+            else:
+                if metrics.ENABLED:
+                    SEND_SECONDS.observe(time.perf_counter() - start)
+                    for reply in replies:
+                        QUEUE_SECONDS.observe(start - reply.queued)
+                    REPLIES.inc("sent")
+                    if len(replies) > 1:
+                        REPLIES.inc("coalesced", amount=len(replies) - 1)
+                logger.info('Sent %s: "%s"', description, sent_message.get("text", text))
+                return sent_message
+            if attempt == self.max_retries:
+                break
+            if metrics.ENABLED:
+                RETRIES.inc(reason)
+            logger.warning("Sending %s to chat %s failed (%r), retrying in %s s", description, chat_id, error, delay)
+            await asyncio.sleep(min(delay, MAX_BACKOFF))
+        if metrics.ENABLED:
+            REPLIES.inc("failed", amount=len(replies))
+        logger.error("Gave up sending %s to chat %s after %s attempts", description, chat_id, self.max_retries + 1)
+        return None
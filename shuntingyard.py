@@ -1,16 +1,29 @@
 from numbers import Real
-from collections import deque
+from array import array
+from collections import OrderedDict, namedtuple
 import operator
-import random
 import math
 import re
+import time
 import logging
+import argparse
 import functools
+import contextlib
+import contextvars
+import threading
+from types import MappingProxyType
 
-# import timeout
+import dicebackends
+import tracing
+import metrics
 
-logging.basicConfig(format="%(levelname)-8s (%(asctime)s) %(message)s", level=logging.INFO, datefmt="%d.%m.%y, %H:%M:%S")
+logging.getLogger(__name__).addHandler(logging.NullHandler())
 logger = logging.getLogger(__name__)
+trace = tracing.Tracer(logger)
+
+PHASE_SECONDS = metrics.histogram("dxroll_evaluation_phase_seconds", "Time spent in every phase of evaluating an expression", ["phase"])
+OPERATOR_SECONDS = metrics.histogram("dxroll_operator_seconds", "Time spent applying every operator and function", ["operator"])
+DICE_ROLLED = metrics.counter("dxroll_dice_rolled_total", "Dice rolled, including the dice added by explosions", ["backend"])
 
 
 class UnknownSymbol(Exception):
@@ -53,32 +66,130 @@ class IncorrectArgumentCount(Exception):
     '''Wrong number of arguments passed to the operator'''
 
 
+class RollTooLarge(Exception):
+    '''The expression would roll more dice than an evaluation is allowed to'''
+
+
+class BatchValueError(Exception):
+    '''The number of times to evaluate an expression in a batch was wrong'''
+
+
+RELATIONS = {">": operator.gt, "<": operator.lt, "=": operator.eq}
+
+MAX_DICE = 10 ** 7  # Dice an evaluation may hold at once (a pool kept as face counts holds one entry per face)
+MAX_DRAWS = 10 ** 7  # Random draws an evaluation is expected to make, rerolls and explosions included
+UNLIKELY = 1e-6  # Explosion chains less likely than this are left out of the bounds of a roll
+PACK_THRESHOLD = 8  # Smallest group of rolls moved into the RollLog, smaller ones cost less to keep than to pack
+MAX_BATCH = 100  # Evaluations a batch ("10#1d20; 2d6") may ask for in total
+BATCH_PATTERN = re.compile(r"\s*(\d+)\s*#(.*)", re.DOTALL)
+
+
+class RollLog:
+    '''Append-only log of the dice rolled by one execution of a program
+
+    Groups of rolls kept as lists of ints are stored back to back in one array('i'), a few bytes per die, and
+    referred to by slices of it. Pools the other backends keep as arrays or face counts, and ints too large for the
+    array, are referred to as they are'''
+    __slots__ = ("values",)
+
+    def __init__(self):
+        self.values = array("i")
+
+    def store(self, rolls):
+        '''Returns how to find rolls in the log'''
+        if type(rolls) is list:
+            if not rolls:
+                return _EMPTY
+            try:
+                packed = array("i", rolls)
+            except OverflowError:
+                return rolls
+            start = len(self.values)
+            self.values += packed
+            return slice(start, start + len(packed))
+        return rolls
+
+    def load(self, stored):
+        return self.values[stored].tolist() if type(stored) is slice else stored
+
+
+_EMPTY = slice(0, 0)
+# Log of the program being executed, shared by every roll it makes
+_roll_log = contextvars.ContextVar("roll_log", default=None)
+
+
+class _RollGroup:
+    '''One NdS roll as its modifiers left it. Its rolls stay as the backend returned them while modifiers can still
+    change them, and move into the RollLog once the roll is finished'''
+    __slots__ = ("log", "rolls", "dropped", "dropped_indices", "additional")
+
+    def __init__(self, log, rolls):
+        self.log = log
+        self.rolls, self.dropped, self.dropped_indices, self.additional = rolls, [], [], []
+
+    def seal(self):
+        if type(self.rolls) is list and len(self.rolls) < PACK_THRESHOLD:
+            return
+        store = self.log.store
+        self.rolls, self.dropped = store(self.rolls), store(self.dropped)
+        self.dropped_indices, self.additional = store(self.dropped_indices), store(self.additional)
+
+
+def _join(first, second):
+    '''Groups of two results one after the other, a pair of the two unless either is empty'''
+    if first is None:
+        return second
+    return first if second is None else (first, second)
+
+
+def _flatten(groups):
+    flat, stack = [], [groups]
+    while stack:
+        node = stack.pop()
+        if type(node) is tuple:
+            stack += (node[1], node[0])
+        elif node is not None:
+            flat.append(node)
+    return flat
+
+
 class RolledDice:
-    '''Class that simulates a dice roll and holds all the information about it to allow arithmetics'''
+    '''Class that simulates a dice roll and holds all the information about it to allow arithmetics
+
+    The groups of rolls of a result form a tree that combining results joins in O(1), the rolls themselves live in
+    a RollLog and are only turned into lists when read through rolls, dropped_rolls, dropped_indices and
+    additional_rolls'''
+    __slots__ = ("__number", "__sides", "backend", "sum", "finished", "_group", "_groups")
+
     def __init__(self, number, sides):
-        logger.debug("Created %s(number=%s, sides=%s) instance", type(self).__name__, number, sides)
-        self.rolls, self.dropped_rolls, self.additional_rolls = [], [], []
+        trace("Created %s(number=%s, sides=%s) instance", type(self).__name__, number, sides)
+        log, self._groups = _roll_log.get(), None
         if (isinstance(number, RolledDice)):
-            self.rolls += number.rolls
-            self.dropped_rolls += number.dropped_rolls
-            self.additional_rolls += number.additional_rolls
+            number.finish()
+            self._groups = number._groups
+            log = log or number._group.log
         self.__number = round(number)
         if (isinstance(sides, RolledDice)):
-            self.rolls += sides.rolls
-            self.dropped_rolls += sides.dropped_rolls
-            self.additional_rolls += sides.additional_rolls
+            sides.finish()
+            self._groups = _join(self._groups, sides._groups)
+            log = log or sides._group.log
         self.__sides = sides
         if self.sides != "F":
             self.__sides = round(sides)
         if (self.sides != "F" and self.sides < 0):
-            logger.debug("Raised NegativeRollMeasurements exception, sides = %s", self.sides)
+            trace("Raised NegativeRollMeasurements exception, sides = %s", self.sides)
             raise NegativeRollMeasurements(f"Cannot roll dice with negative number of sides: {self.sides}")
         if (self.number < 0):
-            logger.debug("Raised NegativeRollMeasurements exception, number of dice = %s", self.number)
+            trace("Raised NegativeRollMeasurements exception, number of dice = %s", self.number)
             raise NegativeRollMeasurements(f"Cannot roll negative number of dice: {self.number}")
-        self.sum = self._roll_dice()
+        if (self.sides != "F" and self.sides < 1 and self.number > 0):
+            trace("Raised NegativeRollMeasurements exception, sides = %s", self.sides)
+            raise NegativeRollMeasurements(f"Cannot roll dice with {self.sides} sides")
+        self.backend = dicebackends.select_backend(self.number, self.faces[1] - self.faces[0] + 1)
+        self.sum = self._roll_dice(log or RollLog())
         self.finished = False
-        logger.debug("Initialized %s(number=%s, sides=%s, rolls=%s, sum=%s) instance", type(self).__name__, self.number, self.sides, self.rolls, self.sum)
+        if trace:
+            trace("Initialized %s(number=%s, sides=%s, rolls=%s, sum=%s) instance", type(self).__name__, self.number, self.sides, tracing.Short(self.rolls), self.sum)
 
     @property
     def number(self):
@@ -91,26 +202,59 @@ class RolledDice:
 #    def __repr__(self):
 #        return f"{type(self).__name__}({self.number}, " + repr(self.sides) + f", {self.rolls}, {self.dropped_rolls}, {self.additional_rolls}, {self.sum})"
 
+    @property
+    def faces(self):
+        '''Lowest and highest value of a single die'''
+        return (-1, 1) if self.sides == "F" else (1, self.sides)
+
+    @property
+    def rolls(self):
+        '''Rolls of every group, in the order the groups were rolled'''
+        return [group.log.load(group.rolls) for group in _flatten(self._groups)]
+
+    @property
+    def dropped_rolls(self):
+        return [group.log.load(group.dropped) for group in _flatten(self._groups)]
+
+    @property
+    def dropped_indices(self):
+        '''Positions of dropped dice in the pool the keep/drop modifier was applied to, for every group'''
+        return [group.log.load(group.dropped_indices) for group in _flatten(self._groups)]
+
+    @property
+    def additional_rolls(self):
+        return [group.log.load(group.additional) for group in _flatten(self._groups)]
+
     def __str__(self):
         return f"{self.number}d{self.sides}({self.sum})"
 
-    def _roll_dice(self):
-        self.rolls.append([])
-        self.dropped_rolls.append([])
-        self.additional_rolls.append([])
-        if self.sides == "F":
-            self.rolls[-1] = [random.randint(-1, 1) for i in range(self.number)]
-        else:
-            self.rolls[-1] = [random.randint(1, self.sides) for i in range(self.number)]
-        result = sum(self.rolls[-1])
-        return result
+    def _roll_dice(self, log):
+        if metrics.ENABLED:
+            DICE_ROLLED.inc(self.backend.name, amount=self.number)
+        rolls = self.backend.roll(self.number, *self.faces)
+        self._group = _RollGroup(log, rolls)
+        self._groups = _join(self._groups, self._group)
+        return self.backend.total(rolls)
+
+    def _current(self):
+        '''Rolls of the group this roll made, which roll modifiers apply to (so it isn't sealed yet)'''
+        return self._group.rolls
+
+    def _replace_rolls(self, old_rolls, new_rolls):
+        self.sum += self.backend.total(new_rolls) - self.backend.total(old_rolls)
+        self._group.rolls = new_rolls
+
+    def finish(self):
+        '''Marks the roll as used by an operator, so roll modifiers can't be applied to it anymore'''
+        if not self.finished:
+            self.finished = True
+            self._group.seal()
 
     def _operators(oper):
         def _add_lists(me, other):
             if(isinstance(other, RolledDice)):
-                me.rolls += other.rolls
-                me.dropped_rolls += other.dropped_rolls
-                me.additional_rolls += other.additional_rolls
+                other.finish()
+                me._groups = _join(me._groups, other._groups)
 
         def forward(me, other):
             if(isinstance(other, Real)):
@@ -166,100 +310,73 @@ class RolledDice:
 
     @staticmethod
     def keep(roll, number, *, highest=True):
-        logger.debug("Trying to keep %s highest (%s) rolls for %s", int(number), highest, roll)
+        trace("Trying to keep %s highest (%s) rolls for %s", number, highest, roll)
         try:
             number = int(number)
         except ValueError:
-            logger.debug("Raised KeepValueError: couldn't convert %s to int", number)
+            trace("Raised KeepValueError: couldn't convert %s to int", number)
             raise KeepValueError(f"Number of dice to keep/drop ({number}) has to be a number")
-        if ((0 > number) or (number > len(roll.rolls[-1]))):
-            logger.debug("Raised KeepValueError for trying to keep (%s) rolls out of (%s)", number, len(roll.rolls[0]))
-            raise KeepValueError(f"Number of dice to keep/drop ({number}) has to be positive and less than number of rolls ({len(roll.rolls[0])})")
+        rolls = roll._current()
+        if ((0 > number) or (number > len(rolls))):
+            trace("Raised KeepValueError for trying to keep (%s) rolls out of (%s)", number, len(rolls))
+            raise KeepValueError(f"Number of dice to keep/drop ({number}) has to be positive and less than number of rolls ({len(rolls)})")
         else:
-            logger.debug("Rolls before dropping: %s", roll.rolls)
-            to_remove = roll.rolls[-1]
-            to_remove.sort()
-            if highest:
-                to_remove = to_remove[:len(roll.rolls[-1]) - number]
-            else:
-                to_remove = to_remove[number:]
-            for element in to_remove:
-                roll.dropped_rolls[-1].append(element)
-                roll.rolls[-1].remove(element)
-                roll.sum -= element
-            logger.debug("Rolls after dropping: %s", roll.rolls)
-        logger.debug("Result of keeping: %s", roll)
+            trace("Rolls before dropping: %s", tracing.Short(rolls))
+            kept, dropped, dropped_indices = roll.backend.keep(rolls, number, highest)
+            roll._replace_rolls(rolls, kept)
+            group = roll._group
+            group.dropped = roll.backend.concatenate(group.dropped, dropped)
+            group.dropped_indices = roll.backend.concatenate(group.dropped_indices, dropped_indices)
+            trace("Rolls after dropping: %s", tracing.Short(kept))
+        trace("Result of keeping: %s", roll)
         return roll
 
     @staticmethod
     def reroll(roll, target, *, relation, once=False):
-        def reroll_die(sides):
-            if sides == "F":
-                return random.randint(-1, 1)
-            else:
-                return random.randint(1, sides)
-
-        logger.debug("Rerolling all dice in %s that are %s%s, once (%s)", roll, relation, target, once)
+        trace("Rerolling all dice in %s that are %s%s, once (%s)", roll, relation, target, once)
         try:
             target = int(target)
         except ValueError:
-            logger.debug("Raised RerollValueError: couldn't convert %s to int", target)
+            trace("Raised RerollValueError: couldn't convert %s to int", target)
             raise RerollValueError(f"Number of dice to reroll ({str(target)}) has to be a number")
-        logger.debug("Rolls before rerolling: %s", roll.rolls)
-        relations = {">": operator.gt, "<": operator.lt, "=": operator.eq}
-        new_rolls = []
-        for value in roll.rolls[-1]:
-            while relations[relation](value, target):
-                value = reroll_die(roll.sides)
-                if once is True:
-                    break
-            new_rolls.append(value)
-        roll.rolls[-1] = new_rolls
-        logger.debug("Rolls after rerolling: %s\nResult of reroll: %s", roll.rolls[-1], roll)
+        rolls = roll._current()
+        trace("Rolls before rerolling: %s", tracing.Short(rolls))
+        new_rolls = roll.backend.reroll(rolls, *roll.faces, RELATIONS[relation], target, once)
+        roll._replace_rolls(rolls, new_rolls)
+        trace("Rolls after rerolling: %s\nResult of reroll: %s", tracing.Short(new_rolls), roll)
         return roll
 
     @staticmethod
     def explode(roll, target, *, relation, special=None):
-        def roll_die(sides):
-            if sides == "F":
-                return random.randint(-1, 1)
-            else:
-                return random.randint(1, sides)
-
-        logger.debug("Exploding dice for %s, target is %s%s, special modifier is %s", roll, relation, target, special)
+        trace("Exploding dice for %s, target is %s%s, special modifier is %s", roll, relation, target, special)
         try:
-            if target != "F":
-                target = int(target)
+            if target == "F":
+                target = roll.faces[1]
+            target = int(target)
         except ValueError:
-            logger.debug("Raised ExplodeValueError: couldn't convert %s to int", target)
+            trace("Raised ExplodeValueError: couldn't convert %s to int", target)
             raise ExplodeValueError(f"Target number for exploding dice ({str(target)}) has to be a number (or 'F' for Fate dice)")
-        logger.debug("Rolls before exploding: %s", roll.rolls)
-        relations = {">": operator.gt, "<": operator.lt, "=": operator.eq}
+        rolls = roll._current()
+        trace("Rolls before exploding: %s", tracing.Short(rolls))
         if special == "Compounding":
-            new_rolls = []
-            for value in roll.rolls[-1]:
-                new_value = new_roll = value
-                while relations[relation](new_roll, target):
-                    new_roll = roll_die(roll.sides)
-                    new_value += new_roll
-                new_rolls.append(new_value)
-                roll.additional_rolls[-1].append(new_value - value)
-            roll.rolls[-1] = new_rolls
-        elif special is None:
-            for value in roll.rolls[-1]:
-                if relations[relation](value, target):
-                    roll.additional_rolls[-1].append(roll_die(roll.sides))
-                    roll.rolls[-1].append(roll_die(roll.sides))
-        logger.debug("Rolls after exploding: %s\nResult of exploding: %s", roll.rolls[-1], roll)
+            new_rolls, additional = roll.backend.explode_compounding(rolls, *roll.faces, RELATIONS[relation], target)
+        else:
+            new_rolls, additional = roll.backend.explode(rolls, *roll.faces, RELATIONS[relation], target)
+        if metrics.ENABLED:
+            DICE_ROLLED.inc(roll.backend.name, amount=len(additional) if special != "Compounding" else 0)
+        roll._replace_rolls(rolls, new_rolls)
+        group = roll._group
+        group.additional = roll.backend.concatenate(group.additional, additional)
+        trace("Rolls after exploding: %s\nResult of exploding: %s", tracing.Short(new_rolls), roll)
         return roll
 
 
 def drop_highest(roll, number):
-    return keep_lowest(roll, len(roll.rolls[0]) - number)
+    return keep_lowest(roll, len(roll._current()) - number)
 
 
 def drop_lowest(roll, number):
-    return keep_highest(roll, len(roll.rolls[0]) - number)
+    return keep_highest(roll, len(roll._current()) - number)
 
 
 def explode(roll, new_special=None):
@@ -286,10 +403,11 @@ explode_compounding_less = functools.partial(explode_less, special="Compounding"
 
 
 class Operator:
-    def __init__(self, function, priority=0, operands=2):
+    def __init__(self, function, priority=0, operands=2, pure=True):
         self.operands = operands
         self.priority = priority
         self.function = function
+        self.pure = pure
 
     def operation(self, args):
         if len(tuple(args)) != self.operands:
@@ -298,206 +416,687 @@ class Operator:
         return self.function(*args)
 
 
-class ExpressionEvaluation:
-    '''Shunting Yard algorithm'''
-    def __init__(self, expression):
-        logger.info("Initializing evaluation of expression '%s'", expression)
-        self.functions = {"floor": math.floor,
-                          "ceil": math.ceil,
-                          "abs": abs,
-                          "round": round }
-
-        self.operators = {"+": Operator(operator.add, priority=1, operands=2),
-                          "-": Operator(operator.sub, priority=1, operands=2),
-                          "*": Operator(operator.mul, priority=2, operands=2),
-                          "/": Operator(operator.truediv, priority=2, operands=2),
-                          "%": Operator(operator.mod, priority=2, operands=2),
-                          "^": Operator(operator.pow, priority=3, operands=2),
-                          "d": Operator(RolledDice, priority=5, operands=2),
-                          "_": Operator(operator.neg, priority=10, operands=1) }
-
-        self.roll_modifiers = {"k": Operator(keep_highest, priority=4, operands=2),
-                               "kh": Operator(keep_highest, priority=4, operands=2),
-                               "kl": Operator(keep_lowest, priority=4, operands=2),
-                               "dh": Operator(drop_highest, priority=4, operands=2),
-                               "dl": Operator(drop_lowest, priority=4, operands=2),
-                               "r": Operator(reroll_equal, priority=4, operands=2),
-                               "r=": Operator(reroll_equal, priority=4, operands=2),
-                               "r>": Operator(reroll_more, priority=4, operands=2),
-                               "r<": Operator(reroll_less, priority=4, operands=2),
-                               "ro": Operator(reroll_once_equal, priority=4, operands=2),
-                               "ro=": Operator(reroll_once_equal, priority=4, operands=2),
-                               "ro>": Operator(reroll_once_more, priority=4, operands=2),
-                               "ro<": Operator(reroll_once_less, priority=4, operands=2),
-                               "!": Operator(explode, priority=4, operands=1),
-                               "!=": Operator(explode_equal, priority=4, operands=2),
-                               "!>": Operator(explode_more, priority=4, operands=2),
-                               "!<": Operator(explode_less, priority=4, operands=2),
-                               "!!": Operator(explode_compounding, priority=4, operands=1),
-                               "!!=": Operator(explode_compounding_equal, priority=4, operands=2),
-                               "!!>": Operator(explode_compounding_more, priority=4, operands=2),
-                               "!!<": Operator(explode_compounding_less, priority=4, operands=2) }
-
-        for oper in self.roll_modifiers:
-            self.operators[oper] = self.roll_modifiers[oper]
-        self.result = None
-        # seconds_to_timeout = 1
-        try:
-            # self.result = timeout.evaluate(seconds_to_timeout, self._evaluate, expression)
-            self.result = self._evaluate(expression)
-            logger.info("The result of evaluation: %s", self.result)
-            if isinstance(self.result, RolledDice):
-                logger.info("Rolls made: %s", self.result.rolls)
-                if self.result.dropped_rolls != [[]]:
-                    logger.info("Rolls dropped: %s", self.result.dropped_rolls)
-                if self.result.additional_rolls != [[]]:
-                    logger.info("Additional rolls made: %s", self.result.additional_rolls)
-        except Exception as e:
-            logger.info("Raised exception %r for expression '%s'", e, expression)
-            raise e
+PUSH, OPERATOR, FUNCTION = "push", "operator", "function"
 
-    def _is_operand(self, token):
-        if token == "F":
-            return True
-        try:
-            float(token)
-            return True
-        except ValueError:
-            return False
 
-    def _peek(self, stack):
-        return stack[-1] if stack else None
+class Program:
+    '''Expression compiled to reverse Polish notation that can be executed any number of times'''
+    def __init__(self, source, instructions, grammar):
+        self.source = source
+        self.instructions = tuple(instructions)
+        self.grammar = grammar
+        self.__cost = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.source!r}, {list(self.instructions)})"
+
+    def __reduce__(self):
+        # The cost estimate is left behind, it's made again when needed
+        return type(self), (self.source, self.instructions, self.grammar)
 
     def _roll_modifier_legality(self, oper, value):
-        if oper in self.roll_modifiers:
+        if oper in self.grammar.roll_modifiers:
             if not isinstance(value, RolledDice) or value.finished is True:
-                logger.debug("Raised RollModifierMisuse exception while applying roll modifier '%s' to non-roll value '%s'", oper, value)
+                trace("Raised RollModifierMisuse exception while applying roll modifier '%s' to non-roll value '%s'", oper, value)
                 raise RollModifierMisuse(f"Tried to apply roll modifier to something that is not a roll: {value}")
         elif isinstance(value, RolledDice):
-            value.finished = True
-            logger.debug("Changed 'finished' attribute of %s to %s", value, value.finished)
-
-    def _apply_operator(self, operators, values):
-        oper = operators.pop()
-        if oper not in self.operators:
-            logger.error("Trying to apply unknown operator '%s'", oper)
-            raise ValueError(f"Unknown operator: {oper}")
-        args = []
-        for i in range(self.operators[oper].operands):
-            if (self._peek(values) is None):
-                logger.debug("Raised StackIsEmpty exception for values while applying operator '%s', stack: %s", oper, values)
-                raise StackIsEmpty(oper)
-            args.append(values.pop())
-        self._roll_modifier_legality(oper, args[-1])
-        args.reverse()
-        logger.debug("Applying operator '%s' to values %s", oper, args)
-        values.append(self.operators[oper].operation(args))
-
-    def _apply_function(self, operators, values):
-        function = operators.pop()
+            value.finish()
+            trace("Changed 'finished' attribute of %s to %s", value, value.finished)
+
+    def _apply_operator(self, oper, values):
+        operands = self.grammar.operators[oper].operands
+        args = values[-operands:]
+        del values[-operands:]
+        self._roll_modifier_legality(oper, args[0])
+        trace("Applying operator '%s' to values %s", oper, tracing.Short(args))
+        values.append(self.grammar.operators[oper].operation(args))
+
+    def _apply_function(self, function, values):
         arg = values.pop()
-        logger.debug("Applying function '%s' to argument %s", function, arg)
-        values.append(self.functions[function](arg))
+        trace("Applying function '%s' to argument %s", function, arg)
+        values.append(self.grammar.functions[function](arg))
 
-    def _greater_precedence(self, op1, op2):
-        return self.operators[op1].priority >= self.operators[op2].priority
+    @property
+    def cost(self):
+        '''Static CostEstimate of the program, made once since programs are cached and shared'''
+        if self.__cost is None:
+            self.__cost = CostEstimate(self)
+        return self.__cost
+
+    def execute(self):
+        values = []
+        timed = metrics.ENABLED
+        log = _roll_log.set(RollLog())
+        try:
+            for kind, token in self.instructions:
+                if kind == PUSH:
+                    values.append(token)
+                    continue
+                start = time.perf_counter() if timed else 0
+                if kind == OPERATOR:
+                    self._apply_operator(token, values)
+                else:
+                    self._apply_function(token, values)
+                if timed:
+                    OPERATOR_SECONDS.observe(time.perf_counter() - start, token)
+        finally:
+            _roll_log.reset(log)
+        return values[0]
 
-    def _preprocess_expression(self, expression):
-        expression = re.compile("\s").sub("", expression)
-        expression = re.compile("\*\*").sub("^", expression)
-        expression = re.compile("d%").sub("d100", expression)
-        if "_" in expression:
-            raise UnknownSymbol("_")
-        expression = re.compile("((?=[^)0-9F]).|\A)\-").sub(r"\1_", expression)  # Change unary minus to _
-        logger.debug("Preprocessed expression: %s", expression)
-        return expression
-
-    def _divide_expression(self, expression):
-        func_tokens, op_tokens, tokens = '(', '(', []
-        for function in self.functions:
-            func_tokens += function + '|'
-        func_tokens = func_tokens[:-1] + ')'
-        func_tokens = re.split(func_tokens, expression)
-        for oper in self.operators:
-            if oper in '.^$*+?{}[]|-\\':
-                oper = '\\' + str(oper)
-            elif oper == "d":
-                oper = "d(?=[0-9(F])"
-            elif oper == "!" or oper == "!!":
-                oper += "(?![!><=p])"
+
+# Bounds of a value on the stack of CostEstimate. pool is a _Pool while roll modifiers can still be applied to it
+_Bounds = namedtuple("_Bounds", ["low", "high", "pool"])
+# Expected number of dice in the last group of a roll, (lowest, highest) faces it may have and whether it's counted
+_Pool = namedtuple("_Pool", ["number", "faces", "counted"])
+_UNBOUNDED = _Bounds(-math.inf, math.inf, None)
+
+
+def _corners(function, first, second):
+    '''Bounds of function over two intervals, for functions that are monotonic in both arguments'''
+    try:
+        results = [function(a, b) for a in (first.low, first.high) for b in (second.low, second.high)]
+        if any(math.isnan(result) for result in results):
+            return _UNBOUNDED
+        return _Bounds(min(results), max(results), None)
+    except (ArithmeticError, ValueError, TypeError):
+        return _UNBOUNDED
+
+
+def _divide(first, second):
+    if second.low <= 0 <= second.high:
+        return _UNBOUNDED
+    return _corners(operator.truediv, first, second)
+
+
+def _modulo(first, second):
+    if second.low > 0:
+        return _Bounds(0, second.high, None)
+    if second.high < 0:
+        return _Bounds(second.low, 0, None)
+    return _UNBOUNDED
+
+
+def _monotonic(function):
+    def bounds(value):
+        try:
+            return _Bounds(function(value.low), function(value.high), None)
+        except (ArithmeticError, ValueError):
+            return _Bounds(value.low, value.high, None)
+    return bounds
+
+
+def _absolute(value):
+    if value.low >= 0:
+        return _Bounds(value.low, value.high, None)
+    if value.high <= 0:
+        return _Bounds(-value.high, -value.low, None)
+    return _Bounds(0, max(-value.low, value.high), None)
+
+
+def _matching(relation, target, low, high):
+    '''Largest number of faces low..high that match the relation for some target within its bounds'''
+    if relation == ">":
+        return max(0, high - int(max(min(target.low, high), low - 1)))
+    if relation == "<":
+        return max(0, int(min(max(target.high, low), high + 1)) - low)
+    return 1 if max(low, target.low) <= min(high, target.high) else 0
+
+
+def _describe_target(relation, target):
+    if target.low == target.high:
+        return f"{relation}{target.low:g}"
+    return f"{relation}{target.low:g}..{target.high:g}"
+
+
+class CostEstimate:
+    '''Static estimate of the dice an expression rolls, made from its program before anything is rolled
+
+    Every value is tracked as bounds and rolls also keep the expected number of their dice, so dice holds the number
+    of dice the result will keep and draws the number of random draws expected to make it. listed is the number of
+    dice rolled if none of them were counted by face, as simulations roll them. Rerolls and explosions that can never
+    stop raise the same exceptions their roll modifiers would for a bad target'''
+    def __init__(self, program):
+        self.dice = self.draws = self.listed = 0
+        operators = {operator.add: functools.partial(_corners, operator.add),
+                     operator.sub: functools.partial(_corners, operator.sub),
+                     operator.mul: functools.partial(_corners, operator.mul),
+                     operator.pow: functools.partial(_corners, operator.pow),
+                     operator.truediv: _divide,
+                     operator.mod: _modulo,
+                     operator.neg: lambda value: _Bounds(-value.high, -value.low, None),
+                     RolledDice: self._roll,
+                     keep_highest: self._keep, keep_lowest: self._keep,
+                     drop_highest: self._keep, drop_lowest: self._keep}
+        for function, relation in ((reroll_equal, "="), (reroll_more, ">"), (reroll_less, "<")):
+            operators[function] = functools.partial(self._reroll, relation=relation, once=False)
+        for function, relation in ((reroll_once_equal, "="), (reroll_once_more, ">"), (reroll_once_less, "<")):
+            operators[function] = functools.partial(self._reroll, relation=relation, once=True)
+        operators[explode] = functools.partial(self._explode, target=None, relation="=", compounding=False)
+        operators[explode_compounding] = functools.partial(self._explode, target=None, relation="=", compounding=True)
+        for relation, plain, compounding in (("=", explode_equal, explode_compounding_equal),
+                                             (">", explode_more, explode_compounding_more),
+                                             ("<", explode_less, explode_compounding_less)):
+            operators[plain] = functools.partial(self._explode, relation=relation, compounding=False)
+            operators[compounding] = functools.partial(self._explode, relation=relation, compounding=True)
+        functions = {math.floor: _monotonic(math.floor), math.ceil: _monotonic(math.ceil),
+                     round: _monotonic(round), abs: _absolute}
+        values = []
+        for kind, token in program.instructions:
+            if kind == PUSH:
+                values.append(token if token == "F" else _Bounds(token, token, None))
+            elif kind == OPERATOR:
+                oper = program.grammar.operators[token]
+                args = values[-oper.operands:]
+                del values[-oper.operands:]
+                bounds = operators.get(oper.function)
+                values.append(bounds(*args) if bounds and "F" not in args[:1] else _UNBOUNDED)
             else:
-                for oper2 in self.operators:
-                    if oper in oper2 and oper != oper2 and self.operators[oper].operands > 1:
-                        oper += "(?=[0-9(])"
-            op_tokens += oper + "|"
-        op_tokens = op_tokens[:-1] + "|\(|\))"
-        for token in func_tokens:
-            if token not in self.functions:
-                token = re.split(op_tokens, token)
-            if (isinstance(token, list)):
-                tokens += [tok for tok in token if tok]
+                bounds = functions.get(program.grammar.functions[token])
+                values.append(bounds(values.pop()) if bounds else _UNBOUNDED)
+        self.bounds = values[0] if values else _UNBOUNDED
+        trace("Estimated cost of %s: %s dice, %s draws", program.source, self.dice, self.draws)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(dice={self.dice:g}, draws={self.draws:g})"
+
+    @staticmethod
+    def _count(value):
+        '''Finite upper bound of a number of dice or sides, 0 when it can't be told'''
+        return max(0, round(value)) if math.isfinite(value) else 0
+
+    def _roll(self, number, sides):
+        if sides != "F" and math.isfinite(sides.high) and round(sides.high) < 1 and self._count(number.low) > 0:
+            # There's no face to draw, RolledDice refuses them too
+            raise NegativeRollMeasurements(f"Cannot roll dice with {round(sides.high)} sides")
+        if sides == "F":
+            faces = ((-1, 1),)
+        else:
+            faces = tuple({(1, self._count(sides.low)), (1, self._count(sides.high) or self._count(sides.low))})
+        low, high = min(face[0] for face in faces), max(face[1] for face in faces)
+        most, least = self._count(number.high), self._count(number.low)
+        counted = dicebackends.select_backend(most, high - low + 1) is dicebackends.COUNTED_DICE
+        self.dice += min(most, high - low + 1) if counted else most
+        self.draws += high - low + 1 if counted and dicebackends.numpy is not None else most
+        self.listed += most
+        totals = (least * low, least * high, most * low, most * high)
+        return _Bounds(min(totals), max(totals), _Pool(most, faces, counted))
+
+    def _keep(self, roll, number):
+        if roll == "F" or roll.pool is None:
+            return _UNBOUNDED
+        return _Bounds(min(0, roll.low), max(0, roll.high), roll.pool)
+
+    def _probability(self, pool, relation, target):
+        '''Highest chance that a die of the pool matches, target None stands for the highest face'''
+        return max(_matching(relation, target or _Bounds(high, high, None), low, high) / (high - low + 1)
+                   for low, high in pool.faces if high >= low)
+
+    def _reroll(self, roll, target, *, relation, once):
+        if roll == "F" or roll.pool is None or target == "F":
+            return _UNBOUNDED if roll == "F" else roll
+        pool = roll.pool
+        probability = self._probability(pool, relation, target)
+        if probability >= 1 and not once:
+            raise RerollValueError(f"Rerolling dice that are {_describe_target(relation, target)} would never stop")
+        faces = max(high - low + 1 for low, high in pool.faces)
+        if pool.counted and dicebackends.numpy is not None:
+            self.draws += faces
+        else:
+            self.draws += pool.number * (probability if once else probability / (1 - probability))
+        return roll
+
+    def _explode(self, roll, target=None, *, relation, compounding):
+        if roll == "F" or roll.pool is None:
+            return _UNBOUNDED if roll == "F" else roll
+        if target == "F":
+            target = None
+        pool = roll.pool
+        probability = self._probability(pool, relation, target)
+        if probability >= 1:
+            highest = max(high for low, high in pool.faces)
+            raise ExplodeValueError(f"Exploding dice that are {_describe_target(relation, target or _Bounds(highest, highest, None))} would never stop")
+        extra = probability / (1 - probability)
+        # Longest chain of explosions that isn't too unlikely to happen
+        chain = math.ceil(math.log(UNLIKELY) / math.log(probability)) if probability else 0
+        faces = max(high - low + 1 for low, high in pool.faces)
+        if pool.counted:
+            self.dice += faces * (chain if compounding else 1)
+            self.draws += faces * chain if dicebackends.numpy is not None else pool.number * extra
+        else:
+            self.dice += 0 if compounding else pool.number * extra
+            self.draws += pool.number * extra
+        number = pool.number if compounding else pool.number * (1 + extra)
+        return _Bounds(min(roll.low, roll.low * (chain + 1)), max(roll.high, roll.high * (chain + 1)),
+                       pool._replace(number=number))
+
+    def check(self, max_dice=MAX_DICE, max_draws=MAX_DRAWS, times=1):
+        '''Raises RollTooLarge if evaluating the expression times times would hold or draw more dice than allowed'''
+        dice, draws = self.dice * times, self.draws * times
+        if dice > max_dice:
+            raise RollTooLarge(f"The expression would roll about {dice:.3g} dice, at most {max_dice} are allowed")
+        if draws > max_draws:
+            raise RollTooLarge(f"The expression would need about {draws:.3g} rolls with rerolls and explosions, at most {max_draws} are allowed")
+
+
+# Kinds of tokens besides OPERATOR and FUNCTION
+NUMBER, LEFT, RIGHT = "number", "(", ")"
+DIGITS = "0123456789"
+# Spellings of operators that aren't their names in the operator table
+ALIASES = {"**": "^"}
+
+
+def _source_position(source, index):
+    '''Position in source of the character at index of the source without its whitespace, counted from 1'''
+    for position, character in enumerate(source):
+        if not character.isspace():
+            if index == 0:
+                return position + 1
+            index -= 1
+    return len(source) + 1
+
+
+class Grammar:
+    '''Immutable tables of functions and operators with the token pattern built from them, shared by all evaluations'''
+    def __init__(self, functions, operators, roll_modifiers):
+        self.__functions = MappingProxyType(dict(functions))
+        self.__roll_modifiers = MappingProxyType(dict(roll_modifiers))
+        self.__operators = MappingProxyType({**operators, **roll_modifiers})
+        tokens = self._tokens()
+        self.__kinds = {text: (kind, value) for text, (kind, value, _) in tokens.items()}
+        self.__token_pattern = self._build_pattern(tokens)
+
+    @property
+    def functions(self):
+        return self.__functions
+
+    @property
+    def operators(self):
+        return self.__operators
+
+    @property
+    def roll_modifiers(self):
+        return self.__roll_modifiers
+
+    def __reduce__(self):
+        # Its tables hold functions and lambdas, so the grammar is pickled by name. Only GRAMMAR can be
+        return "GRAMMAR"
+
+    def _guard(self, oper):
+        '''(characters, allowed): what oper has to be followed by (or must not be) to be a token
+
+        Operators that are the start of a longer one only count when an operand follows, so "k3" isn't read as the
+        start of "kh3". d also takes Fate dice and d%, and a bare ! mustn't be the start of another modifier'''
+        if oper == "d":
+            return DIGITS + "(F%", True
+        if oper in ("!", "!!"):
+            return "!><=p", False
+        if self.operators[oper].operands > 1 and any(oper in other and oper != other for other in self.operators):
+            return DIGITS + "(", True
+        return None
+
+    def _tokens(self):
+        '''{text: (kind, value, guard)} of the operators, functions and brackets
+
+        The unary minus "_" is only made by the tokenizer, so it isn't one of them'''
+        tokens = {"(": (LEFT, "(", None), ")": (RIGHT, ")", None)}
+        tokens.update((function, (FUNCTION, function, None)) for function in self.functions)
+        tokens.update((oper, (OPERATOR, oper, self._guard(oper))) for oper in self.operators if oper != "_")
+        tokens.update((alias, (OPERATOR, oper, None)) for alias, oper in ALIASES.items() if oper in self.operators)
+        return tokens
+
+    def _build_pattern(self, tokens):
+        '''Pattern of every token, longest first, capturing it so splitting an expression by it keeps the tokens
+
+        A guard becomes a lookahead. d% is matched along with the digits after it, which are read as the rest of its
+        number like they always were'''
+        alternatives = []
+        for text in sorted(tokens, key=len, reverse=True):
+            guard = tokens[text][2]
+            lookahead = "" if guard is None else ("(?=[{}])" if guard[1] else "(?![{}])").format(re.escape(guard[0]))
+            alternatives.append(re.escape(text) + lookahead)
+        if "d" in self.operators:
+            starts = "".join(sorted({text[0] for text in tokens}))
+            alternatives.insert(0, "d%[^" + re.escape(starts) + "]*")
+        return re.compile("(" + "|".join(alternatives) + ")")
+
+    def compact(self, expression):
+        '''The expression without its whitespace, which never matters. It's what tokenize splits'''
+        return "".join(expression.split())
+
+    def preprocess(self, expression):
+        '''Normalized expression, which programs are cached by: without whitespace, and with ** and d% spelled ^ and
+        d100, so expressions that differ only in these share a program'''
+        return self.compact(expression).replace("**", "^").replace("d%", "d100")
+
+    def _operand(self, text, position, source):
+        if text == "F":
+            return (NUMBER, text, position)
+        try:
+            if "_" in text:
+                raise ValueError(text)
+            return (NUMBER, float(text), position)
+        except ValueError:
+            trace("Raised UnknownSymbol('%s') exception", text)
+            raise UnknownSymbol(f"'{text}' at position {_source_position(source, position)}") from None
+
+    def tokenize(self, expression, source=None, tokens=(), position=0):
+        '''Splits a compact expression into (kind, value, position) tokens
+
+        The token pattern splits it in a single pass, taking the longest operator, function or bracket at every
+        position, and the text between them is an operand. A minus is unary (the operator "_") unless it follows an
+        operand or a closing bracket. Positions are indices in expression, errors count them in source (the
+        expression as given, whitespace included). The split may resume at position after the tokens already split
+        from the expression before it'''
+        source = expression if source is None else source
+        kinds, operand = self.__kinds, self._operand
+        tokens = list(tokens)
+        append = tokens.append
+        # Operand text and tokens alternate, the text between two adjacent tokens being empty
+        pieces = self.__token_pattern.split(expression[position:])
+        texts = iter(pieces)
+        for text, piece in zip(texts, texts):
+            if text:
+                if text.isdecimal():
+                    # Most operands are plain numbers, the others are checked by _operand
+                    append((NUMBER, float(text), position))
+                else:
+                    append(operand(text, position, source))
+                position += len(text)
+            found = kinds.get(piece)
+            if found is None:
+                # d% is d100, its number is placed at the %
+                append((OPERATOR, "d", position))
+                append(operand("100" + piece[2:], position + 1, source))
+            elif found[1] == "-" and (not tokens or tokens[-1][0] not in (NUMBER, RIGHT)):
+                append((OPERATOR, "_", position))
             else:
-                tokens.append(token)
-        logger.debug("Divided expression: %s", tokens)
+                append((found[0], found[1], position))
+            position += len(piece)
+        if pieces[-1]:
+            append(operand(pieces[-1], position, source))
+        if trace:
+            trace("Divided expression: %s", tracing.Short([token[1] for token in tokens]))
         return tokens
 
-    def _evaluate(self, expression):
-        expression = self._preprocess_expression(expression)
-        tokens = self._divide_expression(expression)
-        values, operators = deque(), deque()
+    def _greater_precedence(self, op1, op2):
+        return self.operators[op1].priority >= self.operators[op2].priority
+
+    def _emit_operator(self, oper, values):
+        '''Pops operands of oper from the stack of (constant, instructions) pairs, folding it if all of them are constant'''
+        if oper not in self.operators:
+            logger.error("Trying to apply unknown operator '%s'", oper)
+            raise ValueError(f"Unknown operator: {oper}")
+        operands = self.operators[oper].operands
+        if len(values) < operands:
+            trace("Raised StackIsEmpty exception for values while applying operator '%s', stack: %s", oper, tracing.Short(values))
+            raise StackIsEmpty(oper)
+        args = values[-operands:]
+        del values[-operands:]
+        if self.operators[oper].pure and all(isinstance(constant, Real) for constant, _ in args):
+            constant = self.operators[oper].operation([constant for constant, _ in args])
+            values.append((constant, [(PUSH, constant)]))
+            trace("Folded operator '%s' into constant %s", oper, constant)
+        else:
+            instructions = [instruction for _, fragment in args for instruction in fragment]
+            instructions.append((OPERATOR, oper))
+            values.append((None, instructions))
+
+    def _emit_function(self, function, values):
+        if not values:
+            trace("Raised StackIsEmpty exception for values while applying function '%s'", function)
+            raise StackIsEmpty(function)
+        constant, fragment = values.pop()
+        if isinstance(constant, Real):
+            constant = self.functions[function](constant)
+            values.append((constant, [(PUSH, constant)]))
+            trace("Folded function '%s' into constant %s", function, constant)
+        else:
+            values.append((None, fragment + [(FUNCTION, function)]))
+
+    def compile(self, expression, tokens=None):
+        '''Shunting Yard algorithm over the tokens of the expression, split from it here unless they're given'''
+        with PHASE_SECONDS.time("tokenize"):
+            if tokens is None:
+                tokens = self.tokenize(self.compact(expression), expression)
+        with PHASE_SECONDS.time("parse"):
+            return self._parse(self.preprocess(expression), tokens, expression)
+
+    def _parse(self, expression, tokens, source):
+        values, operators, brackets = [], [], []  # brackets: positions of the open brackets on the operator stack
         if not tokens:
             raise EmptyExpression
-        for token in tokens:
-            if self._is_operand(token):
-                try:
-                    values.append(float(token))
-                except ValueError:
-                    values.append(token)
-                logger.debug("Added token '%s' to value stack: %s", token, values)
-            elif token in self.functions:
+        for kind, token, position in tokens:
+            if kind == NUMBER:
+                values.append((token, [(PUSH, token)]))
+                trace("Added token '%s' to value stack", token)
+            elif kind == FUNCTION:
                 operators.append(token)
-                logger.debug("Added function '%s' to operator stack: %s", token, operators)
-            elif token == '(':
+                trace("Added function '%s' to operator stack: %s", token, operators)
+            elif kind == LEFT:
                 operators.append(token)
-                logger.debug("Added '%s' to stack: %s", token, operators)
-            elif token == ')':
-                logger.debug("Found the closing bracket. Operator stack is %s", operators)
-                top = self._peek(operators)
-                while top is not None and top != '(':
-                    self._apply_operator(operators, values)
-                    top = self._peek(operators)
-                if top is None:
-                    logger.debug("There was a mismatched closing bracket. Raised MismatchedBrackets exception")
-                    raise MismatchedBrackets
-                else:
-                    operators.pop()  # Discard the '('
-                    logger.debug("Discarded opening bracket")
-                    if self._peek(operators) in self.functions:
-                        self._apply_function(operators, values)
-                logger.debug("Finished closing bracket handling. Values: %s, Operators: %s", values, operators)
-            elif token in self.operators:
-                logger.debug("Met an operator: '%s'", token)
-                top = self._peek(operators)
-                while top is not None and top not in "()" and self._greater_precedence(top, token):
-                    self._apply_operator(operators, values)
-                    top = self._peek(operators)
+                brackets.append(position)
+                trace("Added '%s' to stack: %s", token, operators)
+            elif kind == RIGHT:
+                trace("Found the closing bracket. Operator stack is %s", operators)
+                while operators and operators[-1] != '(':
+                    self._emit_operator(operators.pop(), values)
+                if not operators:
+                    trace("There was a mismatched closing bracket. Raised MismatchedBrackets exception")
+                    raise MismatchedBrackets(f"')' at position {_source_position(source, position)} has no opening bracket")
+                operators.pop()  # Discard the '('
+                brackets.pop()
+                trace("Discarded opening bracket")
+                if operators and operators[-1] in self.functions:
+                    self._emit_function(operators.pop(), values)
+            else:
+                trace("Met an operator: '%s'", token)
+                while operators and operators[-1] not in "()" and self._greater_precedence(operators[-1], token):
+                    self._emit_operator(operators.pop(), values)
                 operators.append(token)
-                logger.debug("Added operator '%s' to operator stack: %s", token, operators)
+                trace("Added operator '%s' to operator stack: %s", token, operators)
+        while operators:
+            if operators[-1] == '(':
+                trace("There was a mismatched opening bracket. Raised MismatchedBrackets exception")
+                raise MismatchedBrackets(f"'(' at position {_source_position(source, brackets[-1])} is never closed")
+            self._emit_operator(operators.pop(), values)
+        if not values:
+            # Only brackets, e.g. "()"
+            raise EmptyExpression
+        return Program(expression, values[0][1], self)
+
+
+GRAMMAR = Grammar(
+    functions={"floor": math.floor,
+               "ceil": math.ceil,
+               "abs": abs,
+               "round": round},
+    operators={"+": Operator(operator.add, priority=1, operands=2),
+               "-": Operator(operator.sub, priority=1, operands=2),
+               "*": Operator(operator.mul, priority=2, operands=2),
+               "/": Operator(operator.truediv, priority=2, operands=2),
+               "%": Operator(operator.mod, priority=2, operands=2),
+               "^": Operator(operator.pow, priority=3, operands=2),
+               "d": Operator(RolledDice, priority=5, operands=2, pure=False),
+               "_": Operator(operator.neg, priority=10, operands=1)},
+    roll_modifiers={"k": Operator(keep_highest, priority=4, operands=2, pure=False),
+                    "kh": Operator(keep_highest, priority=4, operands=2, pure=False),
+                    "kl": Operator(keep_lowest, priority=4, operands=2, pure=False),
+                    "dh": Operator(drop_highest, priority=4, operands=2, pure=False),
+                    "dl": Operator(drop_lowest, priority=4, operands=2, pure=False),
+                    "r": Operator(reroll_equal, priority=4, operands=2, pure=False),
+                    "r=": Operator(reroll_equal, priority=4, operands=2, pure=False),
+                    "r>": Operator(reroll_more, priority=4, operands=2, pure=False),
+                    "r<": Operator(reroll_less, priority=4, operands=2, pure=False),
+                    "ro": Operator(reroll_once_equal, priority=4, operands=2, pure=False),
+                    "ro=": Operator(reroll_once_equal, priority=4, operands=2, pure=False),
+                    "ro>": Operator(reroll_once_more, priority=4, operands=2, pure=False),
+                    "ro<": Operator(reroll_once_less, priority=4, operands=2, pure=False),
+                    "!": Operator(explode, priority=4, operands=1, pure=False),
+                    "!=": Operator(explode_equal, priority=4, operands=2, pure=False),
+                    "!>": Operator(explode_more, priority=4, operands=2, pure=False),
+                    "!<": Operator(explode_less, priority=4, operands=2, pure=False),
+                    "!!": Operator(explode_compounding, priority=4, operands=1, pure=False),
+                    "!!=": Operator(explode_compounding_equal, priority=4, operands=2, pure=False),
+                    "!!>": Operator(explode_compounding_more, priority=4, operands=2, pure=False),
+                    "!!<": Operator(explode_compounding_less, priority=4, operands=2, pure=False)})
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "size", "maxsize"])
+
+
+class ProgramCache:
+    '''Bounded LRU cache of compiled programs keyed by grammar and preprocessed expression'''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self.__programs = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__programs)
+
+    def get(self, grammar, expression):
+        with self.__lock:
+            program = self.__programs.get((grammar, expression))
+            if program is None:
+                self.misses += 1
             else:
-                logger.debug("Raised UnknownSymbol('%s') exception", token)
-                raise UnknownSymbol(token)
-        while self._peek(operators) is not None:
-            if self._peek(operators) == '(':
-                logger.debug("There was a mismatched opening bracket. Raised MismatchedBrackets exception")
-                raise MismatchedBrackets
+                self.hits += 1
+                self.__programs.move_to_end((grammar, expression))
+            return program
+
+    def put(self, program):
+        with self.__lock:
+            self.__programs[(program.grammar, program.source)] = program
+            self.__programs.move_to_end((program.grammar, program.source))
+            while len(self.__programs) > self.maxsize:
+                self.__programs.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__programs.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self.__programs), self.maxsize)
+
+
+PROGRAM_CACHE = ProgramCache()
+
+
+def compile_expression(expression, grammar=GRAMMAR, cache=PROGRAM_CACHE):
+    '''Returns the compiled Program for the expression, reusing a cached one when possible'''
+    with PHASE_SECONDS.time("preprocess"):
+        key = grammar.preprocess(expression)
+    program = cache.get(grammar, key) if cache is not None else None
+    if program is None:
+        program = grammar.compile(expression)
+        if cache is not None:
+            cache.put(program)
+    return program
+
+
+class ExpressionEvaluation:
+    '''Evaluates an expression, keeping both its compiled program and result
+
+    With times > 1 the expression is compiled once and executed that many times, result is the first of results.
+    With a seed the dice are drawn from a random source of their own, so the same seed rolls the same dice again.
+    A program already compiled from the expression (e.g. a saved macro) is run without compiling it again'''
+    def __init__(self, expression, grammar=GRAMMAR, cache=PROGRAM_CACHE, times=1, seed=None, program=None):
+        trace("Initializing evaluation of expression '%s' (seed %s)", expression, seed)
+        self.seed = seed
+        self.grammar = grammar
+        self.functions = grammar.functions
+        self.operators = grammar.operators
+        self.roll_modifiers = grammar.roll_modifiers
+        self.program = program
+        self.result = None
+        self.results = []
+        try:
+            if seed is None:
+                self.results = self._evaluate(expression, cache, times)
             else:
-                self._apply_operator(operators, values)
-        return values[0]
+                with dicebackends.using(seed):
+                    self.results = self._evaluate(expression, cache, times)
+            self.result = self.results[0]
+            trace("The result of evaluation: %s", tracing.Short(self.results) if times > 1 else self.result)
+            if isinstance(self.result, RolledDice) and trace:
+                trace("Rolls made: %s", tracing.Short(self.result.rolls))
+                if any(len(group) for group in self.result.dropped_rolls):
+                    trace("Rolls dropped: %s", tracing.Short(self.result.dropped_rolls))
+                if any(len(group) for group in self.result.additional_rolls):
+                    trace("Additional rolls made: %s", tracing.Short(self.result.additional_rolls))
+        except Exception as e:
+            trace("Raised exception %r for expression '%s'", e, expression)
+            raise e
+
+    def _evaluate(self, expression, cache=PROGRAM_CACHE, times=1):
+        if times < 1:
+            raise BatchValueError(f"The number of rolls must be positive, got {times}")
+        if self.program is None:
+            self.program = compile_expression(expression, self.grammar, cache)
+        with PHASE_SECONDS.time("estimate"):
+            self.program.cost.check(times=times)
+        with PHASE_SECONDS.time("execute"):
+            return [self.program.execute() for _ in range(times)]
+
+
+def evaluate(expression, seed=None, program=None):
+    '''Result of the expression, for callers that don't need the evaluation itself (e.g. worker processes)'''
+    return ExpressionEvaluation(expression, seed=seed, program=program).result
+
+
+def split_batch(query, max_batch=MAX_BATCH):
+    '''Splits "N#expression; expression; ..." into [(expression, times)]
+
+    Raises BatchValueError if a count isn't positive or the counts add up to more than max_batch'''
+    batch = []
+    for part in query.split(";"):
+        repeat = BATCH_PATTERN.fullmatch(part)
+        expression, times = (repeat[2], int(repeat[1])) if repeat else (part, 1)
+        if times < 1:
+            raise BatchValueError(f"The number of rolls must be positive, got {times}")
+        batch.append((expression.strip(), times))
+    if len(batch) > 1:
+        # A stray separator (e.g. "1d6;") shouldn't fail a batch, an expression that is empty on its own still does
+        batch = [(expression, times) for expression, times in batch if expression] or batch[:1]
+    total = sum(times for _, times in batch)
+    if total > max_batch:
+        raise BatchValueError(f"At most {max_batch} rolls are allowed in one message, {total} were asked for")
+    return batch
+
+
+def is_batch(query):
+    return ";" in query or BATCH_PATTERN.match(query) is not None
+
+
+def evaluate_batch(query, seed=None):
+    '''[(expression, [results as floats])] of every expression of a batch query, see split_batch. The whole batch
+    is drawn from one random source when seeded
+
+    Results are sent back as plain numbers, so a worker process doesn't pickle the rolls of every evaluation'''
+    batch = split_batch(query)
+    with dicebackends.using(seed) if seed is not None else contextlib.nullcontext():
+        return [(expression, [float(result) for result in ExpressionEvaluation(expression, times=times).results])
+                for expression, times in batch]
 
 
 def main():
-    expression = input("Enter expression:\n")
-    print(f"Answer: {ExpressionEvaluation(expression).result}")
+    parser = argparse.ArgumentParser(description="Evaluates a dice expression")
+    parser.add_argument("expression", nargs="?", help="the expression, asked for when not given")
+    parser.add_argument("--seed", type=int, help="roll with this seed, e.g. to replay a roll the bot logged")
+    args = parser.parse_args()
+    tracing.configure()
+    expression = args.expression if args.expression is not None else input("Enter expression:\n")
+    if is_batch(expression):
+        for part, results in evaluate_batch(expression, args.seed):
+            print(f"{part}: {results}")
+        return
+    evaluation = ExpressionEvaluation(expression, seed=args.seed)
+    print(f"Answer: {evaluation.result}")
+    if isinstance(evaluation.result, RolledDice):
+        print(f"Rolls: {tracing.Short(evaluation.result.rolls)}")
 
 
 if (__name__ == "__main__"):
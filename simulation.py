@@ -0,0 +1,305 @@
+import math
+import time
+import operator
+import logging
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import shuntingyard
+import distribution
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+TRIALS = 100000  # Default sample budget
+MAX_TRIALS = 10000000
+DEADLINE = 2.0  # Seconds a simulation may take before it stops with the samples it has
+BATCH_SIZE = 1 << 15  # Most trials evaluated together in one vectorized pass
+BATCH_MEMORY = 1 << 27  # Bytes the dice of a batch may take, fewer trials are evaluated together the more dice they roll
+DIE_BYTES = 48  # Bytes a die takes while a batch is evaluated: its value, mask and the temporary arrays made from them
+EXPLODE_DEPTH = distribution.EXPLODE_DEPTH  # Exploding dice stop after this many waves of extra dice
+
+
+class SimulationError(Exception):
+    '''The expression can't be simulated'''
+
+
+class Pool:
+    '''Dice rolled in every trial at once: one row of values per trial, mask tells which of them are in the pool'''
+    def __init__(self, values, mask, low, high):
+        self.values = values
+        self.mask = mask
+        self.low = low  # Lowest and highest face of a fresh die, per trial
+        self.high = high
+
+    def total(self):
+        return numpy.where(self.mask, self.values, 0).sum(axis=1).astype(float)
+
+    def draw(self, generator, rows, shape=None):
+        '''Fresh dice for the given trial of every cell, or a row of shape[1] dice per trial'''
+        low, high = self.low[rows], self.high[rows]
+        if shape is not None:
+            low, high = low[:, None], high[:, None]
+        return generator.integers(low, high, size=shape, endpoint=True)
+
+
+def _trials(value, size):
+    '''Per-trial array of a value that can also be a constant'''
+    if isinstance(value, Pool):
+        value = value.total()
+    return numpy.broadcast_to(numpy.asarray(value, dtype=float), (size,))
+
+
+def _integers(value, size, exception, message):
+    if isinstance(value, str):
+        raise exception(message.format(value))
+    return numpy.round(_trials(value, size)).astype(numpy.int64)
+
+
+class BatchEvaluation:
+    '''Evaluates a compiled program for a whole batch of trials, every value is an array with one entry per trial'''
+    def __init__(self, program, size, generator, depth=EXPLODE_DEPTH):
+        self.program = program
+        self.size = size
+        self.generator = generator
+        self.depth = depth
+        self.truncated = 0
+
+    def dice(self, number, sides):
+        number = numpy.round(_trials(number, self.size)).astype(numpy.int64)
+        if (number < 0).any():
+            raise shuntingyard.NegativeRollMeasurements(f"Cannot roll negative number of dice: {number.min()}")
+        if sides == "F":
+            low, high = numpy.full(self.size, -1), numpy.full(self.size, 1)
+        else:
+            low, high = numpy.ones(self.size, dtype=numpy.int64), numpy.round(_trials(sides, self.size)).astype(numpy.int64)
+            if (high < 0).any():
+                raise shuntingyard.NegativeRollMeasurements(f"Cannot roll dice with negative number of sides: {high.min()}")
+            if ((high < 1) & (number > 0)).any():
+                raise SimulationError("Cannot roll dice with no sides")
+        width = int(number.max()) if self.size else 0
+        mask = numpy.arange(width) < number[:, None]
+        values = self.generator.integers(low[:, None], numpy.maximum(high, low)[:, None], size=(self.size, width), endpoint=True)
+        return Pool(values, mask, low, high)
+
+    def keep(self, pool, count, *, highest=True, drop=False):
+        count = _integers(count, self.size, shuntingyard.KeepValueError, "Number of dice to keep/drop ({}) has to be a number")
+        available = pool.mask.sum(axis=1)
+        keep_highest = highest
+        if drop:
+            count, keep_highest = available - count, not highest
+        if ((count < 0) | (count > available)).any():
+            raise shuntingyard.KeepValueError(f"Number of dice to keep/drop has to be positive and less than number of rolls ({available.min()})")
+        # Dice outside of the pool sort after every die that can be kept
+        sentinel = numpy.iinfo(numpy.int64).min if keep_highest else numpy.iinfo(numpy.int64).max
+        keys = numpy.where(pool.mask, pool.values, sentinel)
+        order = numpy.argsort(-keys if keep_highest else keys, axis=1, kind="stable")
+        mask = numpy.zeros_like(pool.mask)
+        numpy.put_along_axis(mask, order, numpy.arange(pool.mask.shape[1]) < count[:, None], axis=1)
+        return Pool(pool.values, mask, pool.low, pool.high)
+
+    def reroll(self, pool, target, *, relation, once=False):
+        target = _integers(target, self.size, shuntingyard.RerollValueError, "Number of dice to reroll ({}) has to be a number")[:, None]
+        matches = shuntingyard.RELATIONS[relation]
+        values, rows = pool.values.copy(), numpy.broadcast_to(numpy.arange(self.size)[:, None], pool.values.shape)
+        pending = pool.mask & matches(values, target)
+        if not once:
+            low, high = pool.low[:, None], pool.high[:, None]
+            allowed = {"=": (low != target) | (high != target), ">": low <= target, "<": high >= target}[relation]
+            if (pending & ~allowed).any():
+                raise shuntingyard.RerollValueError(f"Rerolling dice that are {relation}{target.min()} would never stop")
+        while pending.any():
+            values[pending] = pool.draw(self.generator, rows[pending])
+            if once is True:
+                break
+            pending &= matches(values, target)
+        return Pool(values, pool.mask, pool.low, pool.high)
+
+    def explode(self, pool, target=None, *, relation="=", compounding=False):
+        if target is None or target == "F":
+            target = pool.high
+        target = _integers(target, self.size, shuntingyard.ExplodeValueError, "Target number for exploding dice ({}) has to be a number (or 'F' for Fate dice)")
+        matches, rows = shuntingyard.RELATIONS[relation], numpy.arange(self.size)
+        values, mask = pool.values.copy(), pool.mask.copy()
+        if compounding:
+            pending = mask & matches(values, target[:, None])
+            cells = numpy.broadcast_to(rows[:, None], values.shape)
+            for wave in range(self.depth):
+                if not pending.any():
+                    break
+                draws = pool.draw(self.generator, cells[pending])
+                values[pending] += draws
+                pending[pending] = matches(draws, target[cells[pending]])
+            self.truncated += int(pending.any(axis=1).sum())
+            return Pool(values, mask, pool.low, pool.high)
+        pending = (mask & matches(values, target[:, None])).sum(axis=1)
+        for wave in range(self.depth):
+            if not pending.any():
+                break
+            width = int(pending.max())
+            wave_mask = numpy.arange(width) < pending[:, None]
+            draws = pool.draw(self.generator, rows, (self.size, width))
+            values, mask = numpy.hstack((values, draws)), numpy.hstack((mask, wave_mask))
+            pending = (wave_mask & matches(draws, target[:, None])).sum(axis=1)
+        self.truncated += int(numpy.count_nonzero(pending))
+        return Pool(values, mask, pool.low, pool.high)
+
+    def arithmetic(self, oper, first, second):
+        first, second = _trials(first, self.size), _trials(second, self.size)
+        if oper in (operator.truediv, operator.mod) and (second == 0).any():
+            raise ZeroDivisionError("There is a chance of dividing by zero")
+        with numpy.errstate(over="ignore", invalid="ignore"):
+            return oper(first, second)
+
+    def execute(self):
+        values = []
+        for kind, token in self.program.instructions:
+            if kind == shuntingyard.PUSH:
+                values.append(token)
+            elif kind == shuntingyard.FUNCTION:
+                values.append(FUNCTIONS[self.program.grammar.functions[token]](_trials(values.pop(), self.size)))
+            else:
+                oper = self.program.grammar.operators[token]
+                args = values[-oper.operands:]
+                del values[-oper.operands:]
+                if token in self.program.grammar.roll_modifiers:
+                    if not isinstance(args[0], Pool):
+                        raise shuntingyard.RollModifierMisuse(f"Tried to apply roll modifier to something that is not a roll: {args[0]}")
+                    if oper.function not in distribution.MODIFIERS:
+                        raise SimulationError(f"Roll modifier '{token}' can't be simulated")
+                    name, options = distribution.MODIFIERS[oper.function]
+                    values.append(getattr(self, name)(*args, **options))
+                elif oper.function is shuntingyard.RolledDice:
+                    values.append(self.dice(*args))
+                elif oper.function is operator.neg:
+                    values.append(-_trials(args[0], self.size))
+                elif oper.function in distribution.ARITHMETIC:
+                    values.append(self.arithmetic(oper.function, *args))
+                else:
+                    raise SimulationError(f"Operator '{token}' can't be simulated")
+        return _trials(values[0], self.size).copy()
+
+
+FUNCTIONS = {}
+if numpy is not None:
+    FUNCTIONS = {math.floor: numpy.floor, math.ceil: numpy.ceil, abs: numpy.abs, round: numpy.round}
+
+
+def batch_size(program):
+    '''Trials of the program evaluated together, as many as BATCH_MEMORY holds the dice of (at least one)
+
+    Every die of a trial is a cell of the batch, so a batch of pools of a few thousand dice would otherwise take
+    gigabytes. Raises SimulationError if even a single trial doesn't fit'''
+    dice = max(program.cost.listed, math.ceil(program.cost.draws), 1)
+    if dice * DIE_BYTES > BATCH_MEMORY:
+        raise SimulationError(f"A trial would roll about {dice:.3g} dice, at most {BATCH_MEMORY // DIE_BYTES} can be simulated")
+    return max(1, min(BATCH_SIZE, BATCH_MEMORY // (dice * DIE_BYTES)))
+
+
+def split_trials(query, grammar=shuntingyard.GRAMMAR):
+    '''Splits "<expression> [trials]" into the expression and the number of trials
+
+    Whitespace doesn't separate tokens in expressions, so a trailing number is only taken as the number of trials
+    when the text before it is a complete expression on its own'''
+    expression, _, last = query.strip().rpartition(" ")
+    if expression and last.isdigit():
+        try:
+            shuntingyard.compile_expression(expression, grammar)
+            return expression, int(last)
+        except Exception:
+            pass
+    return query, TRIALS
+
+
+class SimulationEvaluation:
+    '''Estimates the distribution of an expression by evaluating it over many random trials'''
+    def __init__(self, expression, trials=TRIALS, deadline=DEADLINE, precision=None, seed=None, grammar=shuntingyard.GRAMMAR):
+        logger.info("Simulating expression '%s' over %s trials", expression, trials)
+        self.program = shuntingyard.compile_expression(expression, grammar)
+        self.program.cost.check()
+        self.budget = max(1, min(int(trials), MAX_TRIALS))
+        self.truncated = 0
+        start = time.perf_counter()
+        if numpy is not None:
+            self.samples = self._simulate(numpy.random.default_rng(seed), start + deadline, precision)
+        else:
+            self.samples = self._interpret(start + deadline)
+        self.elapsed = time.perf_counter() - start
+        self.trials = len(self.samples)
+        logger.info("Simulated %s trials of '%s' in %.3f s", self.trials, expression, self.elapsed)
+
+    def _simulate(self, generator, deadline, precision):
+        batches, done, total, squares = [], 0, 0.0, 0.0
+        size = batch_size(self.program)
+        while done < self.budget and (not batches or time.perf_counter() < deadline):
+            batch = BatchEvaluation(self.program, min(size, self.budget - done), generator)
+            samples = batch.execute()
+            self.truncated += batch.truncated
+            batches.append(samples)
+            done += len(samples)
+            total, squares = total + samples.sum(), squares + (samples ** 2).sum()
+            if precision is not None and done > 1:
+                variance = max(squares / done - (total / done) ** 2, 0.0)
+                if 1.96 * math.sqrt(variance / done) <= precision:
+                    break
+        return numpy.concatenate(batches) if batches else numpy.zeros(0)
+
+    def _interpret(self, deadline):
+        '''Fallback without NumPy: runs the program once per trial'''
+        samples = []
+        while len(samples) < self.budget and (not samples or time.perf_counter() < deadline):
+            samples.append(float(self.program.execute()))
+        return samples
+
+    @property
+    def complete(self):
+        '''Whether the whole sample budget was used before the deadline'''
+        return self.trials >= self.budget
+
+    @property
+    def mean(self):
+        return float(sum(self.samples)) / self.trials if numpy is None else float(numpy.mean(self.samples))
+
+    @property
+    def stderr(self):
+        '''Standard error of the mean'''
+        if self.trials < 2:
+            return float("inf")
+        if numpy is not None:
+            return float(numpy.std(self.samples, ddof=1)) / math.sqrt(self.trials)
+        mean = self.mean
+        return math.sqrt(sum((sample - mean) ** 2 for sample in self.samples) / (self.trials - 1) / self.trials)
+
+    def distribution(self):
+        '''Empirical distribution of the samples'''
+        if numpy is not None:
+            values, counts = numpy.unique(self.samples, return_counts=True)
+        else:
+            counts = Counter(self.samples)
+            values, counts = list(counts), list(counts.values())
+        return distribution.Distribution({float(value): int(count) / self.trials for value, count in zip(values, counts)})
+
+    def describe(self):
+        '''Estimated statistics, histogram and how precise the estimate is'''
+        lines = [distribution.describe(self.distribution()),
+                 f"{self.trials} trials in {self.elapsed:.2f} s, mean {self.mean:.4g} ± {1.96 * self.stderr:.2g} (95%)"]
+        if not self.complete:
+            lines.append(f"(stopped at the deadline, {self.budget - self.trials} trials were skipped)")
+        if self.truncated:
+            lines.append(f"(exploding dice were cut off after {EXPLODE_DEPTH} waves in {self.truncated} trials)")
+        return "\n".join(lines)
+
+
+def describe_expression(expression, trials=TRIALS, deadline=DEADLINE):
+    return SimulationEvaluation(expression, trials, deadline).describe()
+
+
+def describe_query(query, deadline=DEADLINE):
+    '''(expression, description) of a /sim query "<expression> [trials]", split where it's simulated as telling the
+    number of trials apart compiles the expression'''
+    expression, trials = split_trials(query)
+    return expression, describe_expression(expression, trials, deadline)
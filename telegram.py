@@ -0,0 +1,128 @@
+import json
+import uuid
+import asyncio
+import functools
+import contextvars
+import logging
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.telegram.org"
+POLL_TIMEOUT = 30  # Seconds a getUpdates long poll may wait for new messages
+IO_THREADS = 16  # Requests to the API that may be in flight at once
+RETRY_DELAY = 1  # Seconds to wait before polling again after a failed getUpdates
+MESSAGE_LIMIT = 4095  # Characters Telegram allows in a message
+CAPTION_LIMIT = 1024  # Characters Telegram allows in the caption of a document
+
+CONTENT_TYPES = ("text", "audio", "document", "game", "photo", "sticker", "video", "voice", "video_note", "contact",
+                 "location", "venue", "new_chat_members", "left_chat_member", "new_chat_title", "new_chat_photo",
+                 "delete_chat_photo", "group_chat_created", "pinned_message", "invoice", "successful_payment")
+
+
+class TelegramError(Exception):
+    '''The Bot API answered with an error'''
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.description = description
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+
+def glance(message):
+    '''Returns (content_type, chat_type, chat_id) of a message'''
+    content_type = next((key for key in CONTENT_TYPES if key in message), None)
+    return content_type, message["chat"]["type"], message["chat"]["id"]
+
+
+def encode_multipart(params, files):
+    '''Encodes parameters and files ({field: (filename, bytes)}) as multipart/form-data, returns (body, content type)'''
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in params.items():
+        value = value if isinstance(value, str) else json.dumps(value)
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class TelegramAPI:
+    '''Asynchronous transport for the Telegram Bot API
+
+    Requests are blocking urllib calls run in a thread pool of their own, so neither a slow round trip nor a long
+    poll holds up the event loop'''
+    def __init__(self, token, base_url=API_URL, executor=None, poll_timeout=POLL_TIMEOUT):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.executor = executor or ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="telegram")
+        self.poll_timeout = poll_timeout
+        self.offset = None
+
+    def _request(self, method, params, timeout, files=None):
+        if files:
+            data, content_type = encode_multipart(params, files)
+        else:
+            data, content_type = json.dumps(params).encode(), "application/json"
+        request = urllib.request.Request(f"{self.base_url}/bot{self.token}/{method}", data=data,
+                                         headers={"Content-Type": content_type})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                answer = json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                answer = json.load(e)
+            except ValueError:
+                raise TelegramError(f"HTTP error {e.code}", e.code)
+        if not answer.get("ok"):
+            parameters = answer.get("parameters", {})
+            raise TelegramError(answer.get("description"), answer.get("error_code"), parameters.get("retry_after"))
+        return answer["result"]
+
+    async def call(self, method, timeout=None, files=None, **params):
+        '''Calls a Bot API method, returns its result or raises TelegramError. files ({field: (filename, bytes)})
+        are uploaded along with the parameters'''
+        loop = asyncio.get_running_loop()
+        timeout = timeout or self.poll_timeout + 10
+        request = functools.partial(contextvars.copy_context().run, self._request, method, params, timeout, files)
+        return await loop.run_in_executor(self.executor, request)
+
+    async def get_updates(self, offset=None, timeout=None):
+        params = {"timeout": self.poll_timeout if timeout is None else timeout}
+        if offset is not None:
+            params["offset"] = offset
+        return await self.call("getUpdates", **params)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call("sendMessage", chat_id=chat_id, text=text, **kwargs)
+
+    async def send_document(self, chat_id, filename, data, **kwargs):
+        return await self.call("sendDocument", files={"document": (filename, data)}, chat_id=chat_id, **kwargs)
+
+    async def answer_inline_query(self, inline_query_id, results, **kwargs):
+        return await self.call("answerInlineQuery", inline_query_id=inline_query_id, results=results, **kwargs)
+
+    async def edit_message_text(self, text, **kwargs):
+        '''Edits a message given by chat_id and message_id, or by inline_message_id when it was sent inline'''
+        return await self.call("editMessageText", text=text, **kwargs)
+
+    async def updates(self):
+        '''Yields updates forever, confirming every batch with the next poll'''
+        while True:
+            try:
+                batch = await self.get_updates(self.offset)
+            except (TelegramError, OSError) as e:
+                logger.warning("Polling for updates failed: %r", e)
+                await asyncio.sleep(getattr(e, "retry_after", None) or RETRY_DELAY)
+                continue
+            for update in batch:
+                self.offset = update["update_id"] + 1
+                yield update
+
+    def close(self):
+        self.executor.shutdown(wait=False)
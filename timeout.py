@@ -1,67 +1,206 @@
 import time
+import threading
 import multiprocessing
 import logging
-import functools
+
+import tracing
+import metrics
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+WORKERS = 2
+MEMORY_LIMIT = 1 << 30  # Bytes of address space every worker may use
+MAX_QUEUE = 32  # Calls that may wait for a free worker before new ones are rejected
+
+WAIT_SECONDS = metrics.histogram("dxroll_evaluator_wait_seconds", "Time calls waited for a free worker")
 
 
 class TimeoutException(Exception):
-    pass
     ''' The function took too long to execute '''
 
 
-class RunnableProcessing(multiprocessing.Process):
-    ''' Run a function in a child process. Pass back any exception received'''
-    def __init__(self, func, *args, **kwargs):
-        self.queue = multiprocessing.Queue(maxsize=1)
-        args = (func,) + args
-        multiprocessing.Process.__init__(self, target=self.run_func, args=args, kwargs=kwargs)
+class PoolBusy(Exception):
+    ''' Too many calls are already waiting for a free worker '''
 
-    def run_func(self, func, *args, **kwargs):
+
+class WorkerCrashed(Exception):
+    ''' The worker process died while executing the function '''
+
+
+def _work(connection, memory_limit, metrics_enabled=False):
+    ''' Worker process loop: receives (function, args, kwargs, trace), sends back (success, result or exception,
+    metrics recorded while running the function) '''
+    metrics.enable(metrics_enabled)
+    metrics.REGISTRY.drain()  # A forked worker starts with a copy of the parent's values
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task is None:
+            break
+        function, args, kwargs, trace = task
         try:
-            result = func(*args, **kwargs)
-            self.queue.put((True, result))
+            with tracing.resume(trace):
+                answer = (True, function(*args, **kwargs))
         except Exception as e:
-            self.queue.put((False, e))
-
-    def done(self):
-        return self.queue.full()
-
-    def result(self):
-        return self.queue.get()
-
-
-def timeout(seconds, force_kill=True):
-    ''' Timeout decorator using Python multiprocessing.
-    Courtesy of http://code.activestate.com/recipes/577853-timeout-decorator-with-multiprocessing/
-    '''
-    def wrapper(function):
-        @functools.wraps(function)
-        def inner(*args, **kwargs):
-            now = time.time()
-            proc = RunnableProcessing(function, *args, **kwargs)
-            proc.start()
-            proc.join(seconds)
-            if proc.is_alive():
-                if force_kill:
-                    proc.terminate()
-                runtime = time.time() - now
-                logging.info("The function %s timed out after %s seconds", function.__name__, runtime)
+            answer = (False, e)
+        answer += (metrics.REGISTRY.drain() if metrics_enabled else None,)
+        try:
+            connection.send(answer)
+        except Exception as e:
+            connection.send((False, WorkerCrashed(f"Couldn't send back the result: {e!r}"), None))
+
+
+class _Worker:
+    def __init__(self, context, memory_limit):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_work, args=(child_connection, memory_limit, metrics.ENABLED), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.tasks = 0
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+
+PoolStats = namedtuple("PoolStats", ["workers", "busy", "waiting", "submitted", "completed", "failed", "timeouts",
+                                     "crashes", "rejected", "recycled", "max_wait"])
+
+
+class EvaluatorPool:
+    ''' Persistent pool of warm worker processes that run functions with a deadline
+
+    A worker that misses the deadline is killed and replaced, so runaway evaluations can't pile up. Calls wait for
+    a free worker in a bounded queue and are rejected with PoolBusy once it is full'''
+    def __init__(self, workers=WORKERS, memory_limit=MEMORY_LIMIT, max_queue=MAX_QUEUE, max_tasks_per_worker=None, context=None):
+        self.context = context or multiprocessing.get_context()
+        self.memory_limit = memory_limit
+        self.max_queue = max_queue
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.__condition = threading.Condition()
+        self.__idle = [_Worker(self.context, memory_limit) for i in range(workers)]
+        self.__size = workers
+        self.__waiting = 0
+        self.submitted = self.completed = self.failed = self.timeouts = 0
+        self.crashes = self.rejected = self.recycled = 0
+        self.max_wait = 0.0
+        self.closed = False
+
+    def _acquire(self, seconds):
+        with self.__condition:
+            if self.closed:
+                raise RuntimeError("The pool is closed")
+            if not self.__idle and self.__waiting >= self.max_queue:
+                self.rejected += 1
+                raise PoolBusy(f"{self.__waiting} calls are already waiting for a worker")
+            self.submitted += 1
+            self.__waiting += 1
+            start = time.monotonic()
+            try:
+                while not self.__idle:
+                    remaining = start + seconds - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise PoolBusy(f"No worker became free in {seconds} seconds")
+                    self.__condition.wait(remaining)
+            finally:
+                self.__waiting -= 1
+            self.max_wait = max(self.max_wait, time.monotonic() - start)
+            if metrics.ENABLED:
+                WAIT_SECONDS.observe(time.monotonic() - start)
+            return self.__idle.pop()
+
+    def _release(self, worker, healthy=True):
+        if healthy and self.max_tasks_per_worker and worker.tasks >= self.max_tasks_per_worker:
+            worker.stop()
+            healthy = False
+        if not healthy:
+            self.recycled += 1
+            worker = _Worker(self.context, self.memory_limit)
+        with self.__condition:
+            if self.closed:
+                worker.stop()
+                return
+            self.__idle.append(worker)
+            self.__condition.notify()
+
+    def evaluate(self, seconds, function, *args, **kwargs):
+        ''' Runs function(*args, **kwargs) in a worker, raises TimeoutException if it takes longer than seconds '''
+        worker = self._acquire(seconds)
+        now = time.monotonic()
+        healthy = False  # Until it answers, a worker is replaced whatever went wrong (e.g. arguments that can't be pickled)
+        try:
+            worker.connection.send((function, args, kwargs, tracing.current()))
+            worker.tasks += 1
+            if not worker.connection.poll(seconds):
+                self.timeouts += 1
+                runtime = time.monotonic() - now
+                logger.info("The function %s timed out after %s seconds", getattr(function, "__name__", function), runtime)
                 raise TimeoutException('Timed out after {0} seconds'.format(runtime))
-            assert proc.done()
-            success, result = proc.result()
-            if success:
-                return result
-            else:
-                raise result
-        return inner
-    return wrapper
+            success, result, recorded = worker.connection.recv()
+            healthy = True
+        except (EOFError, OSError) as e:
+            self.crashes += 1
+            raise WorkerCrashed(f"The worker died while running {getattr(function, '__name__', function)}") from e
+        finally:
+            if not healthy:
+                worker.kill()
+            self._release(worker, healthy)
+        if recorded:
+            metrics.REGISTRY.merge(recorded)
+        if success:
+            self.completed += 1
+            return result
+        self.failed += 1
+        raise result
+
+    def stats(self):
+        with self.__condition:
+            idle, waiting = len(self.__idle), self.__waiting
+        return PoolStats(self.__size, self.__size - idle, waiting, self.submitted, self.completed, self.failed,
+                         self.timeouts, self.crashes, self.rejected, self.recycled, self.max_wait)
+
+    def close(self):
+        with self.__condition:
+            self.closed = True
+            workers, self.__idle = self.__idle, []
+        for worker in workers:
+            worker.stop()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    ''' Shared pool, started on first use '''
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = EvaluatorPool()
+        return _default_pool
 
 
 def evaluate(seconds, function, *args, **kwargs):
-    @timeout(seconds)
-    def timed_function(*args, **kwargs):
-        logging.debug("Started timed evaluation of function '%s(%s)'", function.__name__, *args)
-        return function(*args, **kwargs)
-    return timed_function(*args, **kwargs)
+    return default_pool().evaluate(seconds, function, *args, **kwargs)
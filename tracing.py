@@ -0,0 +1,144 @@
+import os
+import sys
+import queue
+import atexit
+import random
+import reprlib
+import logging
+import logging.handlers
+import contextlib
+import contextvars
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+FORMAT = "%(levelname)-8s (%(asctime)s) [%(trace_id)s] %(message)s"
+DATEFMT = "%d.%m.%y, %H:%M:%S"
+
+# (trace_id, sampled) of the request being handled
+_trace = contextvars.ContextVar("trace", default=(None, False))
+_listener = None
+
+_short_repr = reprlib.Repr()
+_short_repr.maxlist = _short_repr.maxtuple = _short_repr.maxset = _short_repr.maxdict = 16
+_short_repr.maxother = 200
+
+
+class Short:
+    '''Wraps a value that can be huge (e.g. a list of rolls) so it's only abbreviated and formatted when logged'''
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, (list, tuple)):
+            # Abbreviating is slower than repr, so small lists (of lists) are left alone
+            items = sum(len(item) if isinstance(item, (list, tuple)) else 1 for item in value)
+            if items > _short_repr.maxlist:
+                return _short_repr.repr(value)
+        return repr(value)
+
+    __repr__ = __str__
+
+
+class Tracer:
+    '''Debug tracing for a module logger
+
+    Calling it logs at DEBUG level if the logger is enabled for it or the current request was sampled, in which case
+    the record is emitted whatever the log level. Its truth value tells whether a trace would be emitted at all, to
+    guard traces whose arguments are expensive to compute'''
+    __slots__ = ("logger",)
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def __bool__(self):
+        return self.logger.isEnabledFor(logging.DEBUG) or _trace.get()[1]
+
+    def __call__(self, msg, *args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(msg, *args, stacklevel=2)
+        elif _trace.get()[1]:
+            self.logger.handle(self.logger.makeRecord(self.logger.name, logging.DEBUG, "(sampled)", 0, msg, args, None))
+
+
+class TraceFilter(logging.Filter):
+    '''Adds the trace_id of the current request to log records that don't have one yet'''
+    def filter(self, record):
+        if not hasattr(record, "trace_id"):
+            record.trace_id = _trace.get()[0] or "-"
+        return True
+
+
+def new_trace_id():
+    return f"{random.getrandbits(32):08x}"
+
+
+@contextlib.contextmanager
+def request(trace_id=None, sample_rate=0.0):
+    '''Handles the block as one request: its log records carry trace_id (a new one by default), and with probability
+    sample_rate all of its debug tracing is emitted whatever the log level'''
+    token = _trace.set((trace_id or new_trace_id(), bool(sample_rate) and random.random() < sample_rate))
+    try:
+        yield _trace.get()[0]
+    finally:
+        _trace.reset(token)
+
+
+@contextlib.contextmanager
+def resume(trace):
+    '''Continues a request in another thread or process, trace is what current() returned there'''
+    token = _trace.set(tuple(trace))
+    try:
+        yield trace[0]
+    finally:
+        _trace.reset(token)
+
+
+def current():
+    '''(trace_id, sampled) of the current request'''
+    return _trace.get()
+
+
+def configure(level=logging.INFO, stream=None, format=FORMAT, datefmt=DATEFMT):
+    '''Configures the root logger to hand records to a queue, which a listener thread writes to stream (stderr by
+    default), so logging never blocks the thread that logs'''
+    global _listener
+    _stop_listener()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(format, datefmt))
+    handler.addFilter(TraceFilter())
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(TraceFilter())
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork():
+    '''A forked child has the queue but not the listener thread, so it writes to the listener's handlers directly'''
+    if _listener is not None:
+        root = logging.getLogger()
+        for old_handler in list(root.handlers):
+            root.removeHandler(old_handler)
+        for handler in _listener.handlers:
+            root.addHandler(handler)
+
+
+atexit.register(_stop_listener)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
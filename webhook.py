@@ -0,0 +1,190 @@
+import os
+import json
+import hmac
+import asyncio
+import logging
+import threading
+import multiprocessing
+import queue
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import metrics
+import telegram
+import sendqueue
+import macros
+import auditlog
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_PENDING = 1000  # Updates received but not handled yet before new ones are refused (Telegram sends them again)
+MAX_BODY = 1 << 20  # Bytes an update may take
+SHARD_QUEUE = 1000  # Updates waiting for a worker process before the dispatcher waits for it
+
+UPDATES = metrics.counter("dxroll_webhook_updates_total", "Updates posted to the webhook, by what became of them", ["outcome"])
+
+
+class WebhookServer:
+    '''HTTP endpoint Telegram posts updates to, instead of the bot polling for them
+
+    Requests are served by threads of their own and must carry the secret token the webhook was set with. Accepted
+    updates wait in a bounded queue in the order they arrived, and updates() yields them like TelegramAPI.updates()
+    does. A request is only answered once its update is queued, and with 503 when the queue is full, so Telegram
+    keeps the update and posts it again later'''
+    def __init__(self, secret_token, host="127.0.0.1", port=0, path="/", max_pending=MAX_PENDING):
+        self.secret_token = secret_token
+        self.path = path
+        self.max_pending = max_pending
+        self.loop = None
+        self.queue = None
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                status = server._receive(self)
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    async def start(self):
+        '''Starts serving from a daemon thread, handing updates to the running event loop'''
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.max_pending)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info("Listening for updates on %s", self.url)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _receive(self, request):
+        '''Queues the update posted in request, returns the HTTP status to answer with'''
+        if request.path.split("?")[0] != self.path:
+            return 404
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            outcome, status = "unauthorized", 401
+        else:
+            length = int(request.headers.get("Content-Length", 0))
+            if length > MAX_BODY:
+                outcome, status = "malformed", 413
+            else:
+                try:
+                    update = json.loads(request.rfile.read(length))
+                    update["update_id"]
+                except (ValueError, TypeError, KeyError):
+                    outcome, status = "malformed", 400
+                else:
+                    accepted = asyncio.run_coroutine_threadsafe(self._put(update), self.loop).result()
+                    outcome, status = ("accepted", 200) if accepted else ("refused", 503)
+        if metrics.ENABLED:
+            UPDATES.inc(outcome)
+        if status != 200:
+            logger.warning("Answered an update posted to the webhook with %s (%s)", status, outcome)
+        return status
+
+    async def _put(self, update):
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def updates(self):
+        '''Yields the posted updates forever, in the order they were accepted'''
+        while True:
+            yield await self.queue.get()
+
+
+def shard(chat_id, shards):
+    '''The worker every message of the chat goes to, so a chat is always answered in order'''
+    return hash(chat_id) % shards
+
+
+def shard_key(update):
+    '''What the update is sharded by, None for updates the bot doesn't handle
+
+    Messages go by chat. Inline queries have none, they go by user, so a newer query reaches the worker that is
+    still debouncing the one it supersedes'''
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    inline = update.get("inline_query") or update.get("chosen_inline_result")
+    return None if inline is None else inline["from"]["id"]
+
+
+class ShardedDispatcher:
+    '''Hands updates to worker processes that each run a bot of their own, by the chat they come from
+
+    Every worker gets its share of Telegram's global rate limit, and messages wait in a bounded queue for it. When
+    a worker falls behind the dispatcher waits for it, which stops taking updates and fills the webhook's queue'''
+    def __init__(self, bot_class, token, workers, base_url=telegram.API_URL, context=None, macros_path=macros.DATABASE,
+                 audit_directory=auditlog.DIRECTORY):
+        self.context = context or multiprocessing.get_context()
+        self.inboxes = [self.context.Queue(SHARD_QUEUE) for _ in range(workers)]
+        # Not daemons, as they start evaluator processes of their own. close() has to be called to let them exit
+        # Every worker logs the rolls of its chats to an audit log of its own
+        self.processes = [self.context.Process(target=_work, args=(
+            bot_class, token, base_url, inbox, workers, macros_path, os.path.join(audit_directory, f"shard-{number}")))
+            for number, inbox in enumerate(self.inboxes)]
+        for process in self.processes:
+            process.start()
+
+    async def run(self, updates):
+        loop = asyncio.get_running_loop()
+        async for update in updates:
+            key = shard_key(update)
+            if key is None:
+                continue
+            inbox = self.inboxes[shard(key, len(self.inboxes))]
+            try:
+                inbox.put_nowait(update)
+            except queue.Full:
+                await loop.run_in_executor(None, inbox.put, update)
+
+    def close(self):
+        '''Lets the workers answer the messages they were given and waits for them to exit'''
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def _work(bot_class, token, base_url, inbox, workers, macros_path, audit_directory):
+    api = telegram.TelegramAPI(token, base_url=base_url)
+    outbox = sendqueue.Outbox(api, global_rate=sendqueue.GLOBAL_RATE / workers,
+                              global_burst=max(1, sendqueue.GLOBAL_BURST // workers))
+    # Each worker caches the macros of its own chats, the database is shared
+    bot = bot_class(token, api=api, outbox=outbox, macro_store=macros.MacroStore(macros_path),
+                    audit_log=auditlog.AuditLog(audit_directory))
+    try:
+        asyncio.run(_serve_inbox(bot, inbox))
+    finally:
+        bot.audit.close()
+        bot.macros.close()
+        bot.evaluator.close()
+        api.close()
+
+
+async def _serve_inbox(bot, inbox):
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await loop.run_in_executor(None, inbox.get)
+        if update is None:
+            break
+        bot.handle(update)
+    await bot.join()